@@ -3,6 +3,10 @@ ASGI config for ai_chat project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve it with an ASGI server (e.g. ``uvicorn ai_chat.asgi:application``) to get
+the async chat views (send_message_async, create_summary_async and
+character_generate_async), which wait on OpenAI without tying up a worker thread.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
@@ -48,6 +48,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.middleware.WriteBehindMiddleware',  # Batches per-request bookkeeping writes
     'token_management.middleware.TokenUsageMiddleware',  # Custom middleware for token tracking
     
 ]
@@ -129,6 +130,167 @@ CRISPY_TEMPLATE_PACK = 'bootstrap4'
 # OpenAI settings
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
+# LLM client settings (see core/services/llm_client.py for defaults)
+LLM_CLIENT = {
+    # 'openai', or 'fake' for deterministic offline completions (load tests, development)
+    'BACKEND': os.getenv('LLM_BACKEND', 'openai'),
+    # e.g. http://127.0.0.1:8765/v1 to use `manage.py fake_llm_server` through the real client
+    'BASE_URL': os.getenv('LLM_BASE_URL') or None,
+    # Fake backend response timing, in seconds
+    'FAKE': {
+        'LATENCY': float(os.getenv('FAKE_LLM_LATENCY', 0.5)),
+        'JITTER': float(os.getenv('FAKE_LLM_JITTER', 0.2)),
+    },
+    # Request timeouts in seconds, per feature
+    'TIMEOUTS': {
+        'character_chat': 30,
+        'character_creation': 90,
+        'memory_summarization': 45,
+        'default': 60,
+    },
+    'CONNECT_TIMEOUT': 5,
+    # Retries for 429/5xx responses, with jittered exponential backoff
+    'MAX_RETRIES': 3,
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 8,
+    # Cap on concurrent upstream calls per process, and how long to wait for a free slot
+    'MAX_CONCURRENCY': int(os.getenv('LLM_MAX_CONCURRENCY', 16)),
+    'ACQUIRE_TIMEOUT': 30,
+    # Keep-alive connection pool
+    'MAX_CONNECTIONS': 32,
+    'MAX_KEEPALIVE_CONNECTIONS': 16,
+    'KEEPALIVE_EXPIRY': 30,
+}
+
+# Models per LLM feature, in order of preference. latency_target is the SLO in
+# seconds: a model that misses it on average, or keeps failing, is skipped for
+# LLM_ROUTER['COOLDOWN'] seconds and traffic fails over to the next one.
+LLM_MODEL_ROUTES = {
+    'character_creation': [
+        {'model': 'gpt-4', 'latency_target': 40},
+        {'model': 'gpt-4o-mini', 'latency_target': 40},
+    ],
+    'character_chat': [
+        {'model': 'gpt-3.5-turbo', 'latency_target': 6, 'timeout': 15},
+        {'model': 'gpt-4o-mini', 'latency_target': 6},
+    ],
+    'memory_summarization': [
+        {'model': 'gpt-3.5-turbo', 'latency_target': 15},
+        {'model': 'gpt-4o-mini', 'latency_target': 15},
+    ],
+}
+
+LLM_ROUTER = {
+    'MIN_SAMPLES': 5,
+    'MAX_ERROR_RATE': 0.5,
+    'COOLDOWN': 30,
+}
+
+# Cache for deterministic LLM calls (character creation, summaries).
+# Use 'core.services.response_cache.DjangoCacheBackend' to share it via CACHES.
+LLM_RESPONSE_CACHE = {
+    'ENABLED': os.getenv('LLM_RESPONSE_CACHE_ENABLED', 'True').lower() == 'true',
+    'BACKEND': 'core.services.response_cache.LocMemLRUBackend',
+    'TTL': 60 * 60,  # seconds
+    'MAX_ENTRIES': 1024,
+    'OPTIONS': {},
+}
+
+# Chat prompt packing (see core/services/context_packer.py)
+CHAT_CONTEXT = {
+    # Token budget for the prompt: persona, memories, summaries, then recent messages
+    'PROMPT_BUDGET': int(os.getenv('CHAT_PROMPT_BUDGET', 3000)),
+    'MAX_MEMORIES': 5,
+    # Upper bound on history rows fetched per turn
+    'MAX_HISTORY_MESSAGES': 200,
+    # Once unsummarized messages exceed this many tokens, older ones are folded
+    # into the rolling summary, keeping roughly COMPACTION_KEEP_RECENT tokens verbatim
+    'COMPACTION_THRESHOLD': 2000,
+    'COMPACTION_KEEP_RECENT': 800,
+    'COMPACT_IN_BACKGROUND': True,
+}
+
+# Compiled character personas (prompt text, token count, pinned memories),
+# rebuilt once a character or its memories change (in any process)
+PERSONA_CACHE = {
+    'ENABLED': os.getenv('PERSONA_CACHE_ENABLED', 'True').lower() == 'true',
+    'CACHE_ALIAS': 'default',
+    'TTL': 60 * 60,  # seconds
+}
+
+# Batch character generation (characters:generate_batch)
+CHARACTER_BATCH = {
+    'MAX_SIZE': 20,
+    'CONCURRENCY': int(os.getenv('CHARACTER_BATCH_CONCURRENCY', 5)),
+}
+
+# Cached per-user quota snapshot read by TokenUsageMiddleware; a short TTL
+# bounds how long another process's invalidations take to show up here
+TOKEN_QUOTA_CACHE = {
+    'CACHE_ALIAS': 'default',
+    'TTL': 60,  # seconds
+}
+
+# Cached month-to-date usage counters behind TokenUsage.get_usage_summary,
+# rebuilt from the daily rollup on a miss; a short TTL bounds how far another
+# process's copy can lag
+TOKEN_USAGE_SUMMARY = {
+    'CACHE_ALIAS': 'default',
+    'TTL': 60,  # seconds
+}
+
+# In-memory buffer for TokenUsage ledger rows, bulk inserted in batches
+# (and always at process exit)
+USAGE_LEDGER = {
+    'BUFFERED': os.getenv('USAGE_LEDGER_BUFFERED', 'True').lower() == 'true',
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 2.0,  # seconds
+}
+
+# Quota reserved for LLM calls in flight; reservations left by a crashed
+# worker are dropped after TIMEOUT seconds without new ones
+TOKEN_RESERVATIONS = {
+    'ENABLED': True,
+    'TIMEOUT': 10 * 60,
+}
+
+# Per-user, per-feature token buckets in front of OpenAIService calls, sized
+# by subscription tier; throttled requests get a 429 with Retry-After
+LLM_RATE_LIMIT = {
+    'ENABLED': os.getenv('LLM_RATE_LIMIT_ENABLED', 'True').lower() == 'true',
+    'BACKEND': 'core.services.rate_limiter.DatabaseTokenBucketBackend',
+    'OPTIONS': {},
+    'TIERS': {
+        'free': {'CAPACITY': 5, 'PER_MINUTE': 10},
+        'basic': {'CAPACITY': 10, 'PER_MINUTE': 30},
+        'enterprise': {'CAPACITY': 30, 'PER_MINUTE': 120},
+    },
+}
+
+# TokenUsage rows from before the start of MONTHS months ago are moved into
+# compressed per-month archives by the archive_token_usage command. Reads of
+# ranges starting after that cutoff skip the archive, so don't raise MONTHS
+# once rows have been archived
+TOKEN_USAGE_ARCHIVE = {
+    'MONTHS': int(os.getenv('TOKEN_USAGE_ARCHIVE_MONTHS', 6)),
+}
+
+# Per-request write-behind buffer for counters, timestamps and usage rows
+WRITE_BEHIND = {
+    'ENABLED': os.getenv('WRITE_BEHIND_ENABLED', 'True').lower() == 'true',
+    # Flush on a background thread instead of before the response is returned
+    'FLUSH_IN_BACKGROUND': os.getenv('WRITE_BEHIND_IN_BACKGROUND', 'False').lower() == 'true',
+}
+
+# Database-backed background tasks, run by `manage.py run_tasks`
+TASK_QUEUE = {
+    # Run tasks inline instead of queueing them (no worker needed)
+    'EAGER': os.getenv('TASK_QUEUE_EAGER', 'False').lower() == 'true',
+    'MAX_ATTEMPTS': 3,
+    'RETRY_DELAY': 30,
+    'WORKERS': int(os.getenv('TASK_QUEUE_WORKERS', 4)),
+}
+
 # Pinecone settings
 PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
 PINECONE_ENVIRONMENT = os.getenv('PINECONE_ENVIRONMENT')
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('characters', '0003_charactergenerationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charactergenerationjob',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
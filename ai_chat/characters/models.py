@@ -1,6 +1,11 @@
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils import timezone
+from core.services import write_behind
+from core.services.persona_cache import CHARACTER_STATS_FIELDS, MEMORY_BOOKKEEPING_FIELDS, invalidate_persona
+from core.services.token_counter import count_tokens
 
 class Character(models.Model):
     """Model for AI characters"""
@@ -46,11 +51,26 @@ class Character(models.Model):
         new_total = self.total_interactions + 1
         new_avg = ((self.avg_interaction_tokens * self.total_interactions) + tokens_used) / new_total
         
-        # Update fields
+        # Update fields; the count is an F() increment so concurrent turns don't lose updates
         self.total_interactions = new_total
         self.avg_interaction_tokens = new_avg
         self.last_interaction = now
-        self.save(update_fields=['total_interactions', 'avg_interaction_tokens', 'last_interaction'])
+        write_behind.increment(self, total_interactions=1)
+        write_behind.update(self, avg_interaction_tokens=new_avg, last_interaction=now)
+    
+    @classmethod
+    def from_generated_data(cls, user, name, description, character_data, tokens_used):
+        """Build an unsaved character from OpenAIService.create_character output"""
+        return cls(
+            user=user,
+            name=name,
+            description=description,
+            background_story=character_data.get('background_story', ''),
+            personality_details=character_data.get('personality', {}),
+            voice=character_data.get('voice', ''),
+            traits=character_data.get('personality', {}).get('core_traits', []),
+            creation_token_cost=tokens_used
+        )
     
     def get_memory_objects(self):
         """Retrieve related memory objects from the character's memory"""
@@ -88,10 +108,15 @@ class CharacterMemory(models.Model):
     def __str__(self):
         return f"Memory for {self.character.name}: {self.content[:30]}..."
     
-    def access(self):
+    def save(self, *args, **kwargs):
+        if not self.token_count and self.content:
+            self.token_count = count_tokens(self.content)
+        super().save(*args, **kwargs)
+    
+    def access(self, when=None):
         """Mark this memory as accessed"""
-        self.last_accessed = timezone.now()
-        self.save(update_fields=['last_accessed'])
+        self.last_accessed = when or timezone.now()
+        write_behind.update(self, last_accessed=self.last_accessed)
 
 
 class CharacterRelationship(models.Model):
@@ -114,4 +139,72 @@ class CharacterRelationship(models.Model):
         unique_together = ['character', 'related_character']
     
     def __str__(self):
-        return f"{self.character.name}'s relationship with {self.related_character.name}"
\ No newline at end of file
+        return f"{self.character.name}'s relationship with {self.related_character.name}"
+
+
+class CharacterGenerationJob(models.Model):
+    """An AI character generation request, processed by the background worker"""
+    
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    )
+    
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='character_generation_jobs')
+    
+    # Generation request
+    name = models.CharField(max_length=100)
+    concept = models.TextField()
+    traits = models.JSONField(default=list, blank=True)
+    additional_info = models.TextField(blank=True)
+    
+    # Outcome
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    character = models.ForeignKey(Character, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    error = models.TextField(blank=True)
+    tokens_used = models.IntegerField(default=0)
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'status']),
+        ]
+    
+    def __str__(self):
+        return f"Generation of {self.name} for {self.user.username} ({self.status})"
+    
+    @property
+    def is_finished(self):
+        return self.status in ('succeeded', 'failed')
+
+
+def _drop_persona(character_id, bump=False):
+    # Drop it now and again on commit, so a turn that read the old rows
+    # mid-transaction can't leave a stale persona behind
+    invalidate_persona(character_id)
+    transaction.on_commit(lambda: invalidate_persona(character_id))
+    if bump:
+        # Other processes' cached personas are only replaced once the character's
+        # version (updated_at) changes
+        Character.objects.filter(pk=character_id).update(updated_at=timezone.now())
+
+@receiver([post_save, post_delete], sender=Character)
+def invalidate_character_persona(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= CHARACTER_STATS_FIELDS:
+        return
+    # A full save sets updated_at itself
+    _drop_persona(instance.pk, bump=kwargs['signal'] is post_save and update_fields is not None
+                  and 'updated_at' not in update_fields)
+
+@receiver([post_save, post_delete], sender=CharacterMemory)
+def invalidate_memory_persona(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= MEMORY_BOOKKEEPING_FIELDS:
+        return
+    _drop_persona(instance.character_id, bump=True)
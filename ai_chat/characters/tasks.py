@@ -0,0 +1,66 @@
+from datetime import timedelta
+
+from django.utils import timezone
+
+from core.services.openai_service import OpenAIService
+from core.services.pinecone_service import PineconeService
+from core.services.rate_limiter import RateLimited
+from core.services.task_queue import get_task_queue_settings, task
+from .models import Character, CharacterGenerationJob
+
+
+# The OpenAI client already retries transient errors, and a retry after a
+# charged call would charge again, so a failed generation isn't retried
+@task(max_attempts=1)
+def run_generation_job(job_id):
+    """Generate the character for a CharacterGenerationJob and record the outcome"""
+    now = timezone.now()
+    # A run whose worker died mid-generation (it outlived the task lease) gives the job back
+    CharacterGenerationJob.objects.filter(
+        pk=job_id, status='running',
+        started_at__lt=now - timedelta(seconds=get_task_queue_settings()['LEASE_TIMEOUT'])
+    ).update(status='pending', started_at=None)
+    # Claim the job; running or finished jobs (e.g. a duplicate run) are left alone
+    claimed = CharacterGenerationJob.objects.filter(
+        pk=job_id, status='pending'
+    ).update(status='running', started_at=now)
+    if not claimed:
+        return
+    job = CharacterGenerationJob.objects.select_related('user').get(pk=job_id)
+    
+    try:
+        result = OpenAIService(job.user).create_character(
+            name=job.name,
+            description=f"{job.concept}\n{job.additional_info if job.additional_info else ''}",
+            traits=job.traits
+        )
+        character_data = result['character_data']
+        job.tokens_used = result['token_usage']['total_tokens']
+        if 'error' in character_data:
+            raise ValueError(character_data['error'])
+        
+        character = Character.from_generated_data(job.user, job.name, job.concept, character_data, job.tokens_used)
+        character.save()
+    except Exception as e:
+        print(f"Error generating character: {str(e)}")
+        job.status = 'failed'
+        if isinstance(e, RateLimited):
+            job.error = str(e)
+        else:
+            job.error = "There was an error generating your character. Please try again."
+        job.completed_at = timezone.now()
+        job.save(update_fields=['status', 'error', 'tokens_used', 'completed_at'])
+        return
+    
+    # Create vector embedding
+    try:
+        character.vector_id = PineconeService().store_character_embedding(character)
+        character.save(update_fields=['vector_id'])
+    except Exception as e:
+        # Log the error but don't prevent character creation
+        print(f"Error creating vector embedding: {str(e)}")
+    
+    job.status = 'succeeded'
+    job.character = character
+    job.completed_at = timezone.now()
+    job.save(update_fields=['status', 'character', 'tokens_used', 'completed_at'])
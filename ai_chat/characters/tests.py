@@ -1,3 +1,206 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from core.models import BackgroundTask
+from core.services.task_queue import claim_tasks, run_task
+from token_management.models import TokenUsage, UserTokenLimit
+from .models import Character, CharacterGenerationJob
+from .tasks import run_generation_job
+
+User = get_user_model()
+
+
+def _completion(content, total_tokens):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=SimpleNamespace(prompt_tokens=total_tokens - 10, completion_tokens=10, total_tokens=total_tokens),
+    )
+
+
+@override_settings(LLM_RESPONSE_CACHE={'ENABLED': False})
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class BatchGenerationTests(TestCase):
+    """Test cases for generating several characters in one request"""
+
+    def setUp(self):
+        # Staff users skip the token limit middleware checks
+        self.user = User.objects.create_user(
+            username='director', password='testpassword123', is_staff=True, subscription_tier='basic'
+        )
+        self.client.force_login(self.user)
+
+    def generate(self, characters):
+        return self.client.post(
+            reverse('characters:generate_batch'),
+            data=json.dumps({'characters': characters}),
+            content_type='application/json'
+        )
+
+    def test_batch_creates_characters_and_charges_once(self):
+        """Valid items become characters; usage for the batch is one TokenUsage row"""
+        profile = json.dumps({'background_story': 'A long story', 'voice': 'Soft', 'personality': {'core_traits': ['brave']}})
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            get_client.return_value.chat.completions.create.side_effect = [
+                _completion(profile, 100), _completion(profile, 120),
+            ]
+            response = self.generate([
+                {'name': 'Ada', 'concept': 'A mathematician'},
+                {'name': 'Bo', 'concept': ''},
+                {'name': 'Cy', 'concept': 'A sailor', 'traits': ['calm', 'loyal']},
+            ])
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(data['tokens_used'], 220)
+        self.assertEqual([result['success'] for result in data['results']], [True, False, True])
+
+        characters = Character.objects.filter(user=self.user).order_by('name')
+        self.assertEqual([character.name for character in characters], ['Ada', 'Cy'])
+        self.assertTrue(all(character.vector_id for character in characters))
+        self.assertEqual(characters[0].traits, ['brave'])
+
+        self.assertEqual(TokenUsage.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(UserTokenLimit.objects.get(user=self.user).current_usage, 220)
+
+    def test_items_beyond_character_limit_are_rejected(self):
+        """Only as many characters as the tier still allows are generated"""
+        for i in range(9):
+            Character.objects.create(user=self.user, name=f'Existing {i}', description='Already here')
+
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            get_client.return_value.chat.completions.create.return_value = _completion('{"voice": "Loud"}', 50)
+            response = self.generate([{'name': 'Ada', 'concept': 'One'}, {'name': 'Bo', 'concept': 'Two'}])
+
+        self.assertEqual([result['success'] for result in response.json()['results']], [True, False])
+        self.assertEqual(get_client.return_value.chat.completions.create.call_count, 1)
+
+    def test_free_tier_batch_generates_what_the_quota_covers(self):
+        """Each item reserves its own quota, so a batch larger than what is left isn't refused outright"""
+        user = User.objects.create_user(username='newcomer', password='testpassword123')
+        UserTokenLimit.objects.filter(user=user).update(monthly_limit=3000)
+        self.client.force_login(user)
+
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            get_client.return_value.chat.completions.create.return_value = _completion('{"voice": "Loud"}', 50)
+            response = self.generate([
+                {'name': 'Ada', 'concept': 'One'}, {'name': 'Bo', 'concept': 'Two'}, {'name': 'Cy', 'concept': 'Three'},
+            ])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['success'] for result in response.json()['results']], [True, False, False])
+        self.assertEqual(get_client.return_value.chat.completions.create.call_count, 1)
+        token_limit = UserTokenLimit.objects.get(user=user)
+        self.assertEqual((token_limit.current_usage, token_limit.reserved_tokens), (50, 0))
+
+    def test_batch_beyond_quota_is_refused(self):
+        """With room for no item at all the request is a 403 and nothing is sent upstream"""
+        user = User.objects.create_user(username='spent', password='testpassword123')
+        UserTokenLimit.objects.filter(user=user).update(monthly_limit=1000)
+        self.client.force_login(user)
+
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            response = self.generate([{'name': 'Ada', 'concept': 'One'}])
+
+        self.assertEqual(response.status_code, 403)
+        get_client.assert_not_called()
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class GenerationJobTests(TestCase):
+    """Test cases for character generation through the background worker"""
+
+    def setUp(self):
+        # Staff users skip the token limit middleware checks
+        self.user = User.objects.create_user(username='author', password='testpassword123', is_staff=True)
+        self.client.force_login(self.user)
+
+    def test_generate_returns_job_and_worker_creates_character(self):
+        response = self.client.post(
+            reverse('characters:generate'),
+            {'name': 'Ada', 'concept': 'A mathematician', 'traits': 'curious'},
+            headers={'Accept': 'application/json'}
+        )
+
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+        self.assertEqual(self.client.get(status_url).json()['status'], 'pending')
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+
+        profile = json.dumps({'background_story': 'A long story', 'personality': {'core_traits': ['curious']}})
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            get_client.return_value.chat.completions.create.return_value = _completion(profile, 300)
+            for task_id in claim_tasks(10):
+                self.assertTrue(run_task(task_id))
+
+        status = self.client.get(status_url).json()
+        character = Character.objects.get(user=self.user)
+        self.assertEqual(status['status'], 'succeeded')
+        self.assertEqual(status['url'], reverse('characters:detail', args=[character.pk]))
+        self.assertEqual(character.creation_token_cost, 300)
+        self.assertFalse(BackgroundTask.objects.exists())
+
+    def test_failed_generation_is_reported(self):
+        job = CharacterGenerationJob.objects.create(user=self.user, name='Ada', concept='A mathematician')
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            get_client.return_value.chat.completions.create.return_value = _completion('no json here', 50)
+            run_generation_job(job.pk)
+
+        status = self.client.get(reverse('characters:generation_job_status', args=[job.pk])).json()
+        self.assertEqual(status['status'], 'failed')
+        self.assertTrue(status['error'])
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+
+    def test_jobs_in_progress_count_towards_limit_on_every_route(self):
+        """Queued generations fill the tier's allowance for the sync, async and batch views alike"""
+        for i in range(3):
+            CharacterGenerationJob.objects.create(user=self.user, name=f'Queued {i}', concept='Still generating')
+
+        with mock.patch('core.services.llm_client.get_client') as get_client, \
+                mock.patch('core.services.llm_client.get_async_client') as get_async_client:
+            for name in ('characters:generate', 'characters:generate_async'):
+                response = self.client.post(reverse(name), {'name': 'Ada', 'concept': 'A mathematician'})
+                self.assertRedirects(response, reverse('characters:list'), fetch_redirect_response=False)
+            response = self.client.post(
+                reverse('characters:generate_batch'),
+                data=json.dumps({'characters': [{'name': 'Ada', 'concept': 'A mathematician'}]}),
+                content_type='application/json'
+            )
+
+        self.assertFalse(response.json()['results'][0]['success'])
+        get_client.assert_not_called()
+        get_async_client.assert_not_called()
+        self.assertEqual(CharacterGenerationJob.objects.filter(user=self.user).count(), 3)
+        self.assertFalse(Character.objects.filter(user=self.user).exists())
+
+    def test_running_job_isnt_claimed_again(self):
+        job = CharacterGenerationJob.objects.create(
+            user=self.user, name='Ada', concept='A mathematician', status='running', started_at=timezone.now()
+        )
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            run_generation_job(job.pk)
+
+        get_client.return_value.chat.completions.create.assert_not_called()
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'running')
+
+    def test_job_abandoned_past_the_lease_is_run_again(self):
+        job = CharacterGenerationJob.objects.create(
+            user=self.user, name='Ada', concept='A mathematician', status='running',
+            started_at=timezone.now() - timedelta(hours=1)
+        )
+        profile = json.dumps({'background_story': 'A long story', 'personality': {'core_traits': ['curious']}})
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            get_client.return_value.chat.completions.create.return_value = _completion(profile, 300)
+            run_generation_job(job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'succeeded')
+        self.assertEqual(Character.objects.filter(user=self.user).count(), 1)
@@ -12,5 +12,8 @@ urlpatterns = [
     path('<int:pk>/archive/', views.character_archive, name='archive'),
     path('<int:pk>/unarchive/', views.character_unarchive, name='unarchive'),
     path('generate/', views.character_generate, name='generate'),
+    path('generate-async/', views.character_generate_async, name='generate_async'),
+    path('generate-batch/', views.character_generate_batch, name='generate_batch'),
+    path('generate/jobs/<int:job_id>/', views.generation_job_status, name='generation_job_status'),
     path('<int:pk>/add-memory/', views.add_character_memory, name='add_memory'),
 ]
\ No newline at end of file
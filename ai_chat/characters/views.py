@@ -1,4 +1,5 @@
 import json
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
@@ -8,11 +9,14 @@ from django.urls import reverse
 from django.conf import settings
 from django.db.models import Count
 
-from .models import Character, CharacterMemory, CharacterRelationship
+from .models import Character, CharacterMemory, CharacterRelationship, CharacterGenerationJob
 from .forms import CharacterForm, CharacterGenerationForm
-from core.services.openai_service import OpenAIService
+from .tasks import run_generation_job
+from core.services.openai_service import OpenAIService, AsyncOpenAIService, get_batch_generation_settings
 from core.services.pinecone_service import PineconeService
+from core.services.rate_limiter import RateLimited
 from token_management.models import UserTokenLimit
+from token_management.reservations import QuotaExceeded
 
 @login_required
 def character_list(request):
@@ -270,10 +274,7 @@ def character_generate(request):
     """View for AI-assisted character generation"""
     # Check if user has reached their character limit
     character_limit = get_character_limit(request.user)
-    current_count = Character.objects.filter(
-        user=request.user,
-        is_archived=False
-    ).count()
+    current_count = get_character_count(request.user)
     
     if current_count >= character_limit:
         messages.error(
@@ -297,6 +298,80 @@ def character_generate(request):
         # Create default token limit if it doesn't exist
         token_limit_obj = UserTokenLimit.objects.create(user=request.user)
     
+    if request.method == 'POST':
+        form = CharacterGenerationForm(request.POST)
+        if form.is_valid():
+            # Generation takes a full GPT-4 round trip, so it runs in the
+            # background worker; the page polls the job's status
+            job = CharacterGenerationJob.objects.create(
+                user=request.user,
+                name=form.cleaned_data['name'],
+                concept=form.cleaned_data['concept'],
+                traits=form.cleaned_data['traits'],
+                additional_info=form.cleaned_data['additional_info']
+            )
+            run_generation_job.delay(job.pk)
+            
+            if request.headers.get('x-requested-with') == 'XMLHttpRequest' or 'application/json' in request.headers.get('Accept', ''):
+                return JsonResponse({
+                    'job_id': job.pk,
+                    'status': job.status,
+                    'status_url': reverse('characters:generation_job_status', args=[job.pk]),
+                }, status=202)
+            
+            # Eager task queues (development) have already finished the job
+            job.refresh_from_db()
+            if job.status == 'succeeded':
+                messages.success(request, f"Character '{job.name}' was successfully generated!")
+                return redirect('characters:detail', pk=job.character_id)
+            if job.status == 'failed':
+                messages.error(request, job.error)
+            else:
+                messages.success(request, f"Character '{job.name}' is being generated and will appear here shortly.")
+                return redirect('characters:list')
+    else:
+        form = CharacterGenerationForm()
+        
+        # Check if there's a prompt in the query parameters
+        prompt = request.GET.get('prompt')
+        if prompt:
+            form.fields['concept'].initial = prompt
+    
+    context = {
+        'form': form,
+        'character_limit': character_limit,
+        'current_count': current_count,
+    }
+    
+    return render(request, 'pages/characters/character_generate.html', context)
+
+@login_required
+async def character_generate_async(request):
+    """Async variant of character_generate for ASGI deployments"""
+    user = await request.auser()
+    
+    # Check if user has reached their character limit
+    character_limit = get_character_limit(user)
+    current_count = await sync_to_async(get_character_count)(user)
+    
+    if current_count >= character_limit:
+        messages.error(
+            request, 
+            f"You have reached your limit of {character_limit} characters. "
+            f"Please upgrade your subscription or archive existing characters."
+        )
+        return redirect('characters:list')
+    
+    # Check if user has enough tokens
+    token_limit_obj, _ = await UserTokenLimit.objects.aget_or_create(user=user)
+    if token_limit_obj.current_usage >= token_limit_obj.monthly_limit:
+        messages.error(
+            request,
+            "You have reached your monthly token limit. "
+            "Please upgrade your subscription or purchase additional tokens."
+        )
+        return redirect('token_management:limit_reached')
+    
     if request.method == 'POST':
         form = CharacterGenerationForm(request.POST)
         if form.is_valid():
@@ -306,10 +381,10 @@ def character_generate(request):
             traits = form.cleaned_data['traits']
             additional_info = form.cleaned_data['additional_info']
             
-            # Generate character using OpenAI
+            # Generate character using OpenAI without blocking a worker thread
             try:
-                openai_service = OpenAIService(request.user)
-                result = openai_service.create_character(
+                openai_service = AsyncOpenAIService(user)
+                result = await openai_service.create_character(
                     name=name,
                     description=f"{concept}\n{additional_info if additional_info else ''}",
                     traits=traits
@@ -319,27 +394,14 @@ def character_generate(request):
                 character_data = result['character_data']
                 token_usage = result['token_usage']
                 
-                # Create new character
-                character = Character(
-                    user=request.user,
-                    name=name,
-                    description=concept,
-                    background_story=character_data.get('background_story', ''),
-                    personality_details=character_data.get('personality', {}),
-                    voice=character_data.get('voice', ''),
-                    traits=character_data.get('personality', {}).get('core_traits', []),
-                    creation_token_cost=token_usage['total_tokens']
-                )
-                character.save()
+                character = Character.from_generated_data(user, name, concept, character_data, token_usage['total_tokens'])
+                await character.asave()
                 
                 # Create vector embedding
                 try:
                     pinecone_service = PineconeService()
-                    vector_id = pinecone_service.store_character_embedding(character)
-                    
-                    # Save the vector ID
-                    character.vector_id = vector_id
-                    character.save(update_fields=['vector_id'])
+                    character.vector_id = await sync_to_async(pinecone_service.store_character_embedding)(character)
+                    await character.asave(update_fields=['vector_id'])
                 except Exception as e:
                     # Log the error but don't prevent character creation
                     print(f"Error creating vector embedding: {str(e)}")
@@ -368,7 +430,129 @@ def character_generate(request):
         'current_count': current_count,
     }
     
-    return render(request, 'pages/characters/character_generate.html', context)
+    # Context processors query the database, so render off the event loop
+    return await sync_to_async(render)(request, 'pages/characters/character_generate.html', context)
+
+@login_required
+def generation_job_status(request, job_id):
+    """API view reporting the progress of a character generation job"""
+    job = get_object_or_404(CharacterGenerationJob, pk=job_id, user=request.user)
+    
+    data = {
+        'job_id': job.pk,
+        'status': job.status,
+        'finished': job.is_finished,
+    }
+    if job.status == 'succeeded' and job.character_id:
+        data['character_id'] = job.character_id
+        data['url'] = reverse('characters:detail', args=[job.character_id])
+    if job.status == 'failed':
+        data['error'] = job.error
+    
+    return JsonResponse(data)
+
+@login_required
+def character_generate_batch(request):
+    """
+    API view for generating several characters in one request
+    Expects JSON {"characters": [{"name", "concept", "traits", "additional_info"}, ...]}
+    and reports success or failure per item, in the order given
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    
+    try:
+        items = json.loads(request.body).get('characters')
+    except (json.JSONDecodeError, AttributeError):
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    
+    max_size = get_batch_generation_settings()['MAX_SIZE']
+    if not isinstance(items, list) or not items:
+        return JsonResponse({'error': 'A list of characters is required'}, status=400)
+    if len(items) > max_size:
+        return JsonResponse({'error': f'At most {max_size} characters can be generated at once'}, status=400)
+    
+    # Check if user has enough tokens
+    token_limit_obj, _ = UserTokenLimit.objects.get_or_create(user=request.user)
+    if token_limit_obj.current_usage >= token_limit_obj.monthly_limit:
+        return JsonResponse({'error': 'You have reached your monthly token limit'}, status=403)
+    
+    # Items beyond the user's remaining character allowance are rejected
+    remaining = get_character_limit(request.user) - get_character_count(request.user)
+    
+    results = [None] * len(items)
+    specs, spec_indexes = [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {'index': index, 'success': False, 'error': 'Each character must be an object'}
+            continue
+        if isinstance(item.get('traits'), list):
+            item = {**item, 'traits': ', '.join(str(trait) for trait in item['traits'])}
+        form = CharacterGenerationForm(item)
+        if not form.is_valid():
+            results[index] = {'index': index, 'success': False, 'error': form.errors.get_json_data()}
+            continue
+        if len(specs) >= remaining:
+            results[index] = {'index': index, 'success': False, 'error': 'Character limit reached'}
+            continue
+        
+        additional_info = form.cleaned_data['additional_info']
+        specs.append({
+            'name': form.cleaned_data['name'],
+            'concept': form.cleaned_data['concept'],
+            'description': f"{form.cleaned_data['concept']}\n{additional_info if additional_info else ''}",
+            'traits': form.cleaned_data['traits'],
+        })
+        spec_indexes.append(index)
+    
+    # Generate concurrently; token usage for the whole batch is logged once
+    openai_service = OpenAIService(request.user)
+    try:
+        generated = openai_service.create_characters(specs)
+    except RateLimited as e:
+        response = JsonResponse({'error': str(e)}, status=429)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    except QuotaExceeded as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    
+    characters, character_indexes = [], []
+    for index, spec, result in zip(spec_indexes, specs, generated):
+        error = result.get('error') or result['character_data'].get('error')
+        if error:
+            results[index] = {'index': index, 'name': spec['name'], 'success': False, 'error': error}
+            continue
+        characters.append(Character.from_generated_data(
+            request.user, spec['name'], spec['concept'], result['character_data'], result['token_usage']['total_tokens']
+        ))
+        character_indexes.append(index)
+    
+    Character.objects.bulk_create(characters)
+    
+    # Create vector embeddings in one batch
+    try:
+        vector_ids = PineconeService().store_character_embeddings(characters)
+        for character, vector_id in zip(characters, vector_ids):
+            character.vector_id = vector_id
+        Character.objects.bulk_update(characters, ['vector_id'])
+    except Exception as e:
+        # Log the error but don't prevent character creation
+        print(f"Error creating vector embeddings: {str(e)}")
+    
+    for index, character in zip(character_indexes, characters):
+        results[index] = {
+            'index': index,
+            'name': character.name,
+            'success': True,
+            'character_id': character.pk,
+            'url': reverse('characters:detail', args=[character.pk]),
+        }
+    
+    return JsonResponse({
+        'results': results,
+        'created': len(characters),
+        'tokens_used': sum(result['token_usage']['total_tokens'] for result in generated if 'token_usage' in result),
+    })
 
 @login_required
 def add_character_memory(request, pk):
@@ -418,4 +602,14 @@ def get_character_limit(user):
         'enterprise': 999999,  # effectively unlimited
     }
     
-    return tier_limits.get(user.subscription_tier, 3)
\ No newline at end of file
+    return tier_limits.get(user.subscription_tier, 3)
+
+def get_character_count(user):
+    """Characters counting towards the user's limit: active ones and those still being generated"""
+    return Character.objects.filter(
+        user=user,
+        is_archived=False
+    ).count() + CharacterGenerationJob.objects.filter(
+        user=user,
+        status__in=('pending', 'running')
+    ).count()
\ No newline at end of file
@@ -0,0 +1,91 @@
+import threading
+
+from django.db.models import Sum
+
+from core.services.context_packer import get_chat_context_settings
+from core.services.openai_service import OpenAIService
+from core.services.task_queue import enqueue, task
+from .models import Conversation, Message, ConversationSummary
+
+# Conversations with a compaction in progress in this process
+_in_progress = set()
+_in_progress_lock = threading.Lock()
+
+
+def maybe_compact_conversation(conversation):
+    """
+    Start compaction if the unsummarized tail of a conversation has grown too long
+    Compaction is queued as a background task so the chat turn isn't held up.
+    Returns True if compaction was queued (or run inline).
+    """
+    conf = get_chat_context_settings()
+    tail = _unsummarized_messages(conversation)
+    tail_tokens = tail.aggregate(total=Sum('token_count'))['total'] or 0
+    if tail_tokens <= conf['COMPACTION_THRESHOLD']:
+        return False
+
+    if conf['COMPACT_IN_BACKGROUND']:
+        enqueue(compact_conversation, args=(conversation.pk,), unique_key=f"compact-conversation:{conversation.pk}")
+    else:
+        compact_conversation(conversation.pk)
+    return True
+
+
+@task
+def compact_conversation(conversation_id):
+    """
+    Fold the older part of a conversation's unsummarized tail into its rolling summary
+    The newest COMPACTION_KEEP_RECENT tokens of messages stay verbatim; the rest,
+    together with the previous rolling summary, become a new rolling
+    ConversationSummary. Returns the new summary, or None if there was nothing to do.
+    """
+    with _in_progress_lock:
+        if conversation_id in _in_progress:
+            return None
+        _in_progress.add(conversation_id)
+
+    try:
+        conversation = Conversation.objects.select_related('character', 'user').get(pk=conversation_id)
+        conf = get_chat_context_settings()
+        previous = conversation.get_rolling_summary()
+        tail = list(_unsummarized_messages(conversation, previous).order_by('timestamp'))
+
+        # Keep the most recent messages out of the summary
+        kept_tokens = 0
+        split = len(tail)
+        while split > 0 and kept_tokens + tail[split - 1].token_count <= conf['COMPACTION_KEEP_RECENT']:
+            split -= 1
+            kept_tokens += tail[split].token_count
+        span = tail[:split]
+        if not span:
+            return None
+
+        result = OpenAIService(conversation.user).summarize_conversation(
+            conversation=conversation,
+            messages=span,
+            previous_summary=previous.content if previous else None
+        )
+
+        summary = ConversationSummary.objects.create(
+            conversation=conversation,
+            content=result['summary'],
+            start_message=previous.start_message if previous else span[0],
+            end_message=span[-1],
+            token_count=result['token_usage']['total_tokens'],
+            is_rolling=True
+        )
+        conversation.add_tokens(result['token_usage']['total_tokens'])
+        return summary
+    finally:
+        with _in_progress_lock:
+            _in_progress.discard(conversation_id)
+
+
+def _unsummarized_messages(conversation, summary=None):
+    """Messages after the rolling summary's end (all of them if there is none)"""
+    if summary is None:
+        summary = conversation.get_rolling_summary()
+    messages = Message.objects.filter(conversation=conversation)
+    if summary and summary.end_message:
+        messages = messages.filter(timestamp__gt=summary.end_message.timestamp)
+    return messages
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('conversations', '0003_message_token_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='is_rolling',
+            field=models.BooleanField(default=False, help_text='Created by automatic compaction'),
+        ),
+    ]
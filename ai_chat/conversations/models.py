@@ -1,7 +1,10 @@
 from django.db import models
+from django.db.models import Exists, Q, Subquery
 from django.conf import settings
 from django.utils import timezone
 from characters.models import Character
+from core.services import write_behind
+from core.services.token_counter import count_tokens
 
 class Conversation(models.Model):
     """Model for conversations with characters"""
@@ -33,12 +36,38 @@ class Conversation(models.Model):
     def add_tokens(self, amount):
         """Add tokens to the conversation total"""
         self.total_tokens += amount
-        self.save(update_fields=['total_tokens'])
+        write_behind.increment(self, total_tokens=amount)
     
     def get_recent_messages(self, limit=10):
         """Get the most recent messages in this conversation"""
         return self.messages.order_by('-timestamp')[:limit]
     
+    def get_context_messages(self, exclude=None):
+        """
+        Get the newest-first candidate messages for a chat prompt
+        The context packer takes as many of these as fit its token budget.
+        """
+        from core.services.context_packer import get_chat_context_settings
+        
+        messages = self.messages.only('id', 'conversation_id', 'sender', 'content', 'token_count')
+        if exclude is not None:
+            messages = messages.exclude(pk=exclude.pk)
+        
+        # Messages covered by the rolling summary are replaced by it in the prompt.
+        # Done as a subquery so the queryset stays lazy (and usable from async views).
+        covered_until = ConversationSummary.objects.filter(
+            conversation=self, is_rolling=True, end_message__isnull=False
+        ).order_by('-created_at').values('end_message__timestamp')[:1]
+        messages = messages.filter(
+            Q(timestamp__gt=Subquery(covered_until)) | ~Exists(covered_until)
+        )
+        
+        return messages.order_by('-timestamp')[:get_chat_context_settings()['MAX_HISTORY_MESSAGES']]
+    
+    def get_rolling_summary(self):
+        """Get the latest automatic summary, which covers everything up to its end_message"""
+        return self.summaries.filter(is_rolling=True).select_related('end_message').order_by('-created_at').first()
+    
     def mark_as_read(self):
         """Mark all unread messages in the conversation as read"""
         self.messages.filter(is_read=False, sender='character').update(is_read=True)
@@ -63,6 +92,7 @@ class Message(models.Model):
     # Token usage tracking
     prompt_tokens = models.IntegerField(default=0, help_text="Tokens used in the prompt")
     completion_tokens = models.IntegerField(default=0, help_text="Tokens used in the completion")
+    token_count = models.IntegerField(default=0, help_text="Tokens in the message content, counted once on save")
     
     # Timestamps
     timestamp = models.DateTimeField(default=timezone.now)
@@ -70,12 +100,24 @@ class Message(models.Model):
     # Status
     is_read = models.BooleanField(default=False)
     
+    # Client-supplied key that makes retried sends of a user message idempotent
+    idempotency_key = models.CharField(max_length=100, null=True, blank=True)
+    # The user message a character reply answers
+    reply_to = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replies')
+    
     class Meta:
         ordering = ['timestamp']
+        unique_together = ['conversation', 'idempotency_key']
     
     def __str__(self):
         return f"{self.sender} at {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
     
+    def save(self, *args, **kwargs):
+        # Count tokens once so prompt packing never has to re-tokenize
+        if not self.token_count and self.content:
+            self.token_count = count_tokens(self.content)
+        super().save(*args, **kwargs)
+    
     @property
     def total_tokens(self):
         """Calculate total tokens used by this message"""
@@ -93,6 +135,9 @@ class ConversationSummary(models.Model):
     # Token usage tracking
     token_count = models.IntegerField(default=0, help_text="Tokens in this summary")
     
+    # Automatic rolling summaries cover the whole conversation up to end_message
+    is_rolling = models.BooleanField(default=False, help_text="Created by automatic compaction")
+    
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     
@@ -0,0 +1,41 @@
+from django.utils.dateparse import parse_datetime
+
+from characters.models import Character, CharacterMemory
+from core.services.pinecone_service import PineconeService
+from core.services.task_queue import task
+from .compaction import compact_conversation  # noqa: F401 (a task; registered where it is defined)
+from .models import Conversation
+
+
+@task
+def create_memory(character_id, content):
+    """Turn a substantial user message into a character memory"""
+    memory = CharacterMemory.objects.create(
+        character_id=character_id,
+        content=content,
+        importance_score=0.5,  # Default importance
+        source='conversation'
+    )
+    embed_memory.delay(memory.pk)
+
+
+@task
+def embed_memory(memory_id):
+    """Store a memory's vector embedding and remember its vector ID"""
+    memory = CharacterMemory.objects.get(pk=memory_id)
+    memory.vector_id = PineconeService().store_memory_embedding(memory)
+    memory.save(update_fields=['vector_id'])
+
+
+@task
+def record_turn_stats(conversation_id, tokens_used, interaction_at):
+    """Update the conversation's token total and the character's last interaction time"""
+    conversation = Conversation.objects.get(pk=conversation_id)
+    conversation.add_tokens(tokens_used)
+    
+    # Turns can be processed out of order; never move last_interaction backwards
+    interaction_at = parse_datetime(interaction_at)
+    Character.objects.filter(pk=conversation.character_id).exclude(
+        last_interaction__gte=interaction_at
+    ).update(last_interaction=interaction_at)
+
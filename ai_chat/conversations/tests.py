@@ -1,3 +1,456 @@
-from django.test import TestCase
+import json
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+
+from characters.models import Character, CharacterMemory
+from core.models import BackgroundTask, RateLimitBucket
+from core.services.rate_limiter import check_rate_limit
+from core.services.task_queue import claim_tasks, run_task
+from token_management.models import UserTokenLimit
+from .compaction import maybe_compact_conversation
+from .models import Conversation, Message
+
+User = get_user_model()
+
+
+def _chunk(content=None, usage=None):
+    """Build a fake streaming chunk shaped like the OpenAI SDK's"""
+    choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+def _reply(body):
+    """A 42 token completion saying 'Indeed.', streamed if body asks for a stream"""
+    usage = SimpleNamespace(prompt_tokens=40, completion_tokens=2, total_tokens=42)
+    if body.get('stream'):
+        return FakeStream([_chunk('Indeed.'), _chunk(usage=usage)])
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='Indeed.'))], usage=usage)
+
+
+def _send(client, conversation, idempotency_key, **body):
+    return client.post(
+        reverse('conversations:send_message', args=[conversation.pk]),
+        data=json.dumps({'message': 'Hello there', **body}),
+        content_type='application/json',
+        headers={'Idempotency-Key': idempotency_key}
+    )
+
+
+def _reply_text(response):
+    """The reply in a send_message response, JSON or server-sent events"""
+    if not response.streaming:
+        return response.json()['message']
+    events = b''.join(response.streaming_content).decode().split('\n\n')
+    return json.loads([event for event in events if event][-1][len('data: '):])['message']
+
+
+class FakeStream:
+    """Minimal stand-in for an OpenAI streaming response"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class SendMessageStreamingTests(TestCase):
+    """Test cases for the streaming mode of send_message"""
+
+    def setUp(self):
+        # Staff users skip the token limit middleware checks
+        self.user = User.objects.create_user(username='streamer', password='testpassword123', is_staff=True)
+        self.character = Character.objects.create(user=self.user, name='Ada', description='A mathematician')
+        self.conversation = Conversation.objects.create(user=self.user, character=self.character)
+        self.client.force_login(self.user)
+        self.url = reverse('conversations:send_message', args=[self.conversation.pk])
+
+    def _post_streaming(self, chunks):
+        stream = FakeStream(chunks)
+        patcher = mock.patch('core.services.llm_client.get_client')
+        fake_client = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        fake_client.chat.completions.create.return_value = stream
+        response = self.client.post(
+            self.url,
+            data=json.dumps({'message': 'Hello there', 'stream': True}),
+            content_type='application/json'
+        )
+        return response, stream
+
+    def test_stream_sends_deltas_and_persists_reply(self):
+        """Deltas are sent as events and the full reply is stored with its usage"""
+        usage = SimpleNamespace(prompt_tokens=20, completion_tokens=3, total_tokens=23)
+        response, stream = self._post_streaming([_chunk('Hel'), _chunk('lo!'), _chunk(usage=usage)])
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = [
+            json.loads(line[len('data: '):])
+            for line in b''.join(response.streaming_content).decode().split('\n\n') if line
+        ]
+        self.assertEqual([e['content'] for e in events if e['type'] == 'delta'], ['Hel', 'lo!'])
+        self.assertEqual(events[-1]['type'], 'done')
+
+        reply = Message.objects.get(conversation=self.conversation, sender='character')
+        self.assertEqual(reply.content, 'Hello!')
+        self.assertEqual(reply.total_tokens, 23)
+        self.assertTrue(stream.closed)
+        self.assertEqual(UserTokenLimit.objects.get(user=self.user).current_usage, 23)
+
+    def test_client_disconnect_keeps_accounting(self):
+        """Closing the response mid-stream still stores the partial reply and logs usage"""
+        response, stream = self._post_streaming([_chunk('Hel'), _chunk('lo!'), _chunk('More')])
+
+        content = iter(response.streaming_content)
+        next(content)
+        response.close()  # What the server does when the client goes away
+
+        reply = Message.objects.get(conversation=self.conversation, sender='character')
+        self.assertEqual(reply.content, 'Hel')
+        self.assertTrue(reply.metadata.get('partial'))
+        self.assertTrue(stream.closed)
+        self.assertGreater(UserTokenLimit.objects.get(user=self.user).current_usage, 0)
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class SendMessageAsyncTests(TestCase):
+    """Test cases for the async send_message view"""
+
+    def setUp(self):
+        # Staff users skip the token limit middleware checks
+        self.user = User.objects.create_user(username='asyncer', password='testpassword123', is_staff=True)
+        self.character = Character.objects.create(user=self.user, name='Ada', description='A mathematician')
+        self.conversation = Conversation.objects.create(user=self.user, character=self.character)
+        self.client.force_login(self.user)
+
+    def test_async_reply_is_stored_and_charged(self):
+        """The async view stores the reply and charges the user once"""
+        completion = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='Greetings.'))],
+            usage=SimpleNamespace(prompt_tokens=30, completion_tokens=5, total_tokens=35),
+        )
+        with mock.patch('core.services.llm_client.get_async_client') as get_async_client:
+            get_async_client.return_value.chat.completions.create = mock.AsyncMock(return_value=completion)
+            response = self.client.post(
+                reverse('conversations:send_message_async', args=[self.conversation.pk]),
+                data=json.dumps({'message': 'Hello'}),
+                content_type='application/json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['message'], 'Greetings.')
+        reply = Message.objects.get(conversation=self.conversation, sender='character')
+        self.assertEqual(reply.total_tokens, 35)
+        self.assertEqual(UserTokenLimit.objects.get(user=self.user).current_usage, 35)
+
+    def test_retried_key_replays_stored_reply(self):
+        """The async view stores keyed messages like send_message and replays their reply"""
+        completion = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='Greetings.'))],
+            usage=SimpleNamespace(prompt_tokens=30, completion_tokens=5, total_tokens=35),
+        )
+        with mock.patch('core.services.llm_client.get_async_client') as get_async_client:
+            create = get_async_client.return_value.chat.completions.create = mock.AsyncMock(return_value=completion)
+            responses = [
+                self.client.post(
+                    reverse('conversations:send_message_async', args=[self.conversation.pk]),
+                    data=json.dumps({'message': 'Hello'}),
+                    content_type='application/json',
+                    headers={'Idempotency-Key': 'abc-123'}
+                )
+                for _ in range(2)
+            ]
+
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual([r.json()['replayed'] for r in responses], [False, True])
+        self.assertEqual(responses[1].json()['message'], 'Greetings.')
+        self.assertEqual(self.conversation.messages.filter(sender='user').count(), 1)
+        self.assertEqual(self.conversation.messages.get(sender='character').reply_to.idempotency_key, 'abc-123')
+
+
+class ContextPackingTests(TestCase):
+    """Test cases for token-budgeted prompt packing"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='packer', password='testpassword123')
+        self.character = Character.objects.create(user=self.user, name='Ada', description='A mathematician')
+        self.conversation = Conversation.objects.create(user=self.user, character=self.character)
+
+    def test_token_count_is_stored_on_save(self):
+        """Messages count their tokens once when saved"""
+        msg = Message.objects.create(conversation=self.conversation, content='one two three four', sender='user')
+        self.assertGreater(msg.token_count, 0)
+
+    def test_packs_most_recent_messages_within_budget(self):
+        """Older messages are dropped once the budget is full, newest are kept in order"""
+        from core.services.context_packer import pack_chat_context
+
+        for i in range(20):
+            Message.objects.create(conversation=self.conversation, content=f'message {i} ' + 'word ' * 40, sender='user')
+
+        packed = pack_chat_context(
+            system_prompt='You are Ada.',
+            user_message='Hi',
+            history=self.conversation.get_context_messages(),
+            budget=300,
+        )
+
+        history = [m['content'] for m in packed['messages'][1:-1]]
+        self.assertLessEqual(packed['prompt_tokens'], 300)
+        self.assertTrue(0 < len(history) < 20)
+        self.assertTrue(history[-1].startswith('message 19 '))
+        self.assertEqual(packed['messages'][-1], {'role': 'user', 'content': 'Hi'})
+
+
+@override_settings(CHAT_CONTEXT={
+    'COMPACTION_THRESHOLD': 200, 'COMPACTION_KEEP_RECENT': 100, 'COMPACT_IN_BACKGROUND': False,
+})
+class CompactionTests(TestCase):
+    """Test cases for rolling conversation compaction"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='compactor', password='testpassword123')
+        self.character = Character.objects.create(user=self.user, name='Ada', description='A mathematician')
+        self.conversation = Conversation.objects.create(user=self.user, character=self.character)
+        for i in range(10):
+            Message.objects.create(conversation=self.conversation, content=f'message {i} ' + 'word ' * 30, sender='user')
+
+    def _summarize(self, summary_text):
+        return mock.patch(
+            'core.services.openai_service.OpenAIService.summarize_conversation',
+            return_value={'summary': summary_text, 'token_usage': {'total_tokens': 60}}
+        )
+
+    def test_long_tail_is_folded_into_rolling_summary(self):
+        """Older messages are summarized and dropped from the prompt history"""
+        with self._summarize('They talked a lot.') as summarize:
+            self.assertTrue(maybe_compact_conversation(self.conversation))
+
+        summary = self.conversation.get_rolling_summary()
+        self.assertEqual(summary.content, 'They talked a lot.')
+        self.assertIsNone(summarize.call_args.kwargs['previous_summary'])
+
+        history = list(self.conversation.get_context_messages())
+        self.assertTrue(0 < len(history) < 10)
+        self.assertTrue(all(m.timestamp > summary.end_message.timestamp for m in history))
+        self.assertLessEqual(sum(m.token_count for m in history), 100)
+
+    def test_next_compaction_builds_on_previous_summary(self):
+        """A later compaction folds the previous rolling summary into the new one"""
+        with self._summarize('First part.'):
+            maybe_compact_conversation(self.conversation)
+        for i in range(10):
+            Message.objects.create(conversation=self.conversation, content=f'later {i} ' + 'word ' * 30, sender='user')
+
+        with self._summarize('Everything so far.') as summarize:
+            maybe_compact_conversation(self.conversation)
+
+        self.assertEqual(summarize.call_args.kwargs['previous_summary'], 'First part.')
+        self.assertEqual(self.conversation.get_rolling_summary().content, 'Everything so far.')
+
+    def test_short_tail_is_left_alone(self):
+        """Nothing happens while the unsummarized tail is under the threshold"""
+        conversation = Conversation.objects.create(user=self.user, character=self.character)
+        Message.objects.create(conversation=conversation, content='short', sender='user')
+
+        self.assertFalse(maybe_compact_conversation(conversation))
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class TurnTasksTests(TestCase):
+    """Test cases for the bookkeeping queued after a chat turn"""
+
+    def setUp(self):
+        # Staff users skip the token limit middleware checks
+        self.user = User.objects.create_user(username='queuer', password='testpassword123', is_staff=True)
+        self.character = Character.objects.create(user=self.user, name='Ada', description='A mathematician')
+        self.conversation = Conversation.objects.create(user=self.user, character=self.character)
+        self.client.force_login(self.user)
+
+    def test_reply_returns_before_bookkeeping_runs(self):
+        """Memory creation and stats are queued, then applied by the worker"""
+        completion = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='Indeed.'))],
+            usage=SimpleNamespace(prompt_tokens=40, completion_tokens=2, total_tokens=42),
+        )
+        message = 'I have been thinking about the analytical engine and what it could compute.'
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            get_client.return_value.chat.completions.create.return_value = completion
+            response = self.client.post(
+                reverse('conversations:send_message', args=[self.conversation.pk]),
+                data=json.dumps({'message': message}),
+                content_type='application/json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(CharacterMemory.objects.filter(character=self.character).exists())
+        self.assertEqual(
+            sorted(BackgroundTask.objects.values_list('name', flat=True)),
+            ['conversations.tasks.create_memory', 'conversations.tasks.record_turn_stats']
+        )
+
+        # Memory creation queues the embedding, so run the queue until it drains
+        while BackgroundTask.objects.exists():
+            for task_id in claim_tasks(10):
+                self.assertTrue(run_task(task_id))
+
+        memory = CharacterMemory.objects.get(character=self.character)
+        self.assertEqual(memory.content, message)
+        self.assertTrue(memory.vector_id)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.total_tokens, 42)
+        self.character.refresh_from_db()
+        self.assertIsNotNone(self.character.last_interaction)
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class IdempotentSendTests(TestCase):
+    """Test cases for retried and duplicated send_message requests"""
+
+    def setUp(self):
+        # Staff users skip the token limit middleware checks
+        self.user = User.objects.create_user(username='retrier', password='testpassword123', is_staff=True)
+        self.character = Character.objects.create(user=self.user, name='Ada', description='A mathematician')
+        self.conversation = Conversation.objects.create(user=self.user, character=self.character)
+        self.client.force_login(self.user)
+        self.completion = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='Indeed.'))],
+            usage=SimpleNamespace(prompt_tokens=40, completion_tokens=2, total_tokens=42),
+        )
+
+    def send(self, **headers):
+        return self.client.post(
+            reverse('conversations:send_message', args=[self.conversation.pk]),
+            data=json.dumps({'message': 'Hello there'}),
+            content_type='application/json',
+            headers=headers
+        )
+
+    def test_retried_key_replays_stored_reply(self):
+        """A repeated Idempotency-Key gets the stored reply without another LLM call"""
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            get_client.return_value.chat.completions.create.return_value = self.completion
+            first = self.send(**{'Idempotency-Key': 'abc-123'})
+            second = self.send(**{'Idempotency-Key': 'abc-123'})
+
+        self.assertEqual(get_client.return_value.chat.completions.create.call_count, 1)
+        self.assertEqual(first.json()['message'], 'Indeed.')
+        self.assertFalse(first.json()['replayed'])
+        self.assertEqual(second.json()['message'], 'Indeed.')
+        self.assertTrue(second.json()['replayed'])
+        self.assertEqual(self.conversation.messages.filter(sender='user').count(), 1)
+        reply = self.conversation.messages.get(sender='character')
+        self.assertEqual(reply.reply_to.idempotency_key, 'abc-123')
+
+    def test_unanswered_key_in_flight_conflicts(self):
+        """A retry while the first attempt is still being answered gets a 409"""
+        Message.objects.create(
+            conversation=self.conversation, content='Hello there', sender='user', idempotency_key='abc-123'
+        )
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            response = self.send(**{'Idempotency-Key': 'abc-123'})
+
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('Retry-After', response)
+        get_client.assert_not_called()
+
+
+@override_settings(LLM_RATE_LIMIT={'TIERS': {'free': {'CAPACITY': 1, 'PER_MINUTE': 1}}})
+class SendMessageRateLimitTests(TestCase):
+    """Test cases for throttled send_message requests"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='hasty', password='testpassword123')
+        self.character = Character.objects.create(user=self.user, name='Ada', description='A mathematician')
+        self.conversation = Conversation.objects.create(user=self.user, character=self.character)
+        self.client.force_login(self.user)
+
+    def test_throttled_request_gets_429(self):
+        """Past the limit the client is told when to retry, and the message isn't kept"""
+        check_rate_limit(self.user, 'character_chat')
+
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            for body in ({'message': 'Hello there'}, {'message': 'Hello there', 'stream': True}):
+                response = self.client.post(
+                    reverse('conversations:send_message', args=[self.conversation.pk]),
+                    data=json.dumps(body),
+                    content_type='application/json',
+                    headers={'Idempotency-Key': 'abc-123'}
+                )
+                self.assertEqual(response.status_code, 429)
+                self.assertEqual(response['Retry-After'], '60')
+
+        get_client.assert_not_called()
+        self.assertFalse(self.conversation.messages.exists())
+
+    @override_settings(USAGE_LEDGER={'BUFFERED': False})
+    def test_retry_with_same_key_succeeds_once_refilled(self):
+        """A throttled message isn't held as in flight, so its retry is answered on both paths"""
+        for key, body in (('json-1', {}), ('sse-1', {'stream': True})):
+            RateLimitBucket.objects.all().delete()
+            check_rate_limit(self.user, 'character_chat')
+            with mock.patch('core.services.llm_client.get_client') as get_client:
+                self.assertEqual(_send(self.client, self.conversation, key, **body).status_code, 429)
+                RateLimitBucket.objects.all().delete()
+                get_client.return_value.chat.completions.create.return_value = _reply(body)
+                response = _send(self.client, self.conversation, key, **body)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(_reply_text(response), 'Indeed.')
+
+            self.assertEqual(self.conversation.messages.filter(sender='user', idempotency_key=key).count(), 1)
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class SendMessageQuotaTests(TestCase):
+    """Test cases for send_message when the user's quota can't cover the call"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='frugal', password='testpassword123')
+        UserTokenLimit.objects.filter(user=self.user).update(monthly_limit=10)
+        self.character = Character.objects.create(user=self.user, name='Ada', description='A mathematician')
+        self.conversation = Conversation.objects.create(user=self.user, character=self.character)
+        self.client.force_login(self.user)
+
+    def send(self, **body):
+        return self.client.post(
+            reverse('conversations:send_message', args=[self.conversation.pk]),
+            data=json.dumps({'message': 'Hello there', **body}),
+            content_type='application/json',
+            headers={'Idempotency-Key': 'abc-123'}
+        )
+
+    def test_quota_exceeded_is_a_403_on_both_paths(self):
+        """Neither path starts a response or keeps the message when the quota is used up"""
+        with mock.patch('core.services.llm_client.get_client') as get_client:
+            self.assertEqual(self.send().status_code, 403)
+            self.assertEqual(self.send(stream=True).status_code, 403)
+
+        get_client.assert_not_called()
+        self.assertFalse(self.conversation.messages.exists())
+        self.assertEqual(UserTokenLimit.objects.get(user=self.user).reserved_tokens, 0)
+
+    def test_retry_with_same_key_succeeds_once_topped_up(self):
+        """A refused message isn't held as in flight, so its retry is answered on both paths"""
+        for key, body in (('json-1', {}), ('sse-1', {'stream': True})):
+            UserTokenLimit.objects.filter(user=self.user).update(monthly_limit=10)
+            with mock.patch('core.services.llm_client.get_client') as get_client:
+                self.assertEqual(_send(self.client, self.conversation, key, **body).status_code, 403)
+                UserTokenLimit.objects.filter(user=self.user).update(monthly_limit=50000)
+                get_client.return_value.chat.completions.create.return_value = _reply(body)
+                response = _send(self.client, self.conversation, key, **body)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(_reply_text(response), 'Indeed.')
+
+            self.assertEqual(self.conversation.messages.filter(sender='user', idempotency_key=key).count(), 1)
+
+        token_limit = UserTokenLimit.objects.get(user=self.user)
+        self.assertEqual((token_limit.current_usage, token_limit.reserved_tokens), (84, 0))
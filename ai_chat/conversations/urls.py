@@ -12,9 +12,11 @@ urlpatterns = [
     path('<int:pk>/unarchive/', views.conversation_unarchive, name='unarchive'),
     path('<int:pk>/delete/', views.conversation_delete, name='delete'),
     path('<int:pk>/create-summary/', views.create_summary, name='create_summary'),
+    path('<int:pk>/create-summary-async/', views.create_summary_async, name='create_summary_async'),
 
      # Additional URLs needed based on template references
     path('<int:pk>/send/', views.send_message, name='send_message'),  # Add this for AJAX message sending
+    path('<int:pk>/send-async/', views.send_message_async, name='send_message_async'),  # Async variant for ASGI
     path('<int:conversation_id>/toggle-favorite/', views.toggle_favorite, name='toggle_favorite'),  # Add for favorite functionality
     path('<int:conversation_id>/export/', views.conversation_export, name='export'),  # Add for export functionality
 ]
\ No newline at end of file
@@ -1,16 +1,31 @@
-from django.shortcuts import render, redirect, get_object_or_404
+from asgiref.sync import sync_to_async
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.db import IntegrityError, transaction
 from django.db.models import Count, Prefetch
 
 from .models import Conversation, Message, ConversationSummary
-from characters.models import Character, CharacterMemory
-from core.services.openai_service import OpenAIService
-from core.services.pinecone_service import PineconeService
+from .compaction import maybe_compact_conversation
+from .tasks import create_memory, record_turn_stats
+from characters.models import Character
+from core.services.openai_service import OpenAIService, AsyncOpenAIService
+from core.services.rate_limiter import RateLimited
+from core.services.single_flight import SingleFlight
+from token_management.reservations import QuotaExceeded
+from datetime import timedelta
+import hashlib
 import json
 
+# A keyed message with no reply yet is assumed to still be in progress for
+# this long; after that a retry with the same key generates the reply again
+IDEMPOTENCY_IN_FLIGHT_SECONDS = 120
+
+# Coalesces identical send_message requests running at the same time
+_send_flight = SingleFlight()
+
 
 @login_required
 def conversation_list(request):
@@ -74,7 +89,7 @@ def conversation_detail(request, pk):
         
         if user_message:
             # Create user message
-            Message.objects.create(
+            user_msg = Message.objects.create(
                 conversation=conversation,
                 content=user_message,
                 sender='user',
@@ -83,44 +98,19 @@ def conversation_detail(request, pk):
             
             # Generate character response
             try:
-                # Get conversation history for context
-                message_history = messages.order_by('-timestamp')[:10]  # Last 10 messages for context
-                message_history = reversed(list(message_history))  # Put in chronological order
-                
                 # Create OpenAI service
                 openai_service = OpenAIService(request.user)
                 
-                # Generate response
+                # Generate response; history is packed to the prompt token budget
                 response = openai_service.generate_character_response(
                     character=character,
-                    conversation_history=message_history,
-                    user_message=user_message
-                )
-                
-                # Create character message
-                Message.objects.create(
-                    conversation=conversation,
-                    content=response['response'],
-                    sender='character',
-                    prompt_tokens=response['token_usage']['prompt_tokens'],
-                    completion_tokens=response['token_usage']['completion_tokens'],
-                    is_read=True  # Mark as read since user is currently viewing
+                    conversation_history=conversation.get_context_messages(exclude=user_msg),
+                    user_message=user_message,
+                    conversation=conversation
                 )
                 
-                # Update conversation's total tokens
-                conversation.add_tokens(response['token_usage']['total_tokens'])
-                
-                # Update character's last interaction timestamp
-                character.last_interaction = timezone.now()
-                character.save(update_fields=['last_interaction'])
-                
-                # Check if we should create a memory from this interaction
-                if len(user_message) > 50:  # Only create memories from substantial messages
-                    try:
-                        create_memory_from_message(character, user_message)
-                    except Exception as e:
-                        # Log error but don't interrupt the conversation flow
-                        print(f"Error creating memory: {str(e)}")
+                # Store the reply; the rest of the bookkeeping is queued
+                _store_character_reply(conversation, character, user_message, response)
                 
                 messages.success(request, "Message sent successfully!")
             except Exception as e:
@@ -317,29 +307,64 @@ def create_summary(request, pk):
     
     return redirect('conversations:detail', pk=conversation.pk)
 
-def create_memory_from_message(character, message_content):
-    """Helper function to create a memory from a message"""
-    # Create memory
-    memory = CharacterMemory.objects.create(
-        character=character,
-        content=message_content,
-        importance_score=0.5,  # Default importance
-        source='conversation'
+@login_required
+async def create_summary_async(request, pk):
+    """Async variant of create_summary for ASGI deployments"""
+    user = await request.auser()
+    conversation = await aget_object_or_404(
+        Conversation.objects.select_related('character'), pk=pk, user=user
     )
     
-    # Create vector embedding
-    try:
-        pinecone_service = PineconeService()
-        vector_id = pinecone_service.store_memory_embedding(memory)
+    if request.method == 'POST':
+        # Get message range to summarize
+        start_id = request.POST.get('start_message_id')
+        end_id = request.POST.get('end_message_id')
         
-        # Save the vector ID
-        memory.vector_id = vector_id
-        memory.save(update_fields=['vector_id'])
-    except Exception as e:
-        # Log error but don't fail memory creation
-        print(f"Error creating memory embedding: {str(e)}")
+        if start_id and end_id:
+            try:
+                # Get messages to summarize
+                start_message = await aget_object_or_404(Message, pk=start_id, conversation=conversation)
+                end_message = await aget_object_or_404(Message, pk=end_id, conversation=conversation)
+                
+                # Ensure end message comes after start message
+                if end_message.timestamp < start_message.timestamp:
+                    start_message, end_message = end_message, start_message
+                
+                # Get all messages in range
+                messages_to_summarize = [
+                    msg async for msg in Message.objects.filter(
+                        conversation=conversation,
+                        timestamp__gte=start_message.timestamp,
+                        timestamp__lte=end_message.timestamp
+                    ).order_by('timestamp')
+                ]
+                
+                # Generate summary
+                openai_service = AsyncOpenAIService(user)
+                result = await openai_service.summarize_conversation(
+                    conversation=conversation,
+                    messages=messages_to_summarize
+                )
+                
+                # Create summary
+                await ConversationSummary.objects.acreate(
+                    conversation=conversation,
+                    content=result['summary'],
+                    start_message=start_message,
+                    end_message=end_message,
+                    token_count=result['token_usage']['total_tokens']
+                )
+                
+                # Update conversation's total tokens
+                await sync_to_async(conversation.add_tokens)(result['token_usage']['total_tokens'])
+                
+                messages.success(request, "Conversation segment summarized successfully!")
+            except Exception as e:
+                messages.error(request, f"Error creating summary: {str(e)}")
+        else:
+            messages.error(request, "Please select a valid message range to summarize.")
     
-    return memory
+    return redirect('conversations:detail', pk=conversation.pk)
 
 @login_required
 def conversation_list(request):
@@ -403,62 +428,279 @@ def send_message(request, pk):
         if not user_message:
             return JsonResponse({'error': 'Message content is required'}, status=400)
         
-        # Create user message
-        user_msg = Message.objects.create(
-            conversation=conversation,
-            content=user_message,
-            sender='user',
-            is_read=True
-        )
-        
-        # Get conversation history for context
-        messages_history = Message.objects.filter(conversation=conversation).order_by('-timestamp')[:10]
-        messages_history = reversed(list(messages_history))
+        # Retries and double-clicks carry the same key (in the body or an
+        # Idempotency-Key header); a repeated key gets the stored reply
+        idempotency_key = data.get('idempotency_key') or request.headers.get('Idempotency-Key') or None
         
         # Create OpenAI service
         openai_service = OpenAIService(request.user)
         
-        # Generate response
-        response = openai_service.generate_character_response(
-            character=character,
-            conversation_history=messages_history,
-            user_message=user_message
-        )
+        # Stream the reply as server-sent events if the client asked for it
+        if data.get('stream') or 'text/event-stream' in request.headers.get('Accept', ''):
+            user_msg, stored_reply = _claim_user_message(conversation, user_message, idempotency_key)
+            if stored_reply is not None:
+                events = iter([_sse_event(_reply_payload(stored_reply, type='done', replayed=True))])
+            else:
+                # Get conversation history for context (newest first, packed to the prompt budget)
+                messages_history = conversation.get_context_messages(exclude=user_msg)
+                try:
+                    events = _stream_character_reply(
+                        openai_service, conversation, character, messages_history, user_message, user_msg
+                    )
+                except (RateLimited, QuotaExceeded):
+                    # Nothing went upstream; drop the message so a retry with its key isn't held as in flight
+                    user_msg.delete()
+                    raise
+            response = StreamingHttpResponse(events, content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+            return response
+        
+        def reply():
+            user_msg, stored_reply = _claim_user_message(conversation, user_message, idempotency_key)
+            if stored_reply is not None:
+                return stored_reply, True
+            
+            # Generate response from the history (newest first, packed to the prompt budget)
+            try:
+                response = openai_service.generate_character_response(
+                    character=character,
+                    conversation_history=conversation.get_context_messages(exclude=user_msg),
+                    user_message=user_message,
+                    conversation=conversation
+                )
+            except (RateLimited, QuotaExceeded):
+                # Nothing went upstream; drop the message so a retry with its key isn't held as in flight
+                user_msg.delete()
+                raise
+            return _store_character_reply(conversation, character, user_message, response, reply_to=user_msg), False
+        
+        # Identical requests already in flight share one upstream call
+        flight_key = _send_flight_key(conversation, user_message, idempotency_key)
+        (char_msg, replayed), shared = _send_flight.do(flight_key, reply, timeout=IDEMPOTENCY_IN_FLIGHT_SECONDS)
         
-        # Create character message
-        char_msg = Message.objects.create(
-            conversation=conversation,
-            content=response['response'],
-            sender='character',
-            prompt_tokens=response['token_usage']['prompt_tokens'],
-            completion_tokens=response['token_usage']['completion_tokens'],
-            is_read=True
-        )
+        return JsonResponse(_reply_payload(char_msg, replayed=replayed or shared))
         
-        # Update conversation's total tokens
-        conversation.add_tokens(response['token_usage']['total_tokens'])
+    except MessageInFlight as e:
+        response = JsonResponse({'error': str(e)}, status=409)
+        response['Retry-After'] = '2'
+        return response
+    except RateLimited as e:
+        response = JsonResponse({'error': str(e)}, status=429)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    except QuotaExceeded as e:
+        return JsonResponse({'error': str(e)}, status=403)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@login_required
+async def send_message_async(request, pk):
+    """Async variant of send_message for ASGI deployments"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    
+    user = await request.auser()
+    conversation = await aget_object_or_404(
+        Conversation.objects.select_related('character'), pk=pk, user=user
+    )
+    character = conversation.character
+    
+    try:
+        data = json.loads(request.body)
+        user_message = data.get('message', '')
         
-        # Update character's last interaction timestamp
-        character.last_interaction = timezone.now()
-        character.save(update_fields=['last_interaction'])
+        if not user_message:
+            return JsonResponse({'error': 'Message content is required'}, status=400)
+        
+        # Retries and double-clicks are handled as in send_message
+        idempotency_key = data.get('idempotency_key') or request.headers.get('Idempotency-Key') or None
+        
+        # Generate response without holding a worker thread during the OpenAI call.
+        # History is newest first and is packed to the prompt budget by the service.
+        openai_service = AsyncOpenAIService(user)
         
-        # Create memory if applicable
-        if len(user_message) > 50:
+        async def reply():
+            user_msg, stored_reply = await sync_to_async(_claim_user_message)(conversation, user_message, idempotency_key)
+            if stored_reply is not None:
+                return stored_reply, True
+            
             try:
-                create_memory_from_message(character, user_message)
-            except Exception as e:
-                print(f"Error creating memory: {str(e)}")
+                response = await openai_service.generate_character_response(
+                    character=character,
+                    conversation_history=conversation.get_context_messages(exclude=user_msg),
+                    user_message=user_message,
+                    conversation=conversation
+                )
+            except (RateLimited, QuotaExceeded):
+                # Nothing went upstream; drop the message so a retry with its key isn't held as in flight
+                await user_msg.adelete()
+                raise
+            char_msg = await sync_to_async(_store_character_reply)(
+                conversation, character, user_message, response, reply_to=user_msg
+            )
+            return char_msg, False
         
-        return JsonResponse({
-            'message': response['response'],
-            'timestamp': char_msg.timestamp.strftime('%Y-%m-%d %H:%M:%S')
-        })
+        # Shares the flights of send_message, so sync and async duplicates coalesce too
+        flight_key = _send_flight_key(conversation, user_message, idempotency_key)
+        (char_msg, replayed), shared = await _send_flight.ado(flight_key, reply, timeout=IDEMPOTENCY_IN_FLIGHT_SECONDS)
         
+        return JsonResponse(_reply_payload(char_msg, replayed=replayed or shared))
+        
+    except MessageInFlight as e:
+        response = JsonResponse({'error': str(e)}, status=409)
+        response['Retry-After'] = '2'
+        return response
+    except RateLimited as e:
+        response = JsonResponse({'error': str(e)}, status=429)
+        response['Retry-After'] = str(e.retry_after)
+        return response
+    except QuotaExceeded as e:
+        return JsonResponse({'error': str(e)}, status=403)
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON'}, status=400)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+class MessageInFlight(Exception):
+    """Raised when a message with the same idempotency key is still being answered"""
+    pass
+
+
+def _claim_user_message(conversation, user_message, idempotency_key=None):
+    """
+    Store the user's message, or find the one already stored under its idempotency key
+    Returns (user_msg, stored_reply); stored_reply is the existing character reply
+    when the key was seen before and already answered.
+    """
+    if not idempotency_key:
+        user_msg = Message.objects.create(conversation=conversation, content=user_message, sender='user', is_read=True)
+        return user_msg, None
+    
+    try:
+        with transaction.atomic():
+            user_msg = Message.objects.create(
+                conversation=conversation,
+                content=user_message,
+                sender='user',
+                is_read=True,
+                idempotency_key=idempotency_key
+            )
+        return user_msg, None
+    except IntegrityError:
+        user_msg = Message.objects.get(conversation=conversation, idempotency_key=idempotency_key)
+    
+    stored_reply = user_msg.replies.order_by('-timestamp').first()
+    if stored_reply is not None:
+        return user_msg, stored_reply
+    
+    # No reply yet: either another worker is still answering it, or an earlier
+    # attempt failed; only take over once it is too old to still be running
+    if timezone.now() - user_msg.timestamp < timedelta(seconds=IDEMPOTENCY_IN_FLIGHT_SECONDS):
+        raise MessageInFlight("This message is still being answered. Please try again shortly.")
+    return user_msg, None
+
+def _send_flight_key(conversation, user_message, idempotency_key=None):
+    """Key under which identical send_message requests share one flight"""
+    return (conversation.pk, idempotency_key or hashlib.sha256(user_message.encode('utf-8')).hexdigest())
+
+def _reply_payload(char_msg, **extra):
+    """JSON body describing a stored character reply"""
+    return {
+        'message': char_msg.content,
+        'timestamp': char_msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+        **extra,
+    }
+
+def _store_character_reply(conversation, character, user_message, response, reply_to=None):
+    """
+    Persist a generated character reply and queue the rest of the turn's bookkeeping
+    Stats, memory creation and compaction run as background tasks.
+    """
+    # Create character message
+    char_msg = Message.objects.create(
+        conversation=conversation,
+        content=response['response'],
+        sender='character',
+        prompt_tokens=response['token_usage']['prompt_tokens'],
+        completion_tokens=response['token_usage']['completion_tokens'],
+        metadata={} if response.get('completed', True) else {'partial': True},
+        is_read=True,
+        reply_to=reply_to
+    )
+    
+    # Conversation token total and character's last interaction timestamp
+    record_turn_stats.delay(conversation.pk, response['token_usage']['total_tokens'], timezone.now().isoformat())
+    
+    # Create memory if applicable
+    if len(user_message) > 50:  # Only create memories from substantial messages
+        create_memory.delay(character.pk, user_message)
+    
+    # Fold older messages into the rolling summary once the tail gets long
+    try:
+        maybe_compact_conversation(conversation)
+    except Exception as e:
+        print(f"Error starting conversation compaction: {str(e)}")
+    
+    return char_msg
+
+def _sse_event(payload):
+    """Format a payload as a server-sent event"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+def _stream_character_reply(openai_service, conversation, character, messages_history, user_message, user_msg=None):
+    """
+    Start the reply stream and return the events of the streaming send_message response.
+    The reply is persisted by the service's completion callback, so it is
+    stored (with its token usage) even if the client disconnects mid-stream
+    and the server closes the events early. The rate limit and quota are
+    checked here, before the response starts, so RateLimited and
+    QuotaExceeded can still become a 429 or 403.
+    """
+    stored = {}
+    
+    def store_reply(response):
+        stored['message'] = _store_character_reply(conversation, character, user_message, response, reply_to=user_msg)
+    
+    stream = openai_service.stream_character_response(
+        character=character,
+        conversation_history=messages_history,
+        user_message=user_message,
+        conversation=conversation,
+        on_complete=store_reply
+    )
+    return _ReplyEvents(stream, stored)
+
+class _ReplyEvents:
+    """The events of a reply stream; closing them closes the stream even if none were read"""
+    
+    def __init__(self, stream, stored):
+        self.stream = stream
+        self.events = _reply_events(stream, stored)
+    
+    def __iter__(self):
+        return self.events
+    
+    def close(self):
+        self.events.close()
+        self.stream.close()
+
+def _reply_events(stream, stored):
+    """Server-sent events for a reply stream; stored receives the reply message once it is persisted"""
+    try:
+        for delta in stream:
+            yield _sse_event({'type': 'delta', 'content': delta})
+        
+        char_msg = stored['message']
+        yield _sse_event(_reply_payload(char_msg, type='done', tokens_used=char_msg.total_tokens))
+    except Exception as e:
+        yield _sse_event({'type': 'error', 'error': str(e)})
+    finally:
+        # Runs on client disconnect too; closing the service stream logs usage
+        stream.close()
+
 @login_required
 def toggle_favorite(request, conversation_id):
     """View for toggling a conversation as favorite"""
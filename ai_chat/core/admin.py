@@ -1,3 +1,16 @@
 from django.contrib import admin
+from .models import BackgroundTask
+from .services.task_queue import retry_dead_tasks
 
-# Register your models here.
+@admin.register(BackgroundTask)
+class BackgroundTaskAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'attempts', 'max_attempts', 'run_at', 'created_at')
+    search_fields = ('name', 'unique_key')
+    list_filter = ('status', 'name')
+    readonly_fields = ('created_at', 'locked_at', 'completed_at', 'last_error')
+    actions = ['retry_tasks']
+
+    def retry_tasks(self, request, queryset):
+        retried = retry_dead_tasks(queryset)
+        self.message_user(request, f"{retried} dead task(s) queued again.")
+    retry_tasks.short_description = "Retry selected dead tasks"
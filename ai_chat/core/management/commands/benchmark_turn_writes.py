@@ -0,0 +1,77 @@
+from collections import Counter
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from characters.models import Character, CharacterMemory
+from conversations.models import Conversation, Message
+from conversations.views import _store_character_reply
+from core.services.openai_service import OpenAIService
+from core.services.write_behind import write_behind
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class Command(BaseCommand):
+    help = "Count the database writes made by one chat turn, with and without the write-behind buffer"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--turns', type=int, default=5, help="Chat turns to average over")
+        parser.add_argument('--memories', type=int, default=5, help="Memories the character has")
+    
+    def handle(self, *args, **options):
+        # Everything runs in a transaction that is rolled back, and OpenAI is not called.
+        # The usage ledger writes straight through so each turn's insert is counted.
+        completion = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Well met, traveller."))],
+            usage=SimpleNamespace(prompt_tokens=120, completion_tokens=12, total_tokens=132),
+        )
+        with transaction.atomic(), override_settings(USAGE_LEDGER={'BUFFERED': False}), \
+                mock.patch('core.services.model_router.create_chat_completion', return_value=completion):
+            conversation = self._fixtures(options['memories'])
+            direct = self._measure(conversation, options['turns'], buffered=False)
+            buffered = self._measure(conversation, options['turns'], buffered=True)
+            transaction.set_rollback(True)
+        
+        self.stdout.write(f"Writes per chat turn (average of {options['turns']} turns):")
+        for label, counts in (('direct', direct), ('write-behind', buffered)):
+            detail = ', '.join(f"{counts[kind]:g} {kind}" for kind in WRITE_STATEMENTS if counts[kind])
+            self.stdout.write(f"  {label:<13} {sum(counts.values()):g} statements ({detail})")
+    
+    def _fixtures(self, memory_count):
+        user = get_user_model().objects.create_user(username='__benchmark_turn_writes__', is_staff=True)
+        character = Character.objects.create(user=user, name='Benchmark', description='Benchmark character')
+        for i in range(memory_count):
+            CharacterMemory.objects.create(character=character, content=f"Memory {i}", importance_score=0.5)
+        return Conversation.objects.create(user=user, character=character)
+    
+    def _measure(self, conversation, turns, buffered):
+        """Run chat turns the way send_message does and count write statements"""
+        counts = Counter()
+        for _ in range(turns):
+            with CaptureQueriesContext(connection) as queries:
+                if buffered:
+                    with write_behind():
+                        self._turn(conversation)
+                else:
+                    self._turn(conversation)
+            for query in queries.captured_queries:
+                kind = query['sql'].lstrip().split(' ', 1)[0].upper()
+                if kind in WRITE_STATEMENTS:
+                    counts[kind] += 1
+        return Counter({kind: count / turns for kind, count in counts.items()})
+    
+    def _turn(self, conversation):
+        user_message = "Hello there!"
+        user_msg = Message.objects.create(conversation=conversation, content=user_message, sender='user', is_read=True)
+        response = OpenAIService(conversation.user).generate_character_response(
+            character=conversation.character,
+            conversation_history=conversation.get_context_messages(exclude=user_msg),
+            user_message=user_message,
+            conversation=conversation
+        )
+        _store_character_reply(conversation, conversation.character, user_message, response)
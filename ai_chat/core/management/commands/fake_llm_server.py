@@ -0,0 +1,86 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+from core.services.fake_llm import fake_chunk_payloads, fake_completion_payload, fake_latency, get_fake_llm_settings
+
+
+class FakeCompletionsHandler(BaseHTTPRequestHandler):
+    """Answers POST /v1/chat/completions like the OpenAI API, from the fake backend"""
+    
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+    
+    def do_POST(self):
+        if self.path.rstrip('/') != '/v1/chat/completions':
+            return self._send_json(404, {'error': {'message': f"Unknown path {self.path}"}})
+        
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        payload = fake_completion_payload(body['model'], body['messages'], max_tokens=body.get('max_tokens'))
+        time.sleep(fake_latency())
+        
+        if not body.get('stream'):
+            return self._send_json(200, payload)
+        
+        # Server-sent events, ended by [DONE], as the API streams them
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        include_usage = bool((body.get('stream_options') or {}).get('include_usage'))
+        interval = get_fake_llm_settings()['CHUNK_INTERVAL']
+        for chunk in fake_chunk_payloads(payload, include_usage):
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+            time.sleep(interval)
+        self._write_chunk("data: [DONE]\n\n")
+        self._write_chunk('')
+    
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    
+    def _write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+    
+    def log_message(self, format, *args):
+        pass  # One line per request would drown out a load test
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections is routine under load
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve deterministic fake chat completions over HTTP, so the real client stack can be "
+        "load-tested offline. Point LLM_CLIENT['BASE_URL'] at http://HOST:PORT/v1."
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+    
+    def handle(self, *args, **options):
+        server = FakeLLMServer((options['host'], options['port']), FakeCompletionsHandler)
+        conf = get_fake_llm_settings()
+        self.stdout.write(
+            f"Fake LLM listening on http://{options['host']}:{options['port']}/v1 "
+            f"(latency {conf['LATENCY']}s +/- {conf['JITTER']}s)"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
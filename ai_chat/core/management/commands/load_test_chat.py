@@ -0,0 +1,165 @@
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db.models import Max
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from characters.models import Character
+from conversations.models import Conversation, Message
+from core.models import BackgroundTask
+from core.services.llm_client import get_llm_settings
+
+SCENARIOS = ('send_message', 'character_generate', 'create_summary')
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive send_message, character_generate and create_summary with concurrent simulated "
+        "users against the fake LLM backend and report latency percentiles and throughput"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10, help="Concurrent simulated users")
+        parser.add_argument('--iterations', type=int, default=10, help="Rounds of requests per user")
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f"Comma-separated subset of {', '.join(SCENARIOS)}")
+        parser.add_argument('--latency', type=float, help="Fake LLM latency in seconds")
+        parser.add_argument('--jitter', type=float, help="Fake LLM latency jitter in seconds")
+        parser.add_argument('--configured-backend', action='store_true',
+                            help="Use the configured LLM backend instead of forcing the fake one "
+                                 "(e.g. with BASE_URL pointing at fake_llm_server)")
+        parser.add_argument('--keep', action='store_true', help="Keep the load-test users and their data")
+
+    def handle(self, *args, **options):
+        scenarios = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            self.stderr.write(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+            return
+
+        llm_conf = get_llm_settings()
+        if not options['configured_backend']:
+            fake = dict(llm_conf['FAKE'])
+            if options['latency'] is not None:
+                fake['LATENCY'] = options['latency']
+            if options['jitter'] is not None:
+                fake['JITTER'] = options['jitter']
+            llm_conf = {**llm_conf, 'BACKEND': 'fake', 'FAKE': fake}
+
+        first_task = BackgroundTask.objects.aggregate(last=Max('pk'))['last'] or 0
+        with override_settings(LLM_CLIENT=llm_conf, ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            users = [self._create_user(i) for i in range(options['users'])]
+            try:
+                timings, errors, elapsed = self._run(users, scenarios, options['iterations'])
+            finally:
+                if not options['keep']:
+                    get_user_model().objects.filter(pk__in=[user.pk for user in users]).delete()
+                    BackgroundTask.objects.filter(pk__gt=first_task).delete()
+
+        self._report(timings, errors, elapsed, options)
+
+    def _create_user(self, index):
+        """A load-test user with a character and a short conversation to summarize"""
+        user = get_user_model().objects.create_user(
+            username=f"loadtest-{index}-{int(time.time())}",
+            password=None,
+            subscription_tier='enterprise',  # No character limit
+            is_staff=True,  # Unlimited tokens
+        )
+        character = Character.objects.create(user=user, name=f"Load Test {index}", description="A test character")
+        conversation = Conversation.objects.create(user=user, character=character)
+        for sender, content in (('user', "Hello!"), ('character', "Well met."), ('user', "How are you?")):
+            Message.objects.create(conversation=conversation, sender=sender, content=content)
+        return user
+
+    def _run(self, users, scenarios, iterations):
+        """Run every user's requests concurrently; returns timings per scenario, errors and wall time"""
+        timings = defaultdict(list)
+        errors = defaultdict(int)
+        lock = threading.Lock()
+        start = threading.Barrier(len(users) + 1)
+
+        def simulate(client, conversation):
+            try:
+                start.wait()
+                for iteration in range(iterations):
+                    for scenario in scenarios:
+                        began = time.perf_counter()
+                        try:
+                            ok = getattr(self, f"_{scenario}")(client, conversation, iteration)
+                        except Exception:
+                            ok = False
+                        took = time.perf_counter() - began
+                        with lock:
+                            timings[scenario].append(took)
+                            if not ok:
+                                errors[scenario] += 1
+            finally:
+                close_old_connections()
+
+        sessions = []
+        for user in users:
+            client = Client()
+            client.force_login(user)
+            sessions.append((client, Conversation.objects.get(user=user)))
+
+        threads = [threading.Thread(target=simulate, args=session) for session in sessions]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        began = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        return timings, errors, time.perf_counter() - began
+
+    def _send_message(self, client, conversation, iteration):
+        response = client.post(
+            reverse('conversations:send_message', args=[conversation.pk]),
+            data=json.dumps({'message': f"Tell me something new ({iteration})"}),
+            content_type='application/json'
+        )
+        return response.status_code == 200
+
+    def _character_generate(self, client, conversation, iteration):
+        response = client.post(reverse('characters:generate'), {
+            'name': f"Generated {conversation.pk}-{iteration}",
+            'concept': "A wandering cartographer",
+        })
+        return response.status_code < 400
+
+    def _create_summary(self, client, conversation, iteration):
+        messages = conversation.messages.order_by('timestamp')
+        response = client.post(reverse('conversations:create_summary', args=[conversation.pk]), {
+            'start_message_id': messages.first().pk,
+            'end_message_id': messages.last().pk,
+        })
+        return response.status_code < 400
+
+    def _report(self, timings, errors, elapsed, options):
+        total = sum(len(samples) for samples in timings.values())
+        self.stdout.write(
+            f"{options['users']} users x {options['iterations']} iterations: "
+            f"{total} requests in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.1f} req/s)"
+        )
+        self.stdout.write(f"{'scenario':<20} {'count':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        rows = list(timings.items()) + [('all', [t for samples in timings.values() for t in samples])]
+        for scenario, samples in rows:
+            error_count = sum(errors.values()) if scenario == 'all' else errors[scenario]
+            p50, p95, p99 = (_percentile(samples, p) * 1000 for p in (50, 95, 99))
+            self.stdout.write(f"{scenario:<20} {len(samples):>6} {error_count:>6} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f}")
+
+
+def _percentile(samples, percent):
+    """Nearest-rank percentile of a list of numbers"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
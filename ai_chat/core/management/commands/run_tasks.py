@@ -0,0 +1,55 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core.services.task_queue import claim_tasks, get_task_queue_settings, run_task
+from token_management.ledger import usage_ledger
+
+
+class Command(BaseCommand):
+    help = "Run queued background tasks on a pool of worker threads"
+    
+    def add_arguments(self, parser):
+        conf = get_task_queue_settings()
+        parser.add_argument('--workers', type=int, default=conf['WORKERS'], help="Worker threads")
+        parser.add_argument('--poll-interval', type=float, default=conf['POLL_INTERVAL'],
+                            help="Seconds to wait when the queue is empty")
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty")
+    
+    def handle(self, *args, **options):
+        workers = options['workers']
+        self.stdout.write(f"Running background tasks with {workers} worker threads")
+        
+        # Several worker processes can share the queue; claims are atomic
+        running = set()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                while True:
+                    running = {future for future in running if not future.done()}
+                    claimed = claim_tasks(workers - len(running)) if len(running) < workers else []
+                    for task_id in claimed:
+                        running.add(pool.submit(self._run, task_id))
+                    
+                    if not claimed:
+                        # Tasks' token charges are buffered; write them out while idle
+                        usage_ledger.flush_if_due()
+                        if options['once'] and not running:
+                            break
+                        time.sleep(options['poll_interval'])
+            except KeyboardInterrupt:
+                self.stdout.write("Stopping; waiting for running tasks to finish")
+        usage_ledger.flush()
+    
+    def _run(self, task_id):
+        """Run one task in a pool thread"""
+        try:
+            if run_task(task_id):
+                self.stdout.write(f"Task {task_id} succeeded")
+            else:
+                self.stdout.write(f"Task {task_id} failed")
+        except Exception as e:
+            self.stderr.write(f"Error running task {task_id}: {str(e)}")
+        finally:
+            close_old_connections()
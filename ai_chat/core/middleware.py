@@ -0,0 +1,30 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from core.services.write_behind import write_behind, awrite_behind
+
+
+class WriteBehindMiddleware:
+    """
+    Buffer a request's bookkeeping writes (counters, timestamps, usage rows)
+    and flush them in one short transaction once the view has returned
+    """
+    
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+    
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        
+        with write_behind():
+            return self.get_response(request)
+    
+    async def __acall__(self, request):
+        """Async version of __call__"""
+        async with awrite_behind():
+            return await self.get_response(request)
@@ -1,3 +1,52 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class BackgroundTask(models.Model):
+    """A queued call to a registered task function, run by the run_tasks worker"""
+
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('dead', 'Dead'),  # Out of attempts; kept for inspection and manual retry
+    )
+
+    name = models.CharField(max_length=200, help_text="Registered task name")
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+
+    # Tasks with the same key aren't queued twice while one is pending or running
+    unique_key = models.CharField(max_length=200, blank=True, db_index=True)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    last_error = models.TextField(blank=True)
+
+    # Timestamps
+    run_at = models.DateTimeField(default=timezone.now, help_text="Earliest time the task may run")
+    locked_at = models.DateTimeField(null=True, blank=True, help_text="When a worker claimed the task")
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['run_at']
+        indexes = [
+            models.Index(fields=['status', 'run_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+
+class RateLimitBucket(models.Model):
+    """A token bucket of the database rate limiter (see core.services.rate_limiter)"""
+
+    key = models.CharField(max_length=200, unique=True, help_text="Limited user and feature")
+    tokens = models.FloatField()
+    # Unix time of the last take; the bucket refills from here
+    updated_at = models.FloatField()
+
+    def __str__(self):
+        return f"{self.key}: {self.tokens:.1f}"
@@ -0,0 +1,48 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+def estimated_row_count(model):
+    """
+    The database's own estimate of a table's row count, from its statistics
+    Returns None where there is no cheap estimate (e.g. SQLite) or the table
+    hasn't been analyzed yet.
+    """
+    connection = connections[model.objects.db]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                "SELECT table_rows FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = %s",
+                [table]
+            )
+        else:
+            return None
+        row = cursor.fetchone()
+    # PostgreSQL reports -1 for a table that has never been analyzed
+    return row[0] if row and row[0] is not None and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that never runs COUNT(*) over a whole large table
+    An unfiltered list uses the table statistics estimate once that is past
+    COUNT_LIMIT; otherwise rows are counted up to COUNT_LIMIT, so a filter
+    matching more only shows that many pages.
+    """
+
+    COUNT_LIMIT = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model)
+            if estimate is not None and estimate > self.COUNT_LIMIT:
+                return estimate
+        # COUNT over a LIMITed subquery stops scanning at COUNT_LIMIT rows
+        return queryset.order_by()[:self.COUNT_LIMIT].count()
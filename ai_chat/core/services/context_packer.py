@@ -0,0 +1,99 @@
+from django.conf import settings
+
+from core.services.token_counter import count_tokens, MESSAGE_OVERHEAD_TOKENS, REPLY_PRIMER_TOKENS
+
+# Defaults for settings.CHAT_CONTEXT; any key can be overridden there
+DEFAULT_CHAT_CONTEXT_SETTINGS = {
+    'PROMPT_BUDGET': 3000,
+    'MAX_MEMORIES': 5,
+    'MAX_HISTORY_MESSAGES': 200,
+    'COMPACTION_THRESHOLD': 2000,
+    'COMPACTION_KEEP_RECENT': 800,
+    'COMPACT_IN_BACKGROUND': True,
+}
+
+
+def get_chat_context_settings():
+    """Return the chat context settings merged over the defaults"""
+    conf = dict(DEFAULT_CHAT_CONTEXT_SETTINGS)
+    conf.update(getattr(settings, 'CHAT_CONTEXT', {}))
+    return conf
+
+
+def pack_chat_context(system_prompt, user_message, history, memories=(), summaries=(), budget=None,
+                      system_prompt_tokens=None):
+    """
+    Build chat messages that fit a prompt token budget
+    The system prompt and the new user message are always included. The rest
+    of the budget goes, in order, to memories, summaries, and then as many of
+    the most recent history messages as fit.
+
+    history must be newest-first. Messages use their stored token_count, so
+    packing never re-tokenizes them; rows saved before token counts existed
+    are counted once here and written back.
+
+    Returns a dict with the messages, the memories that were included and
+    the estimated prompt token count. Pass system_prompt_tokens if the
+    system prompt's token count is already known.
+    """
+    budget = budget or get_chat_context_settings()['PROMPT_BUDGET']
+    used = (
+        2 * MESSAGE_OVERHEAD_TOKENS + REPLY_PRIMER_TOKENS
+        + (system_prompt_tokens or count_tokens(system_prompt)) + count_tokens(user_message)
+    )
+
+    # Memories go in a single system message after the user's message
+    included_memories = []
+    memory_text = "Here are some relevant memories that might influence your response:\n\n"
+    memory_cost = MESSAGE_OVERHEAD_TOKENS + count_tokens(memory_text)
+    for memory in memories:
+        cost = (memory.token_count or count_tokens(memory.content)) + 2
+        if used + memory_cost + cost > budget:
+            break
+        memory_cost += cost
+        included_memories.append(memory)
+    if included_memories:
+        used += memory_cost
+        memory_text += ''.join(f"- {memory.content}\n" for memory in included_memories)
+
+    # Summaries of older conversation segments, oldest first
+    included_summaries = []
+    for summary in summaries:
+        summary_text = f"Summary of earlier conversation:\n{summary.content}"
+        cost = MESSAGE_OVERHEAD_TOKENS + count_tokens(summary_text)
+        if used + cost > budget:
+            break
+        used += cost
+        included_summaries.append(summary_text)
+
+    # As many recent messages as still fit
+    included_history = []
+    uncounted = []
+    for msg in history:
+        if not msg.token_count and msg.content:
+            msg.token_count = count_tokens(msg.content)
+            uncounted.append(msg)
+        cost = MESSAGE_OVERHEAD_TOKENS + msg.token_count
+        if used + cost > budget:
+            break
+        used += cost
+        included_history.append(msg)
+
+    if uncounted:
+        type(uncounted[0]).objects.bulk_update(uncounted, ['token_count'])
+
+    messages = [{"role": "system", "content": system_prompt}]
+    for summary_text in included_summaries:
+        messages.append({"role": "system", "content": summary_text})
+    for msg in reversed(included_history):
+        role = "assistant" if msg.sender == "character" else "user"
+        messages.append({"role": role, "content": msg.content})
+    messages.append({"role": "user", "content": user_message})
+    if included_memories:
+        messages.append({"role": "system", "content": memory_text})
+
+    return {
+        'messages': messages,
+        'memories': included_memories,
+        'prompt_tokens': used,
+    }
@@ -0,0 +1,161 @@
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+from types import SimpleNamespace
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from core.services.token_counter import count_message_tokens, count_tokens
+
+# Defaults for settings.LLM_CLIENT['FAKE']; any key can be overridden there
+DEFAULT_FAKE_LLM_SETTINGS = {
+    # Seconds before the response (or the first streamed chunk), +/- JITTER
+    'LATENCY': 0.5,
+    'JITTER': 0.2,
+    # Delay between streamed chunks
+    'CHUNK_INTERVAL': 0.02,
+    # Upper bound on reply length in words, below the request's max_tokens
+    'MAX_WORDS': 60,
+}
+
+_WORDS = (
+    "the a of and to in is was it that he she they said with for as on at by from "
+    "old night sea story light long ever under road home friend strange quiet time "
+    "remember always perhaps indeed wonder voice heart city river storm journey"
+).split()
+
+
+def fake_completion_payload(model, messages, max_tokens=None, **kwargs):
+    """
+    Build a deterministic chat completion (as the API's JSON) for a request
+    The same messages always get the same reply and usage. Requests that ask
+    for JSON get a JSON object back so parsers downstream keep working.
+    """
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode('utf-8')).digest()
+    rng = random.Random(digest)
+
+    word_limit = min(get_fake_llm_settings()['MAX_WORDS'], max_tokens or 800)
+    words = [rng.choice(_WORDS) for _ in range(rng.randint(max(1, word_limit // 2), max(1, word_limit)))]
+    text = ' '.join(words).capitalize() + '.'
+    if 'JSON' in messages[-1]['content']:
+        text = json.dumps({
+            'background_story': text,
+            'personality': {'core_traits': words[:3], 'strengths': words[3:5], 'weaknesses': words[5:7], 'quirks': words[7:8]},
+            'voice': ' '.join(words[:6]),
+            'scenarios': {},
+            'motivations': words[8:10],
+            'fears': words[10:12],
+        })
+
+    prompt_tokens = count_message_tokens(messages, model)
+    completion_tokens = count_tokens(text, model)
+    return {
+        # Ids are unique per call, like the real API's (the usage ledger dedupes on them)
+        'id': f"chatcmpl-fake-{uuid.uuid4().hex[:24]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': text},
+            'finish_reason': 'stop',
+        }],
+        'usage': {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def fake_chunk_payloads(payload, include_usage=False):
+    """Split a fake completion into streaming chunks (as the API's JSON)"""
+    base = {'id': payload['id'], 'object': 'chat.completion.chunk', 'created': payload['created'], 'model': payload['model']}
+    words = payload['choices'][0]['message']['content'].split(' ')
+    for i, word in enumerate(words):
+        yield {**base, 'choices': [{'index': 0, 'delta': {'content': word if i == 0 else ' ' + word}, 'finish_reason': None}]}
+    yield {**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+    if include_usage:
+        yield {**base, 'choices': [], 'usage': payload['usage']}
+
+
+def get_fake_llm_settings():
+    """Return the fake backend settings merged over the defaults"""
+    from core.services.llm_client import get_llm_settings
+    conf = dict(DEFAULT_FAKE_LLM_SETTINGS)
+    conf.update(get_llm_settings().get('FAKE', {}))
+    return conf
+
+
+def fake_latency():
+    """Seconds to wait before answering: LATENCY +/- a random JITTER"""
+    conf = get_fake_llm_settings()
+    return max(0.0, conf['LATENCY'] + random.uniform(-conf['JITTER'], conf['JITTER']))
+
+
+class FakeOpenAI:
+    """In-process stand-in for the OpenAI client, for load tests and offline development"""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, model, messages, stream=False, stream_options=None, timeout=None, **kwargs):
+        payload = fake_completion_payload(model, messages, **kwargs)
+        time.sleep(fake_latency())
+        if not stream:
+            return ChatCompletion.model_validate(payload)
+        include_usage = bool(stream_options and stream_options.get('include_usage'))
+        return FakeStream(fake_chunk_payloads(payload, include_usage), get_fake_llm_settings()['CHUNK_INTERVAL'])
+
+
+class FakeAsyncOpenAI:
+    """Async stand-in for the AsyncOpenAI client"""
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, stream=False, stream_options=None, timeout=None, **kwargs):
+        payload = fake_completion_payload(model, messages, **kwargs)
+        await asyncio.sleep(fake_latency())
+        if not stream:
+            return ChatCompletion.model_validate(payload)
+        include_usage = bool(stream_options and stream_options.get('include_usage'))
+        return FakeAsyncStream(fake_chunk_payloads(payload, include_usage), get_fake_llm_settings()['CHUNK_INTERVAL'])
+
+
+class FakeStream:
+    """Iterable of ChatCompletionChunks with a close() like the SDK's Stream"""
+
+    def __init__(self, chunks, interval):
+        self.chunks = chunks
+        self.interval = interval
+        self.closed = False
+
+    def __iter__(self):
+        for i, chunk in enumerate(self.chunks):
+            if self.closed:
+                return
+            if i and self.interval:
+                time.sleep(self.interval)
+            yield ChatCompletionChunk.model_validate(chunk)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeAsyncStream(FakeStream):
+    """Async iterable of ChatCompletionChunks with a close() like the SDK's AsyncStream"""
+
+    async def __aiter__(self):
+        for i, chunk in enumerate(self.chunks):
+            if self.closed:
+                return
+            if i and self.interval:
+                await asyncio.sleep(self.interval)
+            yield ChatCompletionChunk.model_validate(chunk)
+
+    async def close(self):
+        self.closed = True
@@ -0,0 +1,268 @@
+import asyncio
+import random
+import threading
+import time
+import weakref
+
+import httpx
+from django.conf import settings
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError
+
+from core.services.fake_llm import FakeOpenAI, FakeAsyncOpenAI
+
+# Defaults for settings.LLM_CLIENT; any key can be overridden there
+DEFAULT_LLM_CLIENT_SETTINGS = {
+    # 'openai', or 'fake' for the offline stand-in in core.services.fake_llm
+    'BACKEND': 'openai',
+    # Point the OpenAI backend somewhere else, e.g. the fake_llm_server command
+    'BASE_URL': None,
+    'FAKE': {},
+    'TIMEOUTS': {
+        'character_chat': 30,
+        'character_creation': 90,
+        'memory_summarization': 45,
+        'default': 60,
+    },
+    'CONNECT_TIMEOUT': 5,
+    'MAX_RETRIES': 3,
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 8,
+    'MAX_CONCURRENCY': 16,
+    'ACQUIRE_TIMEOUT': 30,
+    'MAX_CONNECTIONS': 32,
+    'MAX_KEEPALIVE_CONNECTIONS': 16,
+    'KEEPALIVE_EXPIRY': 30,
+}
+
+
+class UpstreamBusyError(Exception):
+    """Raised when no upstream LLM slot frees up within ACQUIRE_TIMEOUT"""
+    pass
+
+
+_lock = threading.Lock()
+_client = None
+_fake_client = None
+_semaphore = None
+# Async clients and semaphores are bound to the event loop that created them
+_async_clients = weakref.WeakKeyDictionary()
+_async_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_llm_settings():
+    """Return the LLM client settings merged over the defaults"""
+    conf = dict(DEFAULT_LLM_CLIENT_SETTINGS)
+    conf.update(getattr(settings, 'LLM_CLIENT', {}))
+    conf['TIMEOUTS'] = {
+        **DEFAULT_LLM_CLIENT_SETTINGS['TIMEOUTS'],
+        **getattr(settings, 'LLM_CLIENT', {}).get('TIMEOUTS', {}),
+    }
+    return conf
+
+
+def get_client():
+    """
+    Get the shared OpenAI client
+    Created on first use with a pooled keep-alive HTTP client. Retries are
+    handled here rather than by the SDK, so they can back off with jitter and
+    give up their concurrency slot while waiting.
+    """
+    global _client, _fake_client
+    conf = get_llm_settings()
+    if conf['BACKEND'] == 'fake':
+        if _fake_client is None:
+            _fake_client = FakeOpenAI()
+        return _fake_client
+    
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=settings.OPENAI_API_KEY,
+                    base_url=conf['BASE_URL'],
+                    max_retries=0,
+                    http_client=httpx.Client(limits=_pool_limits(conf), timeout=_timeout_for(None, conf)),
+                )
+    return _client
+
+
+def get_async_client():
+    """Get the AsyncOpenAI client for the running event loop"""
+    conf = get_llm_settings()
+    if conf['BACKEND'] == 'fake':
+        return FakeAsyncOpenAI()
+    
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=conf['BASE_URL'],
+            max_retries=0,
+            http_client=httpx.AsyncClient(limits=_pool_limits(conf), timeout=_timeout_for(None, conf)),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def create_chat_completion(feature, max_retries=None, **kwargs):
+    """
+    Create a chat completion with the feature's timeout
+    Retries 429, 5xx, timeouts and connection errors with jittered exponential
+    backoff, up to max_retries times (default MAX_RETRIES). At most
+    MAX_CONCURRENCY calls are in flight per process.
+    """
+    conf = get_llm_settings()
+    kwargs.setdefault('timeout', _timeout_for(feature, conf))
+    max_retries = conf['MAX_RETRIES'] if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        try:
+            with _upstream_slot(conf):
+                return get_client().chat.completions.create(**kwargs)
+        except Exception as e:
+            if not is_retryable_error(e) or attempt >= max_retries:
+                raise
+            time.sleep(_backoff_delay(attempt, conf, e))
+            attempt += 1
+
+
+def stream_chat_completion(feature, max_retries=None, **kwargs):
+    """
+    Open a streaming chat completion
+    Errors opening the stream are raised (and retried) here, like
+    create_chat_completion. The returned stream holds a concurrency slot until
+    it is exhausted or closed; a stream that fails midway is not retried.
+    """
+    conf = get_llm_settings()
+    kwargs.setdefault('timeout', _timeout_for(feature, conf))
+    max_retries = conf['MAX_RETRIES'] if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        slot = _upstream_slot(conf).__enter__()
+        try:
+            return _SlotStream(get_client().chat.completions.create(stream=True, **kwargs), slot)
+        except Exception as e:
+            slot.__exit__(None, None, None)
+            if not is_retryable_error(e) or attempt >= max_retries:
+                raise
+            time.sleep(_backoff_delay(attempt, conf, e))
+            attempt += 1
+
+
+async def acreate_chat_completion(feature, max_retries=None, **kwargs):
+    """Async version of create_chat_completion"""
+    conf = get_llm_settings()
+    kwargs.setdefault('timeout', _timeout_for(feature, conf))
+    max_retries = conf['MAX_RETRIES'] if max_retries is None else max_retries
+    semaphore = _async_semaphore(conf)
+    attempt = 0
+    while True:
+        try:
+            try:
+                await asyncio.wait_for(semaphore.acquire(), timeout=conf['ACQUIRE_TIMEOUT'])
+            except asyncio.TimeoutError:
+                raise UpstreamBusyError("Too many concurrent requests to the language model. Please try again shortly.")
+            try:
+                return await get_async_client().chat.completions.create(**kwargs)
+            finally:
+                semaphore.release()
+        except Exception as e:
+            if not is_retryable_error(e) or attempt >= max_retries:
+                raise
+            await asyncio.sleep(_backoff_delay(attempt, conf, e))
+            attempt += 1
+
+
+class _upstream_slot:
+    """Context manager holding one of the process-wide upstream call slots"""
+
+    def __init__(self, conf):
+        self.conf = conf
+
+    def __enter__(self):
+        global _semaphore
+        if _semaphore is None:
+            with _lock:
+                if _semaphore is None:
+                    _semaphore = threading.BoundedSemaphore(self.conf['MAX_CONCURRENCY'])
+        self.semaphore = _semaphore
+        if not self.semaphore.acquire(timeout=self.conf['ACQUIRE_TIMEOUT']):
+            raise UpstreamBusyError("Too many concurrent requests to the language model. Please try again shortly.")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.semaphore.release()
+        return False
+
+
+class _SlotStream:
+    """Iterable wrapper around an OpenAI stream that frees its upstream slot when closed"""
+
+    def __init__(self, stream, slot):
+        self.stream = stream
+        self.slot = slot
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            yield from self.stream
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.stream.close()
+            finally:
+                self.slot.__exit__(None, None, None)
+
+
+def _async_semaphore(conf):
+    """Get the semaphore capping concurrent async calls on the running loop"""
+    loop = asyncio.get_running_loop()
+    semaphore = _async_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(conf['MAX_CONCURRENCY'])
+        _async_semaphores[loop] = semaphore
+    return semaphore
+
+
+def _pool_limits(conf):
+    """Connection pool limits so keep-alive connections are reused across calls"""
+    return httpx.Limits(
+        max_connections=conf['MAX_CONNECTIONS'],
+        max_keepalive_connections=conf['MAX_KEEPALIVE_CONNECTIONS'],
+        keepalive_expiry=conf['KEEPALIVE_EXPIRY'],
+    )
+
+
+def _timeout_for(feature, conf):
+    """Request timeout for a feature, falling back to the default"""
+    seconds = conf['TIMEOUTS'].get(feature, conf['TIMEOUTS']['default'])
+    return httpx.Timeout(seconds, connect=conf['CONNECT_TIMEOUT'])
+
+
+def is_retryable_error(error):
+    """Whether an upstream error is worth retrying (429, 5xx, timeouts, dropped connections)"""
+    if isinstance(error, (APITimeoutError, APIConnectionError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def _backoff_delay(attempt, conf, error=None):
+    """Full-jitter exponential backoff, honouring Retry-After when the API sends one"""
+    delay = random.uniform(0, min(conf['BACKOFF_MAX'], conf['BACKOFF_BASE'] * (2 ** attempt)))
+
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), conf['BACKOFF_MAX']))
+        except ValueError:
+            pass
+
+    return delay
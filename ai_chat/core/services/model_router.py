@@ -0,0 +1,199 @@
+import threading
+import time
+from collections import deque
+
+import httpx
+from django.conf import settings
+
+from core.services.llm_client import (
+    create_chat_completion, stream_chat_completion, acreate_chat_completion, get_llm_settings, is_retryable_error,
+)
+
+# Defaults for settings.LLM_MODEL_ROUTES: feature -> models in order of preference.
+# latency_target is the per-call SLO in seconds; a model whose average latency
+# exceeds it (or that keeps failing) is skipped for COOLDOWN seconds. A route
+# can also set 'timeout' and 'max_retries' for calls that have a fallback.
+DEFAULT_MODEL_ROUTES = {
+    'character_creation': [
+        {'model': 'gpt-4', 'latency_target': 40},
+        {'model': 'gpt-4o-mini', 'latency_target': 40},
+    ],
+    'character_chat': [
+        {'model': 'gpt-3.5-turbo', 'latency_target': 6},
+        {'model': 'gpt-4o-mini', 'latency_target': 6},
+    ],
+    'memory_summarization': [
+        {'model': 'gpt-3.5-turbo', 'latency_target': 15},
+        {'model': 'gpt-4o-mini', 'latency_target': 15},
+    ],
+}
+
+# Defaults for settings.LLM_ROUTER; any key can be overridden there
+DEFAULT_ROUTER_SETTINGS = {
+    'WINDOW': 20,  # Recent calls per model used for the error rate
+    'MIN_SAMPLES': 5,  # Calls needed before a model can be judged unhealthy
+    'MAX_ERROR_RATE': 0.5,
+    'EWMA_ALPHA': 0.3,  # Weight of the newest latency sample
+    'COOLDOWN': 30,  # Seconds an unhealthy model is skipped before it is tried again
+}
+
+
+class ModelHealth:
+    """In-process latency and error statistics for one model serving one feature"""
+
+    def __init__(self, window):
+        self.outcomes = deque(maxlen=window)
+        self.latency = None  # Exponentially weighted moving average, in seconds
+        self.skip_until = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, ok, latency, route, conf):
+        with self.lock:
+            self.outcomes.append(ok)
+            if ok:
+                alpha = conf['EWMA_ALPHA']
+                self.latency = latency if self.latency is None else alpha * latency + (1 - alpha) * self.latency
+
+            if len(self.outcomes) >= conf['MIN_SAMPLES'] and (
+                self.error_rate() > conf['MAX_ERROR_RATE']
+                or (self.latency is not None and self.latency > route['latency_target'])
+            ):
+                # Start afresh after the cooldown so the model gets a clean re-evaluation
+                self.skip_until = time.monotonic() + conf['COOLDOWN']
+                self.outcomes.clear()
+                self.latency = None
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def is_healthy(self):
+        return time.monotonic() >= self.skip_until
+
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+def get_router_settings():
+    """Return the router settings merged over the defaults"""
+    conf = dict(DEFAULT_ROUTER_SETTINGS)
+    conf.update(getattr(settings, 'LLM_ROUTER', {}))
+    return conf
+
+
+def get_routes(feature):
+    """The configured models for a feature, in order of preference"""
+    routes = {**DEFAULT_MODEL_ROUTES, **getattr(settings, 'LLM_MODEL_ROUTES', {})}
+    return routes.get(feature) or routes['character_chat']
+
+
+def primary_model(feature):
+    """The preferred model for a feature (used e.g. in response cache keys)"""
+    return get_routes(feature)[0]['model']
+
+
+def get_health(feature, model):
+    """Get the health record for a feature's model"""
+    key = (feature, model)
+    health = _health.get(key)
+    if health is None:
+        with _health_lock:
+            health = _health.setdefault(key, ModelHealth(get_router_settings()['WINDOW']))
+    return health
+
+
+def router_stats():
+    """Snapshot of the observed latency and error rate per feature and model"""
+    return {
+        f"{feature}:{model}": {
+            'latency': health.latency,
+            'error_rate': health.error_rate(),
+            'calls': len(health.outcomes),
+            'healthy': health.is_healthy(),
+        }
+        for (feature, model), health in list(_health.items())
+    }
+
+
+def candidate_routes(feature):
+    """Routes to try in order: healthy models first, unhealthy ones as a last resort"""
+    routes = get_routes(feature)
+    healthy = [route for route in routes if get_health(feature, route['model']).is_healthy()]
+    return healthy + [route for route in routes if route not in healthy]
+
+
+def routed_chat_completion(feature, **kwargs):
+    """
+    Create a chat completion on the feature's best available model
+    Fails over to the next model on upstream errors (429, 5xx, timeouts,
+    dropped connections). Only the last candidate gets the client's full
+    retry budget, so failover is quick. Errors caused by the request itself
+    are raised straight away.
+    """
+    conf = get_router_settings()
+    candidates = candidate_routes(feature)
+    for i, route in enumerate(candidates):
+        last = i == len(candidates) - 1
+        started = time.monotonic()
+        try:
+            response = create_chat_completion(feature, **_route_kwargs(route, kwargs, last))
+        except Exception as e:
+            if not _fail_over(feature, route, e, started, last, conf):
+                raise
+            continue
+        get_health(feature, route['model']).record(True, time.monotonic() - started, route, conf)
+        return response
+
+
+def routed_stream_chat_completion(feature, **kwargs):
+    """Open a streaming chat completion; failover applies while the stream is being opened"""
+    conf = get_router_settings()
+    candidates = candidate_routes(feature)
+    for i, route in enumerate(candidates):
+        last = i == len(candidates) - 1
+        started = time.monotonic()
+        try:
+            stream = stream_chat_completion(feature, **_route_kwargs(route, kwargs, last))
+        except Exception as e:
+            if not _fail_over(feature, route, e, started, last, conf):
+                raise
+            continue
+        get_health(feature, route['model']).record(True, time.monotonic() - started, route, conf)
+        return stream
+
+
+async def arouted_chat_completion(feature, **kwargs):
+    """Async version of routed_chat_completion"""
+    conf = get_router_settings()
+    candidates = candidate_routes(feature)
+    for i, route in enumerate(candidates):
+        last = i == len(candidates) - 1
+        started = time.monotonic()
+        try:
+            response = await acreate_chat_completion(feature, **_route_kwargs(route, kwargs, last))
+        except Exception as e:
+            if not _fail_over(feature, route, e, started, last, conf):
+                raise
+            continue
+        get_health(feature, route['model']).record(True, time.monotonic() - started, route, conf)
+        return response
+
+
+def _fail_over(feature, route, error, started, last, conf):
+    """Record a failed call; returns True if the next model should be tried"""
+    if not is_retryable_error(error):
+        return False
+    get_health(feature, route['model']).record(False, time.monotonic() - started, route, conf)
+    return not last
+
+
+def _route_kwargs(route, kwargs, last):
+    """Request arguments for one route: its model, and a timeout and retries that leave room for failover"""
+    route_kwargs = {**kwargs, 'model': route['model']}
+    if not last:
+        route_kwargs.setdefault('max_retries', route.get('max_retries', 0))
+        if 'timeout' in route:
+            route_kwargs.setdefault(
+                'timeout', httpx.Timeout(route['timeout'], connect=get_llm_settings()['CONNECT_TIMEOUT'])
+            )
+    return route_kwargs
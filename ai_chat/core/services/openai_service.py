@@ -1,10 +1,55 @@
 import json
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from token_management.models import UserTokenLimit, TokenUsage
+from django.utils import timezone
+from token_management.models import UserTokenLimit
+from token_management.reservations import QuotaExceeded, TokenReservation, reserve_tokens
+from core.services.model_router import (
+    routed_chat_completion, routed_stream_chat_completion, arouted_chat_completion, primary_model,
+)
+from core.services.response_cache import get_response_cache, make_cache_key
+from core.services import write_behind
+from core.services.context_packer import pack_chat_context
+from core.services.persona_cache import get_compiled_persona
+from core.services.rate_limiter import check_rate_limit
+from core.services.token_counter import count_message_tokens
+
+# Defaults for settings.CHARACTER_BATCH; any key can be overridden there
+DEFAULT_BATCH_GENERATION_SETTINGS = {
+    'MAX_SIZE': 20,  # Characters per batch request
+    'CONCURRENCY': 5,  # Character creation calls in flight at once
+}
+
+
+def get_batch_generation_settings():
+    """Return the batch character generation settings merged over the defaults"""
+    conf = dict(DEFAULT_BATCH_GENERATION_SETTINGS)
+    conf.update(getattr(settings, 'CHARACTER_BATCH', {}))
+    return conf
+
+
+class ReservedStream:
+    """
+    A reply stream and the reservation it was started with
+    Closing it releases the reservation even if the stream was never read,
+    when the generator's own cleanup doesn't run.
+    """
+    
+    def __init__(self, generator, reservation):
+        self.generator = generator
+        self.reservation = reservation
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        return next(self.generator)
+    
+    def close(self):
+        self.generator.close()
+        self.reservation.release()
 
-# Set OpenAI API key
-client = OpenAI(api_key=settings.OPENAI_API_KEY)
 
 class OpenAIService:
     """Service for interacting with OpenAI APIs"""
@@ -17,6 +62,137 @@ class OpenAIService:
         Create a new character using OpenAI
         Returns character details and token usage
         """
+        # A cache hit costs nothing, so it doesn't count against the rate limit or quota
+        cached = self._cached_character(name, description, traits)
+        if cached is not None:
+            return cached
+        
+        self._throttle('character_creation')
+        with self._reserve_tokens(self._character_creation_messages(name, description, traits), 2000) as reservation:
+            result = self._generate_character(name, description, traits)
+            
+            # Filled in by another request meanwhile; nothing to log (the reservation is released)
+            if not result['token_usage'].get('cached'):
+                self._log_token_usage(
+                    feature='character_creation',
+                    tokens_used=result['token_usage']['total_tokens'],
+                    character_id=None,  # Will be updated after character creation
+                    reservation=reservation
+                )
+        
+        return result
+    
+    def create_characters(self, specs, concurrency=None):
+        """
+        Create several characters at once
+        specs are dicts with a name, a description and optional traits. Cached
+        specs are answered without a call; the rest run concurrently, at most
+        CHARACTER_BATCH['CONCURRENCY'] at a time, and their token usage is
+        logged as one charge. Quota is reserved per spec, so specs beyond what
+        the user has left fail on their own; QuotaExceeded is only raised if
+        none fit. Each spec sent upstream counts as one request against the
+        rate limit.
+        Returns one result per spec, in order: the same dict create_character
+        returns, or {'error': ...} if the call failed or didn't fit the quota.
+        """
+        if not specs:
+            return []
+        
+        results = [None] * len(specs)
+        pending = []
+        for index, spec in enumerate(specs):
+            cached = self._cached_character(spec['name'], spec['description'], spec.get('traits'))
+            if cached is not None:
+                results[index] = cached
+            else:
+                pending.append(index)
+        
+        # Reserved spec by spec; the reservations are held (and settled) as one
+        to_generate, reserved, quota_error = [], 0, None
+        for index in pending:
+            spec = specs[index]
+            try:
+                reserved += self._reserve_tokens(
+                    self._character_creation_messages(spec['name'], spec['description'], spec.get('traits')), 2000
+                ).amount
+            except QuotaExceeded as e:
+                results[index], quota_error = {'error': str(e)}, e
+                continue
+            to_generate.append(index)
+        
+        def generate(spec):
+            try:
+                return self._generate_character(spec['name'], spec['description'], spec.get('traits'))
+            except Exception as e:
+                print(f"Error generating character {spec['name']}: {str(e)}")
+                return {'error': str(e)}
+        
+        with TokenReservation(self.user.pk, reserved) as reservation:
+            if not to_generate:
+                if quota_error and len(pending) == len(specs):
+                    raise quota_error
+                return results
+            self._throttle('character_creation', cost=len(to_generate))
+            
+            # The workers only call OpenAI; all database writes stay on this thread
+            workers = min(concurrency or get_batch_generation_settings()['CONCURRENCY'], len(to_generate))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for index, result in zip(to_generate, pool.map(generate, [specs[i] for i in to_generate])):
+                    results[index] = result
+            
+            tokens_used = sum(result['token_usage']['total_tokens'] for result in results if 'token_usage' in result)
+            if tokens_used:
+                self._log_token_usage(feature='character_creation', tokens_used=tokens_used, reservation=reservation)
+        
+        return results
+    
+    def _character_request(self, name, description, traits=None):
+        """The completion arguments for character creation, which also key the response cache"""
+        return {
+            'messages': self._character_creation_messages(name, description, traits),
+            'temperature': 0.7,
+            'max_tokens': 2000,
+        }
+    
+    def _cached_character(self, name, description, traits=None):
+        """The cached result for an identical character request, or None"""
+        cache = get_response_cache()
+        if not cache:
+            return None
+        cached = cache.get(make_cache_key(model=primary_model('character_creation'), **self._character_request(name, description, traits)))
+        if cached is None:
+            return None
+        return {
+            'character_data': cached['character_data'],
+            'token_usage': self._cached_token_usage(),
+        }
+    
+    def _generate_character(self, name, description, traits=None):
+        """Generate character details without logging token usage; safe to call from worker threads"""
+        # Identical requests (e.g. the user retrying) are served from the cache
+        # without an upstream call or a second charge
+        cached = self._cached_character(name, description, traits)
+        if cached is not None:
+            return cached
+        
+        request = self._character_request(name, description, traits)
+        cache, cache_key = get_response_cache(), make_cache_key(model=primary_model('character_creation'), **request)
+        response = routed_chat_completion('character_creation', **request)
+        
+        # Fixed to use object properties instead of dictionary access
+        token_usage = self._usage_dict(response.usage)
+        
+        character_data = self._parse_character_data(response.choices[0].message.content)
+        if cache and 'error' not in character_data:
+            cache.set(cache_key, {'character_data': character_data})
+        
+        return {
+            'character_data': character_data,
+            'token_usage': token_usage,
+        }
+    
+    def _character_creation_messages(self, name, description, traits=None):
+        """Build the chat messages for character creation"""
         system_prompt = """You are a creative assistant that helps create detailed fictional characters.
         Generate a rich character profile based on the given name, description, and traits.
         Provide a background story, personality traits, voice characteristics, and how they might 
@@ -56,31 +232,13 @@ class OpenAIService:
         }}
         """
         
-        response = client.chat.completions.create(
-            model="gpt-4",  # Using GPT-4 for higher quality characters
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.7,
-            max_tokens=2000,
-        )
-        
-        # Log token usage - Fixed to use object properties instead of dictionary access
-        token_usage = {
-            'prompt_tokens': response.usage.prompt_tokens,
-            'completion_tokens': response.usage.completion_tokens,
-            'total_tokens': response.usage.total_tokens
-        }
-        
-        self._log_token_usage(
-            feature='character_creation',
-            tokens_used=token_usage['total_tokens'],
-            character_id=None  # Will be updated after character creation
-        )
-        
-        # Parse the response - Fixed to access response content properly
-        character_content = response.choices[0].message.content
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+    
+    def _parse_character_data(self, character_content):
+        """Parse the character JSON out of a completion, tolerating surrounding text"""
         try:
             character_data = json.loads(character_content)
         except json.JSONDecodeError:
@@ -97,94 +255,220 @@ class OpenAIService:
             else:
                 print(f'No JSON found in response: {character_content}')
                 character_data = {"error": "Failed to parse character data"}
-                    
-        return {
-            'character_data': character_data,
-            'token_usage': token_usage,
-        }
+        
+        return character_data
     
-    def generate_character_response(self, character, conversation_history, user_message):
+    def generate_character_response(self, character, conversation_history, user_message, conversation=None):
         """
         Generate a character's response to a user message
+        conversation_history is newest-first and is trimmed to the prompt budget
         Returns the response and token usage
         """
-        # Create system prompt based on character details
-        system_prompt = f"""You are roleplaying as {character.name}. Here are details about your character:
-        
-        Background: {character.background_story}
+        messages = self._build_character_messages(character, conversation_history, user_message, conversation)
         
-        Voice: {character.voice}
+        self._throttle('character_chat')
+        with self._reserve_tokens(messages, 800) as reservation:
+            # Get response from OpenAI
+            # The model comes from the feature's route in settings.LLM_MODEL_ROUTES
+            response = routed_chat_completion(
+                'character_chat',
+                messages=messages,
+                temperature=0.8,
+                max_tokens=800
+            )
+            
+            # Log token usage - Fixed to use object properties
+            token_usage = self._usage_dict(response.usage)
+            
+            self._log_token_usage(
+                feature='character_chat',
+                tokens_used=token_usage['total_tokens'],
+                character_id=character.id,
+                conversation_id=conversation.id if conversation else None,
+                call_id=self._call_id(response),
+                reservation=reservation
+            )
         
-        Traits: {', '.join(character.get_traits_list())}
+        # Update character's interaction records
+        character.record_interaction(token_usage['total_tokens'])
         
-        Always stay in character and respond as {character.name} would. Never break character
-        or acknowledge that you are an AI. Respond directly as the character would speak.
+        return {
+            'response': response.choices[0].message.content,
+            'token_usage': token_usage,
+        }
+    
+    def stream_character_response(self, character, conversation_history, user_message, conversation=None,
+                                  on_complete=None):
         """
-        
-        # Build messages from conversation history
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # Add conversation history
-        for msg in conversation_history:
-            role = "assistant" if msg.sender == "character" else "user"
-            messages.append({"role": role, "content": msg.content})
-        
-        # Add the current user message
-        messages.append({"role": "user", "content": user_message})
-        
-        # Get relevant memories
-        memories = character.get_memory_objects()[:5]  # Limit to 5 most important memories
-        if memories:
-            memory_text = "Here are some relevant memories that might influence your response:\n\n"
-            for memory in memories:
-                memory_text += f"- {memory.content}\n"
-                memory.access()  # Mark memory as accessed
-            
-            # Add memories as a separate system message
-            messages.append({"role": "system", "content": memory_text})
-        
-        # Get response from OpenAI
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",  # Use a less expensive model for regular chat
-            messages=messages,
-            temperature=0.8,
-            max_tokens=800
+        Stream a character's response to a user message
+        Yields text deltas as they arrive. Token usage is logged once the stream
+        ends, including when the consumer closes the generator early (e.g. the
+        client disconnected); in that case usage is estimated from the text.
+        on_complete, if given, is called with the same dict generate_character_response returns.
+        The rate limit is checked and the tokens reserved when this is called,
+        before the first delta is asked for, so RateLimited and QuotaExceeded
+        can still become error responses.
+        """
+        self._throttle('character_chat')
+        messages = self._build_character_messages(character, conversation_history, user_message, conversation)
+        reservation = self._reserve_tokens(messages, 800)
+        return ReservedStream(
+            self._stream_character_response(character, messages, conversation, on_complete, reservation), reservation
         )
+    
+    def _stream_character_response(self, character, messages, conversation, on_complete, reservation):
+        """Generator behind stream_character_response"""
+        # Tokens are reserved for the whole stream; leaving the block releases
+        # them if the call was never charged
+        with reservation:
+            stream = routed_stream_chat_completion(
+                'character_chat',
+                messages=messages,
+                temperature=0.8,
+                max_tokens=800,
+                stream_options={'include_usage': True},
+            )
+            
+            chunks = []
+            usage = None
+            call_id = None
+            try:
+                for chunk in stream:
+                    call_id = call_id or self._call_id(chunk)
+                    # The final chunk carries usage and no choices
+                    if getattr(chunk, 'usage', None):
+                        usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            finally:
+                stream.close()
+                response_text = ''.join(chunks)
+                
+                if usage is not None:
+                    token_usage = self._usage_dict(usage)
+                else:
+                    # Stream was cut short, so OpenAI never sent usage - estimate it
+                    token_usage = self._estimate_token_usage(messages, response_text)
+                
+                # This runs after the request's middleware has returned, so buffer
+                # the bookkeeping writes here
+                with write_behind.write_behind():
+                    self._log_token_usage(
+                        feature='character_chat',
+                        tokens_used=token_usage['total_tokens'],
+                        character_id=character.id,
+                        conversation_id=conversation.id if conversation else None,
+                        call_id=call_id,
+                        reservation=reservation
+                    )
+                    character.record_interaction(token_usage['total_tokens'])
+                    
+                    if on_complete:
+                        on_complete({
+                            'response': response_text,
+                            'token_usage': token_usage,
+                            'completed': usage is not None,
+                        })
+    
+    def _build_character_messages(self, character, conversation_history, user_message, conversation=None):
+        """
+        Build the chat messages for a character response
+        conversation_history is newest-first; only as much of it as fits the
+        CHAT_CONTEXT prompt budget (after the persona, memories and the
+        conversation's rolling summary) is used.
+        """
+        # Persona prompt and pinned memories are compiled once per character and cached
+        persona = get_compiled_persona(character)
         
-        # Log token usage - Fixed to use object properties
-        token_usage = {
-            'prompt_tokens': response.usage.prompt_tokens,
-            'completion_tokens': response.usage.completion_tokens,
-            'total_tokens': response.usage.total_tokens
-        }
+        # Older messages are represented by the rolling summary, if there is one
+        rolling_summary = conversation.get_rolling_summary() if conversation else None
         
-        self._log_token_usage(
-            feature='character_chat',
-            tokens_used=token_usage['total_tokens'],
-            character_id=character.id,
-            conversation_id=conversation_history[0].conversation.id if conversation_history else None
+        packed = pack_chat_context(
+            system_prompt=persona['system_prompt'],
+            system_prompt_tokens=persona['prompt_tokens'],
+            user_message=user_message,
+            history=conversation_history,
+            memories=persona['memories'],
+            summaries=[rolling_summary] if rolling_summary else [],
         )
         
-        # Update character's interaction records
-        character.record_interaction(token_usage['total_tokens'])
+        accessed_at = timezone.now()
+        for memory in packed['memories']:
+            memory.access(accessed_at)  # Mark memory as accessed
         
+        return packed['messages']
+    
+    def _estimate_token_usage(self, messages, completion_text):
+        """Rough token usage estimate (~4 characters per token) for when OpenAI reports none"""
+        prompt_tokens = sum(len(m['content']) for m in messages) // 4 + 1
+        completion_tokens = len(completion_text) // 4 + 1 if completion_text else 0
         return {
-            'response': response.choices[0].message.content,
-            'token_usage': token_usage,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
         }
     
-    def summarize_conversation(self, conversation, messages):
+    def summarize_conversation(self, conversation, messages, previous_summary=None):
         """
         Summarize a conversation segment
+        If previous_summary is given, it is folded into the new summary so one
+        summary keeps covering the whole conversation so far
         Returns the summary and token usage
         """
+        request = {
+            'messages': self._summary_messages(conversation, messages, previous_summary),
+            'temperature': 0.5,
+            'max_tokens': 500,
+        }
+        
+        # Re-summarizing the same message range is served from the cache
+        cache, cache_key = get_response_cache(), make_cache_key(model=primary_model('memory_summarization'), **request)
+        cached = cache.get(cache_key) if cache else None
+        if cached is not None:
+            return {
+                'summary': cached['summary'],
+                'token_usage': self._cached_token_usage(),
+            }
+        
+        self._throttle('memory_summarization')
+        with self._reserve_tokens(request['messages'], request['max_tokens']) as reservation:
+            # Get response from OpenAI
+            response = routed_chat_completion('memory_summarization', **request)
+            
+            # Log token usage - Fixed to use object properties
+            token_usage = self._usage_dict(response.usage)
+            
+            self._log_token_usage(
+                feature='memory_summarization',
+                tokens_used=token_usage['total_tokens'],
+                character_id=conversation.character_id,
+                conversation_id=conversation.id,
+                call_id=self._call_id(response),
+                reservation=reservation
+            )
+        
+        summary = response.choices[0].message.content
+        if cache:
+            cache.set(cache_key, {'summary': summary})
+        
+        return {
+            'summary': summary,
+            'token_usage': token_usage,
+        }
+    
+    def _summary_messages(self, conversation, messages, previous_summary=None):
+        """Build the chat messages for summarizing a conversation segment"""
         system_prompt = """You are a helpful assistant that summarizes conversations.
         Create a concise summary that captures the key points, decisions, and important 
         information from the conversation. Focus on what would be most relevant to remember 
         for future interactions."""
         
         # Build the conversation text
-        conversation_text = f"Conversation between User and {conversation.character.name}:\n\n"
+        conversation_text = ""
+        if previous_summary:
+            conversation_text += f"Summary of the conversation so far:\n{previous_summary}\n\nIt continues:\n\n"
+        conversation_text += f"Conversation between User and {conversation.character.name}:\n\n"
         
         for msg in messages:
             sender = "User" if msg.sender == "user" else conversation.character.name
@@ -198,52 +482,193 @@ class OpenAIService:
         and any important information revealed during this conversation segment.
         """
         
-        # Get response from OpenAI
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.5,
-            max_tokens=500
-        )
-        
-        # Log token usage - Fixed to use object properties
-        token_usage = {
-            'prompt_tokens': response.usage.prompt_tokens,
-            'completion_tokens': response.usage.completion_tokens,
-            'total_tokens': response.usage.total_tokens
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+    
+    def _cached_token_usage(self):
+        """Token usage reported for a cache hit - nothing was spent or charged"""
+        return {
+            'prompt_tokens': 0,
+            'completion_tokens': 0,
+            'total_tokens': 0,
+            'cached': True
         }
-        
-        self._log_token_usage(
-            feature='memory_summarization',
-            tokens_used=token_usage['total_tokens'],
-            character_id=conversation.character.id,
-            conversation_id=conversation.id
-        )
-        
+    
+    def _usage_dict(self, usage):
+        """Convert an OpenAI usage object to the token usage dict we pass around"""
         return {
-            'summary': response.choices[0].message.content,
-            'token_usage': token_usage,
+            'prompt_tokens': usage.prompt_tokens,
+            'completion_tokens': usage.completion_tokens,
+            'total_tokens': usage.total_tokens
         }
     
+    def _call_id(self, response):
+        """The upstream response (or chunk) id, which identifies the call in the usage ledger"""
+        return getattr(response, 'id', None)
+    
+    def _throttle(self, feature, cost=1):
+        """Count cost requests against the user's rate limit for feature; raises RateLimited if it is used up"""
+        check_rate_limit(self.user, feature, cost)
+    
+    def _reserve_tokens(self, messages, max_tokens):
+        """
+        Reserve the most a call can cost (its prompt plus max_tokens) against the
+        user's quota; raises QuotaExceeded if that doesn't fit
+        """
+        return reserve_tokens(self.user, count_message_tokens(messages) + max_tokens)
+    
     def _log_token_usage(self, feature, tokens_used, character_id=None, conversation_id=None, 
-                     story_id=None, world_id=None):
-        """Log token usage to the database"""
-        # Create token usage record
-        TokenUsage.objects.create(
-            user=self.user,
-            feature=feature,
-            tokens_used=tokens_used,
+                     story_id=None, world_id=None, call_id=None, reservation=None):
+        """
+        Charge token usage to the user and record it in the usage ledger
+        call_id is the upstream response id, if there is one; reservation is
+        the call's TokenReservation, settled by the charge
+        """
+        token_limit_obj = UserTokenLimit.objects.get(user=self.user)
+        token_limit_obj.update_token_usage(
+            tokens_used,
+            feature,
+            call_id=call_id,
+            reservation=reservation,
             character_id=character_id,
             conversation_id=conversation_id,
             story_id=story_id,
             world_id=world_id
         )
         
-        # Get the user's token limit object and update it
-        token_limit_obj = UserTokenLimit.objects.get(user=self.user)
-        token_limit_obj.update_token_usage(amount=tokens_used, feature=feature)
+        return tokens_used
+
+
+class AsyncOpenAIService(OpenAIService):
+    """
+    AsyncOpenAI-backed variant of OpenAIService for async views served through asgi.py.
+    Method names and return values match OpenAIService, but they are coroutines.
+    Prompt building, token reservations and token accounting touch the ORM,
+    so they run through sync_to_async; no row lock is held across the await.
+    """
+    
+    async def create_character(self, name, description, traits=None):
+        """
+        Create a new character using OpenAI
+        Returns character details and token usage
+        """
+        request = self._character_request(name, description, traits)
+        
+        cache, cache_key = get_response_cache(), make_cache_key(model=primary_model('character_creation'), **request)
+        cached = await cache.aget(cache_key) if cache else None
+        if cached is not None:
+            return {
+                'character_data': cached['character_data'],
+                'token_usage': self._cached_token_usage(),
+            }
+        
+        await sync_to_async(self._throttle)('character_creation')
+        async with await sync_to_async(self._reserve_tokens)(request['messages'], request['max_tokens']) as reservation:
+            response = await arouted_chat_completion('character_creation', **request)
+            
+            token_usage = self._usage_dict(response.usage)
+            
+            await self._alog_token_usage(
+                feature='character_creation',
+                tokens_used=token_usage['total_tokens'],
+                character_id=None,  # Will be updated after character creation
+                call_id=self._call_id(response),
+                reservation=reservation
+            )
+        
+        character_data = self._parse_character_data(response.choices[0].message.content)
+        if cache and 'error' not in character_data:
+            await cache.aset(cache_key, {'character_data': character_data})
+        
+        return {
+            'character_data': character_data,
+            'token_usage': token_usage,
+        }
+    
+    async def generate_character_response(self, character, conversation_history, user_message, conversation=None):
+        """
+        Generate a character's response to a user message
+        conversation_history is newest-first and is trimmed to the prompt budget
+        Returns the response and token usage
+        """
+        messages = await sync_to_async(self._build_character_messages)(
+            character, conversation_history, user_message, conversation
+        )
+        
+        await sync_to_async(self._throttle)('character_chat')
+        async with await sync_to_async(self._reserve_tokens)(messages, 800) as reservation:
+            response = await arouted_chat_completion(
+                'character_chat',
+                messages=messages,
+                temperature=0.8,
+                max_tokens=800
+            )
+            
+            token_usage = self._usage_dict(response.usage)
+            
+            await self._alog_token_usage(
+                feature='character_chat',
+                tokens_used=token_usage['total_tokens'],
+                character_id=character.id,
+                conversation_id=conversation.id if conversation else None,
+                call_id=self._call_id(response),
+                reservation=reservation
+            )
         
-        return tokens_used
\ No newline at end of file
+        # Update character's interaction records
+        await sync_to_async(character.record_interaction)(token_usage['total_tokens'])
+        
+        return {
+            'response': response.choices[0].message.content,
+            'token_usage': token_usage,
+        }
+    
+    async def summarize_conversation(self, conversation, messages, previous_summary=None):
+        """
+        Summarize a conversation segment
+        Returns the summary and token usage
+        """
+        request = {
+            'messages': await sync_to_async(self._summary_messages)(conversation, messages, previous_summary),
+            'temperature': 0.5,
+            'max_tokens': 500,
+        }
+        
+        cache, cache_key = get_response_cache(), make_cache_key(model=primary_model('memory_summarization'), **request)
+        cached = await cache.aget(cache_key) if cache else None
+        if cached is not None:
+            return {
+                'summary': cached['summary'],
+                'token_usage': self._cached_token_usage(),
+            }
+        
+        await sync_to_async(self._throttle)('memory_summarization')
+        async with await sync_to_async(self._reserve_tokens)(request['messages'], request['max_tokens']) as reservation:
+            response = await arouted_chat_completion('memory_summarization', **request)
+            
+            token_usage = self._usage_dict(response.usage)
+            
+            await self._alog_token_usage(
+                feature='memory_summarization',
+                tokens_used=token_usage['total_tokens'],
+                character_id=conversation.character_id,
+                conversation_id=conversation.id,
+                call_id=self._call_id(response),
+                reservation=reservation
+            )
+        
+        summary = response.choices[0].message.content
+        if cache:
+            await cache.aset(cache_key, {'summary': summary})
+        
+        return {
+            'summary': summary,
+            'token_usage': token_usage,
+        }
+    
+    async def _alog_token_usage(self, **kwargs):
+        """Log token usage from async code"""
+        # The accounting runs in one thread-sensitive call, exactly as in the sync service
+        return await sync_to_async(self._log_token_usage)(**kwargs)
@@ -0,0 +1,99 @@
+from django.conf import settings
+from django.core.cache import caches
+
+from core.services.context_packer import get_chat_context_settings
+from core.services.token_counter import count_tokens
+
+# Defaults for settings.PERSONA_CACHE; any key can be overridden there
+DEFAULT_PERSONA_CACHE_SETTINGS = {
+    'ENABLED': True,
+    # Django cache alias; entries are checked against the character's
+    # updated_at, so a per-process cache never serves a stale persona
+    'CACHE_ALIAS': 'default',
+    'TTL': 60 * 60,  # seconds
+}
+
+# Bump when the prompt template changes so stale entries are ignored
+PERSONA_CACHE_VERSION = 2
+
+# Saves that only touch these fields don't change the compiled persona
+CHARACTER_STATS_FIELDS = frozenset({
+    'total_interactions', 'avg_interaction_tokens', 'last_interaction', 'creation_token_cost', 'vector_id',
+})
+MEMORY_BOOKKEEPING_FIELDS = frozenset({'last_accessed', 'vector_id', 'embedding', 'token_count'})
+
+
+def get_persona_cache_settings():
+    """Return the persona cache settings merged over the defaults"""
+    conf = dict(DEFAULT_PERSONA_CACHE_SETTINGS)
+    conf.update(getattr(settings, 'PERSONA_CACHE', {}))
+    return conf
+
+
+def persona_cache_key(character_id):
+    return f"persona:v{PERSONA_CACHE_VERSION}:{character_id}"
+
+
+def build_system_prompt(character):
+    """The roleplay system prompt for a character"""
+    return f"""You are roleplaying as {character.name}. Here are details about your character:
+        
+        Background: {character.background_story}
+        
+        Voice: {character.voice}
+        
+        Traits: {', '.join(character.get_traits_list())}
+        
+        Always stay in character and respond as {character.name} would. Never break character
+        or acknowledge that you are an AI. Respond directly as the character would speak.
+        """
+
+
+def compile_persona(character):
+    """
+    Build the per-character part of a chat prompt
+    Returns a dict with the system prompt, its token count and the character's
+    most important active memories (CharacterMemory instances).
+    """
+    system_prompt = build_system_prompt(character)
+    return {
+        'system_prompt': system_prompt,
+        'prompt_tokens': count_tokens(system_prompt),
+        'memories': list(character.get_memory_objects()[:get_chat_context_settings()['MAX_MEMORIES']]),
+    }
+
+
+def persona_version(character):
+    """
+    The version of a character's persona: its updated_at
+    Memory changes bump it too (see characters.models), so a character loaded
+    after any change, in any process, carries a newer version.
+    """
+    return character.updated_at.isoformat() if character.updated_at else None
+
+
+def get_compiled_persona(character):
+    """
+    The compiled persona for a character, from the cache when possible
+    An entry compiled for another version of the character is rebuilt. The
+    signal handlers also drop entries outright, which spares this process
+    the rebuild check.
+    """
+    conf = get_persona_cache_settings()
+    if not conf['ENABLED']:
+        return compile_persona(character)
+
+    cache = caches[conf['CACHE_ALIAS']]
+    key = persona_cache_key(character.pk)
+    version = persona_version(character)
+    entry = cache.get(key)
+    if entry is None or entry['version'] != version:
+        entry = {'version': version, 'persona': compile_persona(character)}
+        cache.set(key, entry, conf['TTL'])
+    return entry['persona']
+
+
+def invalidate_persona(character_id):
+    """Drop a character's compiled persona so the next turn rebuilds it"""
+    conf = get_persona_cache_settings()
+    caches[conf['CACHE_ALIAS']].delete(persona_cache_key(character_id))
@@ -39,6 +39,19 @@ class PineconeService:
         
         return vector_id
     
+    def store_character_embeddings(self, characters):
+        """
+        Store embeddings for several characters in one batch
+        In a real implementation, this would embed all the texts in one
+        embeddings request and write them with a single Pinecone upsert
+        Returns the vector IDs, in the same order as the characters
+        """
+        vector_ids = [f"char-{uuid.uuid4()}" for _ in characters]
+        
+        print(f"Storing {len(vector_ids)} character embeddings in one batch")
+        
+        return vector_ids
+    
     def store_memory_embedding(self, memory):
         """
         Store memory embeddings in Pinecone
@@ -0,0 +1,163 @@
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Least
+from django.db.models.lookups import GreaterThanOrEqual
+from django.utils.module_loading import import_string
+
+# Defaults for settings.LLM_RATE_LIMIT; any key can be overridden there
+DEFAULT_RATE_LIMIT_SETTINGS = {
+    'ENABLED': True,
+    # The database backend shares buckets between processes; the in-process
+    # one only suits a single worker (e.g. runserver)
+    'BACKEND': 'core.services.rate_limiter.DatabaseTokenBucketBackend',
+    'OPTIONS': {},
+    # Bucket size (the burst a user can fire at once) and refill rate per
+    # subscription tier, for each feature separately
+    'TIERS': {
+        'free': {'CAPACITY': 5, 'PER_MINUTE': 10},
+        'basic': {'CAPACITY': 10, 'PER_MINUTE': 30},
+        'enterprise': {'CAPACITY': 30, 'PER_MINUTE': 120},
+    },
+    'DEFAULT_TIER': 'free',
+}
+
+
+class RateLimited(Exception):
+    """Raised when a user has made too many LLM requests for a feature; retry_after is in seconds"""
+
+    def __init__(self, feature, retry_after):
+        self.feature = feature
+        self.retry_after = retry_after
+        super().__init__(f"Too many requests. Please wait {retry_after} seconds and try again.")
+
+
+def get_rate_limit_settings():
+    """Return the rate limit settings merged over the defaults"""
+    conf = dict(DEFAULT_RATE_LIMIT_SETTINGS)
+    conf.update(getattr(settings, 'LLM_RATE_LIMIT', {}))
+    return conf
+
+
+class TokenBucketBackend:
+    """Base class for token bucket backends"""
+
+    def __init__(self, **options):
+        pass
+
+    def consume(self, key, capacity, rate, cost=1):
+        """
+        Take cost tokens from the bucket, which holds up to capacity and refills
+        at rate tokens a second. Returns 0 if they were taken, otherwise the
+        seconds until the bucket holds enough. A cost bigger than capacity is
+        taken from a full bucket and leaves it in debt, so it still pays in full.
+        """
+        raise NotImplementedError
+
+    def _needed(self, capacity, cost):
+        """Tokens the bucket must hold for cost to be taken"""
+        return min(cost, capacity)
+
+    def _wait(self, level, rate, needed):
+        return (needed - level) / rate
+
+
+class LocMemTokenBucketBackend(TokenBucketBackend):
+    """Buckets held in this process"""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, rate, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            level = min(capacity, tokens + (now - updated_at) * rate)
+            needed = self._needed(capacity, cost)
+            if level < needed:
+                return self._wait(level, rate, needed)
+            self._buckets[key] = (level - cost, now)
+            return 0
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class DatabaseTokenBucketBackend(TokenBucketBackend):
+    """
+    Buckets stored as RateLimitBucket rows, so every process shares them
+    The refill, the check and the take are one conditional UPDATE, so
+    concurrent requests can't take the same tokens and no row lock is held.
+    """
+
+    def consume(self, key, capacity, rate, cost=1):
+        from core.models import RateLimitBucket
+        now = time.time()
+        level = Least(
+            Value(float(capacity)),
+            F('tokens') + (Value(now) - F('updated_at')) * Value(float(rate)),
+            output_field=FloatField(),
+        )
+        needed = self._needed(capacity, cost)
+        taken = RateLimitBucket.objects.filter(
+            GreaterThanOrEqual(level, Value(float(needed))), key=key
+        ).update(tokens=level - cost, updated_at=now)
+        if taken:
+            return 0
+
+        bucket = RateLimitBucket.objects.filter(key=key).values('tokens', 'updated_at').first()
+        if bucket is None:
+            try:
+                RateLimitBucket.objects.create(key=key, tokens=capacity - cost, updated_at=now)
+                return 0
+            except IntegrityError:
+                # Another request created it first; take from that one
+                return self.consume(key, capacity, rate, cost)
+        return self._wait(min(capacity, bucket['tokens'] + (now - bucket['updated_at']) * rate), rate, needed)
+
+
+_backend = None
+_backend_conf = None
+_backend_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the configured token bucket backend, or None if rate limiting is disabled"""
+    global _backend, _backend_conf
+    conf = get_rate_limit_settings()
+    if not conf['ENABLED']:
+        return None
+
+    with _backend_lock:
+        # Rebuild if the settings changed (e.g. override_settings in tests)
+        if _backend is None or _backend_conf != (conf['BACKEND'], conf['OPTIONS']):
+            _backend = import_string(conf['BACKEND'])(**conf['OPTIONS'])
+            _backend_conf = (conf['BACKEND'], conf['OPTIONS'])
+        return _backend
+
+
+def check_rate_limit(user, feature, cost=1):
+    """
+    Take cost requests from the user's bucket for feature
+    Limits come from the user's subscription_tier; staff aren't limited.
+    Raises RateLimited, with the seconds to wait, if the bucket is empty.
+    """
+    limiter = get_rate_limiter()
+    if limiter is None or user.is_staff:
+        return
+
+    conf = get_rate_limit_settings()
+    tier = conf['TIERS'].get(getattr(user, 'subscription_tier', None)) or conf['TIERS'][conf['DEFAULT_TIER']]
+    capacity, rate = tier['CAPACITY'], tier['PER_MINUTE'] / 60
+    # A request bigger than the bucket (e.g. a large batch) waits for a full bucket
+    # and then leaves it in debt, so later requests wait until it is paid off
+    wait = limiter.consume(f"llm:{user.pk}:{feature}", capacity, rate, cost)
+    if wait:
+        raise RateLimited(feature, max(1, math.ceil(wait)))
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+# Defaults for settings.LLM_RESPONSE_CACHE; any key can be overridden there
+DEFAULT_RESPONSE_CACHE_SETTINGS = {
+    'ENABLED': True,
+    'BACKEND': 'core.services.response_cache.LocMemLRUBackend',
+    'TTL': 60 * 60,
+    'MAX_ENTRIES': 1024,
+    'OPTIONS': {},
+}
+
+
+def make_cache_key(model, messages, temperature, max_tokens):
+    """
+    Content-addressed key for a deterministic completion request
+    Message content is whitespace-normalized, so prompts that differ only in
+    indentation or line wrapping share an entry.
+    """
+    payload = json.dumps({
+        'model': model,
+        'messages': [
+            {'role': m['role'], 'content': ' '.join(m['content'].split())}
+            for m in messages
+        ],
+        'temperature': temperature,
+        'max_tokens': max_tokens,
+    }, sort_keys=True, separators=(',', ':'))
+    return 'llm-response:' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCacheBackend:
+    """Base class for response cache backends"""
+
+    def __init__(self, ttl, max_entries, **options):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    async def aget(self, key):
+        return await sync_to_async(self.get)(key)
+
+    async def aset(self, key, value):
+        return await sync_to_async(self.set)(key, value)
+
+
+class LocMemLRUBackend(ResponseCacheBackend):
+    """In-process cache with per-entry TTL and least-recently-used eviction"""
+
+    def __init__(self, ttl, max_entries, **options):
+        super().__init__(ttl, max_entries, **options)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value):
+        return self.set(key, value)
+
+
+class DjangoCacheBackend(ResponseCacheBackend):
+    """
+    Stores responses in one of the Django CACHES, so they are shared between processes
+    Eviction is left to the cache itself (e.g. Redis' allkeys-lru policy).
+    """
+
+    def __init__(self, ttl, max_entries, alias='default', **options):
+        super().__init__(ttl, max_entries, **options)
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, timeout=self.ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+    async def aget(self, key):
+        return await self.cache.aget(key)
+
+    async def aset(self, key, value):
+        await self.cache.aset(key, value, timeout=self.ttl)
+
+
+_backend = None
+_backend_conf = None
+_backend_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the configured response cache backend, or None if caching is disabled"""
+    global _backend, _backend_conf
+    conf = dict(DEFAULT_RESPONSE_CACHE_SETTINGS)
+    conf.update(getattr(settings, 'LLM_RESPONSE_CACHE', {}))
+    if not conf['ENABLED']:
+        return None
+
+    with _backend_lock:
+        # Rebuild if the settings changed (e.g. override_settings in tests)
+        if _backend is None or _backend_conf != conf:
+            backend_class = import_string(conf['BACKEND'])
+            _backend = backend_class(ttl=conf['TTL'], max_entries=conf['MAX_ENTRIES'], **conf['OPTIONS'])
+            _backend_conf = conf
+        return _backend
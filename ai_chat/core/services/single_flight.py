@@ -0,0 +1,77 @@
+import threading
+
+from asgiref.sync import sync_to_async
+
+
+class _Call:
+    """An in-flight call that followers wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls that share a key into one execution
+    The first caller for a key runs the function; callers arriving while it is
+    running wait and get the same result (or exception). Coalescing is per process,
+    across sync (do) and async (ado) callers alike.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout=None):
+        """Run func() once for concurrent callers with this key; returns (result, shared)"""
+        call, leader = self._join(key)
+        if not leader:
+            return self._shared_result(call, call.done.wait(timeout)), True
+
+        try:
+            call.result = func()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            self._leave(key, call)
+
+    async def ado(self, key, func, timeout=None):
+        """Async do(): func is a coroutine function, and waiting doesn't block the event loop"""
+        call, leader = self._join(key)
+        if not leader:
+            finished = await sync_to_async(call.done.wait, thread_sensitive=False)(timeout)
+            return self._shared_result(call, finished), True
+
+        try:
+            call.result = await func()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            self._leave(key, call)
+
+    def _join(self, key):
+        """The call in flight for key and whether this caller leads it"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        return call, leader
+
+    def _leave(self, key, call):
+        with self._lock:
+            del self._calls[key]
+        call.done.set()
+
+    def _shared_result(self, call, finished):
+        if not finished:
+            raise TimeoutError("Timed out waiting for an identical request to finish")
+        if call.error is not None:
+            raise call.error
+        return call.result
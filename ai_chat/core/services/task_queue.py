@@ -0,0 +1,160 @@
+import random
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from core.models import BackgroundTask
+
+# Defaults for settings.TASK_QUEUE; any key can be overridden there
+DEFAULT_TASK_QUEUE_SETTINGS = {
+    # Run tasks inline when they are queued (development and tests)
+    'EAGER': False,
+    'MAX_ATTEMPTS': 3,
+    # Retry delay in seconds, doubled per attempt and capped at RETRY_DELAY_MAX
+    'RETRY_DELAY': 30,
+    'RETRY_DELAY_MAX': 60 * 60,
+    # Running tasks whose worker hasn't finished them in this many seconds are
+    # assumed lost (e.g. the worker was killed) and are picked up again
+    'LEASE_TIMEOUT': 10 * 60,
+    'KEEP_SUCCEEDED': False,
+    # run_tasks worker defaults
+    'WORKERS': 4,
+    'POLL_INTERVAL': 1.0,
+}
+
+ACTIVE_STATUSES = ('pending', 'running')
+
+_registry = {}
+
+
+def get_task_queue_settings():
+    """Return the task queue settings merged over the defaults"""
+    conf = dict(DEFAULT_TASK_QUEUE_SETTINGS)
+    conf.update(getattr(settings, 'TASK_QUEUE', {}))
+    return conf
+
+
+def task(func=None, *, name=None, max_attempts=None):
+    """
+    Register a function as a background task
+    The function gets a .delay(*args, **kwargs) shortcut for enqueue(). Arguments
+    are stored as JSON, so pass ids rather than model instances.
+    """
+    def register(func):
+        task_name = name or f"{func.__module__}.{func.__name__}"
+        _registry[task_name] = func
+        func.task_name = task_name
+        func.max_attempts = max_attempts
+        func.delay = lambda *args, **kwargs: enqueue(func, args=args, kwargs=kwargs)
+        return func
+
+    return register(func) if func is not None else register
+
+
+def enqueue(func, args=(), kwargs=None, unique_key='', delay=0):
+    """
+    Queue a registered task to run in the worker
+    With a unique_key, nothing is queued while a task with that key is still
+    pending or running. Returns the BackgroundTask, or None if it ran eagerly
+    or was deduplicated.
+    """
+    conf = get_task_queue_settings()
+    kwargs = kwargs or {}
+
+    if conf['EAGER']:
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            print(f"Error running task {func.task_name}: {str(e)}")
+        return None
+
+    if unique_key and BackgroundTask.objects.filter(unique_key=unique_key, status__in=ACTIVE_STATUSES).exists():
+        return None
+
+    return BackgroundTask.objects.create(
+        name=func.task_name,
+        args=list(args),
+        kwargs=kwargs,
+        unique_key=unique_key,
+        max_attempts=func.max_attempts or conf['MAX_ATTEMPTS'],
+        run_at=timezone.now() + timedelta(seconds=delay),
+    )
+
+
+def claim_tasks(limit):
+    """
+    Claim up to limit due tasks for this worker and return their ids
+    Claims are conditional updates, so several worker processes can share the queue.
+    """
+    conf = get_task_queue_settings()
+    now = timezone.now()
+
+    # Tasks abandoned by a dead worker go back in the queue
+    BackgroundTask.objects.filter(
+        status='running', locked_at__lt=now - timedelta(seconds=conf['LEASE_TIMEOUT'])
+    ).update(status='pending', locked_at=None)
+
+    candidates = BackgroundTask.objects.filter(
+        status='pending', run_at__lte=now
+    ).order_by('run_at').values_list('pk', flat=True)[:limit]
+
+    claimed = []
+    for pk in candidates:
+        updated = BackgroundTask.objects.filter(pk=pk, status='pending').update(
+            status='running', locked_at=now, attempts=F('attempts') + 1
+        )
+        if updated:
+            claimed.append(pk)
+    return claimed
+
+
+def run_task(task_id):
+    """
+    Run a claimed task
+    Failures are retried with exponential backoff; once a task is out of
+    attempts it is marked dead and kept, with its traceback, for inspection.
+    Returns True if the task succeeded.
+    """
+    conf = get_task_queue_settings()
+    background_task = BackgroundTask.objects.get(pk=task_id)
+    try:
+        func = _registry.get(background_task.name)
+        if func is None:
+            raise LookupError(f"No task registered as {background_task.name}")
+        func(*background_task.args, **background_task.kwargs)
+    except Exception as e:
+        background_task.last_error = traceback.format_exc()
+        background_task.locked_at = None
+        if background_task.attempts >= background_task.max_attempts:
+            background_task.status = 'dead'
+            print(f"Task {background_task.name} ({background_task.pk}) failed for good: {str(e)}")
+        else:
+            background_task.status = 'pending'
+            background_task.run_at = timezone.now() + timedelta(seconds=_retry_delay(background_task.attempts, conf))
+        background_task.save(update_fields=['status', 'run_at', 'locked_at', 'last_error'])
+        return False
+
+    if conf['KEEP_SUCCEEDED']:
+        background_task.status = 'succeeded'
+        background_task.completed_at = timezone.now()
+        background_task.locked_at = None
+        background_task.save(update_fields=['status', 'completed_at', 'locked_at'])
+    else:
+        background_task.delete()
+    return True
+
+
+def retry_dead_tasks(queryset):
+    """Put dead tasks back in the queue with a fresh set of attempts"""
+    return queryset.filter(status='dead').update(
+        status='pending', attempts=0, run_at=timezone.now(), locked_at=None
+    )
+
+
+def _retry_delay(attempts, conf):
+    """Exponential backoff with jitter, so failing tasks don't retry in lockstep"""
+    delay = min(conf['RETRY_DELAY_MAX'], conf['RETRY_DELAY'] * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
@@ -0,0 +1,51 @@
+from functools import lru_cache
+
+# tiktoken is optional; without it (or without its cached encoding files)
+# we fall back to a character/word heuristic that slightly over-counts
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Chat format framing: each message costs a few tokens on top of its content,
+# and the reply is primed with a few more
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMER_TOKENS = 3
+
+DEFAULT_MODEL = 'gpt-3.5-turbo'
+
+
+def count_tokens(text, model=DEFAULT_MODEL):
+    """Count the tokens in a piece of text without calling the API"""
+    if not text:
+        return 0
+
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+
+    # English averages ~4 characters or ~0.75 words per token; take the larger
+    return max(1, round(max(len(text) / 4, len(text.split()) * 4 / 3)))
+
+
+def count_message_tokens(messages, model=DEFAULT_MODEL):
+    """Count the prompt tokens for a list of chat messages"""
+    return sum(
+        MESSAGE_OVERHEAD_TOKENS + count_tokens(message['content'], model)
+        for message in messages
+    ) + REPLY_PRIMER_TOKENS
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model):
+    """Load the tiktoken encoding for a model, or None if unavailable offline"""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        # Encoding files are downloaded on first use; no network means no tiktoken
+        return None
@@ -0,0 +1,220 @@
+import contextvars
+import threading
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+
+# Defaults for settings.WRITE_BEHIND; any key can be overridden there
+DEFAULT_WRITE_BEHIND_SETTINGS = {
+    'ENABLED': True,
+    # Flush on a background thread instead of at the end of the request
+    'FLUSH_IN_BACKGROUND': False,
+}
+
+_current_buffer = contextvars.ContextVar('write_behind_buffer', default=None)
+
+
+def get_write_behind_settings():
+    """Return the write-behind settings merged over the defaults"""
+    conf = dict(DEFAULT_WRITE_BEHIND_SETTINGS)
+    conf.update(getattr(settings, 'WRITE_BEHIND', {}))
+    return conf
+
+
+class WriteBuffer:
+    """
+    Pending bookkeeping writes for one request
+    Counter increments and field updates are coalesced per row, inserts are
+    batched per model, and everything is written in a single transaction.
+    """
+
+    def __init__(self):
+        self.rows = {}  # (model, pk) -> {'increments': {...}, 'values': {...}}
+        self.inserts = defaultdict(list)
+        self.upserts = {}  # (model, lookup items) -> increments
+        self.callbacks = {}
+
+    def __bool__(self):
+        return bool(self.rows or self.inserts or self.upserts or self.callbacks)
+
+    def row(self, model, pk):
+        return self.rows.setdefault((model, pk), {'increments': {}, 'values': {}})
+
+    def flush(self):
+        """Write everything out; callbacks run after the transaction commits"""
+        rows, inserts, upserts, callbacks = self.rows, self.inserts, self.upserts, self.callbacks
+        self.rows, self.inserts, self.upserts, self.callbacks = {}, defaultdict(list), {}, {}
+
+        # Rows that get the same change (e.g. several memories marked accessed
+        # at once) share one UPDATE
+        updates = defaultdict(list)
+        for (model, pk), changes in rows.items():
+            key = (
+                model,
+                tuple(sorted(changes['increments'].items())),
+                tuple(sorted(changes['values'].items())),
+            )
+            updates[key].append(pk)
+
+        with transaction.atomic():
+            for (model, increments, values), pks in updates.items():
+                fields = {field: F(field) + delta for field, delta in increments}
+                fields.update(values)
+                model.objects.filter(pk__in=pks).update(**fields)
+            for model, objs in inserts.items():
+                model.objects.bulk_create(objs)
+            for (model, lookup), increments in upserts.items():
+                _apply_upsert(model, dict(lookup), increments)
+
+        for callback in callbacks.values():
+            callback()
+
+
+@contextmanager
+def write_behind():
+    """
+    Buffer bookkeeping writes made inside the block and flush them on exit
+    Nested blocks join the outer buffer. Does nothing if WRITE_BEHIND is disabled.
+    """
+    buffer, token = _start_buffer()
+    try:
+        yield buffer
+    finally:
+        if token is not None:
+            _current_buffer.reset(token)
+            if buffer:
+                flush_buffer(buffer)
+
+
+@asynccontextmanager
+async def awrite_behind():
+    """Async version of write_behind; the flush runs in a worker thread"""
+    buffer, token = _start_buffer()
+    try:
+        yield buffer
+    finally:
+        if token is not None:
+            _current_buffer.reset(token)
+            if buffer:
+                await sync_to_async(flush_buffer)(buffer)
+
+
+@contextmanager
+def separate_buffer():
+    """
+    Buffer the block's writes apart from any request buffer and flush them on exit
+    The flush runs in this thread, so errors reach the caller; nothing is
+    written if the block raises.
+    """
+    buffer = WriteBuffer()
+    token = _current_buffer.set(buffer)
+    try:
+        yield buffer
+    finally:
+        _current_buffer.reset(token)
+    buffer.flush()
+
+
+def _start_buffer():
+    """Install a new buffer, unless one is already active or buffering is disabled"""
+    current = _current_buffer.get()
+    if current is not None or not get_write_behind_settings()['ENABLED']:
+        return current, None
+    buffer = WriteBuffer()
+    return buffer, _current_buffer.set(buffer)
+
+
+def flush_buffer(buffer):
+    """Flush a buffer now, or hand it to a background thread if configured to"""
+    if get_write_behind_settings()['FLUSH_IN_BACKGROUND']:
+        threading.Thread(target=_flush_in_thread, args=(buffer,), daemon=True).start()
+    else:
+        buffer.flush()
+
+
+def _flush_in_thread(buffer):
+    """Thread entry point; errors are logged, not raised, since nobody is waiting"""
+    try:
+        buffer.flush()
+    except Exception as e:
+        print(f"Error flushing write-behind buffer: {str(e)}")
+    finally:
+        close_old_connections()
+
+
+def increment(instance, **deltas):
+    """Add to counter fields of a saved instance with F() increments"""
+    buffer = _current_buffer.get()
+    if buffer is None:
+        type(instance).objects.filter(pk=instance.pk).update(
+            **{field: F(field) + delta for field, delta in deltas.items()}
+        )
+        return
+
+    increments = buffer.row(type(instance), instance.pk)['increments']
+    for field, delta in deltas.items():
+        increments[field] = increments.get(field, 0) + delta
+
+
+def update(instance, **values):
+    """Set fields of a saved instance; the last value buffered for a field wins"""
+    buffer = _current_buffer.get()
+    if buffer is None:
+        type(instance).objects.filter(pk=instance.pk).update(**values)
+        return
+
+    buffer.row(type(instance), instance.pk)['values'].update(values)
+
+
+def create(instance):
+    """Insert an unsaved instance (bulk-created with others of its model on flush)"""
+    buffer = _current_buffer.get()
+    if buffer is None:
+        instance.save()
+        return
+
+    buffer.inserts[type(instance)].append(instance)
+
+
+def upsert_increment(model, lookup, **deltas):
+    """
+    Add to counter fields of the row matching lookup, creating the row if needed
+    Used for rollup tables; buffered increments to the same row are summed.
+    """
+    buffer = _current_buffer.get()
+    if buffer is None:
+        _apply_upsert(model, lookup, deltas)
+        return
+
+    increments = buffer.upserts.setdefault((model, tuple(sorted(lookup.items()))), {})
+    for field, delta in deltas.items():
+        increments[field] = increments.get(field, 0) + delta
+
+
+def _apply_upsert(model, lookup, increments):
+    """Increment the matching row, or insert it; a concurrent insert falls back to the increment"""
+    fields = {field: F(field) + delta for field, delta in increments.items()}
+    if model.objects.filter(**lookup).update(**fields):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **increments)
+    except IntegrityError:
+        model.objects.filter(**lookup).update(**fields)
+
+
+def on_flush(callback, key=None):
+    """
+    Run a callback once the buffered writes are in the database
+    Callbacks registered under the same key run once per flush.
+    """
+    buffer = _current_buffer.get()
+    if buffer is None:
+        callback()
+        return
+
+    buffer.callbacks[key if key is not None else object()] = callback
@@ -1,3 +1,525 @@
-from django.test import TestCase
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from openai import BadRequestError, InternalServerError, RateLimitError
+
+from characters.models import Character, CharacterMemory
+from conversations.models import Conversation
+from core.services import llm_client, model_router
+from core.services.openai_service import OpenAIService
+from core.services.persona_cache import get_compiled_persona, persona_cache_key
+from core.services.rate_limiter import (
+    DatabaseTokenBucketBackend, LocMemTokenBucketBackend, RateLimited, check_rate_limit
+)
+from core.models import BackgroundTask, RateLimitBucket
+from core.services.response_cache import LocMemLRUBackend, make_cache_key
+from core.services.single_flight import SingleFlight
+from core.services.task_queue import claim_tasks, enqueue, retry_dead_tasks, run_task, task
+from core.services.write_behind import write_behind
+from token_management.models import TokenUsage, UserTokenLimit
+
+User = get_user_model()
+
+
+@task(max_attempts=2)
+def failing_task(message):
+    """Test task that always fails"""
+    raise RuntimeError(message)
+
+
+def _api_error(error_class, status_code):
+    """Build an OpenAI API error for the given status code"""
+    response = httpx.Response(status_code, request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+    return error_class('upstream error', response=response, body=None)
+
+
+@override_settings(LLM_CLIENT={'MAX_RETRIES': 2, 'TIMEOUTS': {'character_chat': 7}})
+class LLMClientTests(TestCase):
+    """Test cases for the resilient LLM client layer"""
+
+    def setUp(self):
+        patcher = mock.patch('core.services.llm_client.get_client')
+        self.create = patcher.start().return_value.chat.completions.create
+        self.addCleanup(patcher.stop)
+        sleep_patcher = mock.patch('core.services.llm_client.time.sleep')
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def test_retries_rate_limits_then_succeeds(self):
+        """429 responses are retried with backoff"""
+        self.create.side_effect = [_api_error(RateLimitError, 429), 'completion']
+
+        self.assertEqual(llm_client.create_chat_completion('character_chat', model='gpt-3.5-turbo'), 'completion')
+        self.assertEqual(self.create.call_count, 2)
+        self.sleep.assert_called_once()
+        self.assertEqual(self.create.call_args.kwargs['timeout'].read, 7)
+
+    def test_gives_up_after_max_retries(self):
+        """Retries stop after MAX_RETRIES and the last error is raised"""
+        self.create.side_effect = _api_error(RateLimitError, 429)
+
+        with self.assertRaises(RateLimitError):
+            llm_client.create_chat_completion('character_chat', model='gpt-3.5-turbo')
+        self.assertEqual(self.create.call_count, 3)
+
+    def test_client_errors_are_not_retried(self):
+        """4xx errors other than 429 fail immediately"""
+        self.create.side_effect = _api_error(BadRequestError, 400)
+
+        with self.assertRaises(BadRequestError):
+            llm_client.create_chat_completion('character_chat', model='gpt-3.5-turbo')
+        self.assertEqual(self.create.call_count, 1)
+        self.sleep.assert_not_called()
+
+
+@override_settings(LLM_CLIENT={'BACKEND': 'fake', 'FAKE': {'LATENCY': 0, 'JITTER': 0, 'CHUNK_INTERVAL': 0}})
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class FakeLLMBackendTests(TestCase):
+    """Test cases for the offline fake LLM backend"""
+
+    def test_replies_are_deterministic_with_usage(self):
+        """The same request always gets the same reply and token usage"""
+        messages = [{'role': 'user', 'content': 'Hello there'}]
+        first = llm_client.create_chat_completion('character_chat', model='gpt-3.5-turbo', messages=messages)
+        second = llm_client.create_chat_completion('character_chat', model='gpt-3.5-turbo', messages=messages)
+
+        self.assertEqual(first.choices[0].message.content, second.choices[0].message.content)
+        self.assertEqual(first.usage.total_tokens, second.usage.total_tokens)
+        self.assertEqual(first.usage.total_tokens, first.usage.prompt_tokens + first.usage.completion_tokens)
+
+    def test_chat_and_character_creation_work_end_to_end(self):
+        """Service methods run against the fake backend, including JSON parsing and streaming"""
+        user = User.objects.create_user(username='offline', password='testpassword123')
+        character = Character.objects.create(user=user, name='Ada', description='A mathematician')
+        service = OpenAIService(user)
+
+        created = service.create_character('Nemo', 'A captain', ['calm'])
+        self.assertIn('background_story', created['character_data'])
+
+        streamed = ''.join(service.stream_character_response(character, [], 'Hello'))
+        reply = service.generate_character_response(character, [], 'Hello')
+        self.assertEqual(streamed, reply['response'])
+
+    def test_async_client_streams(self):
+        """The async fake streams the same chunks as the sync one, usage last"""
+        messages = [{'role': 'user', 'content': 'Hello there'}]
+        sync_chunks = list(llm_client.get_client().chat.completions.create(
+            model='gpt-3.5-turbo', messages=messages, stream=True, stream_options={'include_usage': True}
+        ))
+
+        async def read():
+            stream = await llm_client.get_async_client().chat.completions.create(
+                model='gpt-3.5-turbo', messages=messages, stream=True, stream_options={'include_usage': True}
+            )
+            chunks = [chunk async for chunk in stream]
+            await stream.close()
+            return chunks
+
+        async_chunks = asyncio.run(read())
+        text = ''.join(chunk.choices[0].delta.content or '' for chunk in async_chunks if chunk.choices)
+        self.assertEqual(text, ''.join(chunk.choices[0].delta.content or '' for chunk in sync_chunks if chunk.choices))
+        self.assertEqual(async_chunks[-1].usage.total_tokens, sync_chunks[-1].usage.total_tokens)
+
+
+@override_settings(
+    LLM_MODEL_ROUTES={'character_chat': [
+        {'model': 'primary', 'latency_target': 1},
+        {'model': 'fallback', 'latency_target': 1},
+    ]},
+    LLM_ROUTER={'MIN_SAMPLES': 2, 'COOLDOWN': 60},
+)
+class ModelRouterTests(TestCase):
+    """Test cases for per-feature model routing and failover"""
+
+    def setUp(self):
+        model_router._health.clear()
+        self.addCleanup(model_router._health.clear)
+        patcher = mock.patch('core.services.model_router.create_chat_completion')
+        self.create = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fails_over_when_primary_errors(self):
+        """An upstream error on the primary model moves the call to the next model without retrying"""
+        self.create.side_effect = [_api_error(InternalServerError, 500), 'fallback completion']
+
+        self.assertEqual(model_router.routed_chat_completion('character_chat', messages=[]), 'fallback completion')
+        first, second = self.create.call_args_list
+        self.assertEqual((first.kwargs['model'], first.kwargs['max_retries']), ('primary', 0))
+        self.assertEqual(second.kwargs['model'], 'fallback')
+        self.assertNotIn('max_retries', second.kwargs)
+
+    def test_request_errors_do_not_fail_over(self):
+        """Errors caused by the request itself are raised, not retried on another model"""
+        self.create.side_effect = _api_error(BadRequestError, 400)
+
+        with self.assertRaises(BadRequestError):
+            model_router.routed_chat_completion('character_chat', messages=[])
+        self.assertEqual(self.create.call_count, 1)
+
+    def test_slow_primary_is_skipped_until_cooldown(self):
+        """A model that misses its latency target is routed around, then tried again later"""
+        clock = [0.0]
+
+        def slow_completion(feature, **kwargs):
+            clock[0] += 5  # Well over the 1 second target
+            return 'completion'
+
+        self.create.side_effect = slow_completion
+        with mock.patch('core.services.model_router.time.monotonic', side_effect=lambda: clock[0]):
+            model_router.routed_chat_completion('character_chat', messages=[])
+            model_router.routed_chat_completion('character_chat', messages=[])
+
+            self.assertEqual(
+                [route['model'] for route in model_router.candidate_routes('character_chat')],
+                ['fallback', 'primary']
+            )
+            clock[0] += 60
+            self.assertEqual(model_router.candidate_routes('character_chat')[0]['model'], 'primary')
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class ResponseCacheTests(TestCase):
+    """Test cases for the LLM response cache"""
+
+    def test_key_ignores_whitespace_but_not_parameters(self):
+        """Keys are stable across formatting but change with request parameters"""
+        messages = [{'role': 'user', 'content': 'Summarize   this\n  please'}]
+        same = [{'role': 'user', 'content': 'Summarize this please'}]
+
+        self.assertEqual(make_cache_key('gpt-4', messages, 0.7, 100), make_cache_key('gpt-4', same, 0.7, 100))
+        self.assertNotEqual(make_cache_key('gpt-4', messages, 0.7, 100), make_cache_key('gpt-4', messages, 0.8, 100))
+
+    def test_lru_eviction_and_ttl(self):
+        """The least recently used entry is evicted, and expired entries are dropped"""
+        cache = LocMemLRUBackend(ttl=60, max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+        with mock.patch('core.services.response_cache.time.monotonic', return_value=10 ** 9):
+            self.assertIsNone(cache.get('c'))
+
+    @override_settings(LLM_RESPONSE_CACHE={'ENABLED': True, 'MAX_ENTRIES': 10})
+    def test_cache_hit_skips_upstream_call_and_charge(self):
+        """A repeated character generation is neither sent upstream nor charged again"""
+        user = User.objects.create_user(username='cacher', password='testpassword123')
+        completion = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='{"background_story": "Born at sea"}'))],
+            usage=SimpleNamespace(prompt_tokens=100, completion_tokens=50, total_tokens=150),
+        )
+        service = OpenAIService(user)
+
+        with mock.patch('core.services.model_router.create_chat_completion', return_value=completion) as create:
+            first = service.create_character('Nemo', 'A captain', ['calm'])
+            second = service.create_character('Nemo', 'A captain', ['calm'])
+
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(second['character_data'], first['character_data'])
+        self.assertTrue(second['token_usage']['cached'])
+        self.assertEqual(UserTokenLimit.objects.get(user=user).current_usage, 150)
+
+    @override_settings(LLM_RESPONSE_CACHE={'ENABLED': True, 'MAX_ENTRIES': 10})
+    def test_cache_hit_skips_rate_limit_and_quota(self):
+        """A cached character is returned even to a user who is out of quota"""
+        user = User.objects.create_user(username='out_of_quota', password='testpassword123')
+        completion = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content='{"background_story": "Born at sea"}'))],
+            usage=SimpleNamespace(prompt_tokens=100, completion_tokens=50, total_tokens=150),
+        )
+        service = OpenAIService(user)
+        with mock.patch('core.services.model_router.create_chat_completion', return_value=completion):
+            service.create_character('Ahab', 'A whaler', ['driven'])
+        UserTokenLimit.objects.filter(user=user).update(monthly_limit=150)
+
+        with mock.patch('core.services.openai_service.check_rate_limit') as check, \
+                mock.patch('core.services.model_router.create_chat_completion') as create:
+            result = service.create_character('Ahab', 'A whaler', ['driven'])
+
+        self.assertTrue(result['token_usage']['cached'])
+        check.assert_not_called()
+        create.assert_not_called()
+        self.assertEqual(UserTokenLimit.objects.get(user=user).reserved_tokens, 0)
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class WriteBehindTests(TestCase):
+    """Test cases for the per-request write-behind buffer"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='buffered', password='testpassword123')
+        self.character = Character.objects.create(user=self.user, name='Ada', description='A mathematician')
+        self.conversation = Conversation.objects.create(user=self.user, character=self.character)
+
+    def test_writes_are_deferred_and_coalesced(self):
+        """Increments and inserts are held until the block exits, then written together"""
+        with write_behind():
+            self.conversation.add_tokens(100)
+            self.conversation.add_tokens(50)
+            OpenAIService(self.user)._log_token_usage('character_chat', 150, conversation_id=self.conversation.id)
+
+            self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).total_tokens, 0)
+            self.assertEqual(UserTokenLimit.objects.get(user=self.user).current_usage, 0)
+            # Usage ledger rows are written by the ledger itself, outside the request's buffer
+            self.assertEqual(TokenUsage.objects.filter(user=self.user).count(), 1)
+
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).total_tokens, 150)
+        self.assertEqual(UserTokenLimit.objects.get(user=self.user).current_usage, 150)
+        self.assertEqual(TokenUsage.objects.filter(user=self.user).count(), 1)
+
+    def test_identical_updates_share_one_statement(self):
+        """Memories accessed together are marked in a single UPDATE"""
+        memories = [
+            CharacterMemory.objects.create(character=self.character, content=f'Memory {i}', importance_score=0.5)
+            for i in range(3)
+        ]
+        accessed_at = timezone.now()
+
+        with CaptureQueriesContext(connection) as queries:
+            with write_behind():
+                for memory in memories:
+                    memory.access(accessed_at)
+
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(CharacterMemory.objects.filter(last_accessed=accessed_at).count(), 3)
+
+    def test_writes_go_straight_through_without_a_buffer(self):
+        """Outside a write_behind block changes are written immediately"""
+        self.character.record_interaction(40)
+        self.character.record_interaction(20)
+
+        self.character.refresh_from_db()
+        self.assertEqual(self.character.total_interactions, 2)
+        self.assertEqual(self.character.avg_interaction_tokens, 30)
+
+
+class PersonaCacheTests(TestCase):
+    """Test cases for the compiled persona cache"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='persona', password='testpassword123')
+        self.character = Character.objects.create(
+            user=self.user, name='Ada', description='A mathematician', traits=['curious', 'precise']
+        )
+        self.memory = CharacterMemory.objects.create(character=self.character, content='Met Babbage', importance_score=0.5)
+
+    def test_persona_is_compiled_once(self):
+        persona = get_compiled_persona(self.character)
+        self.assertIn('roleplaying as Ada', persona['system_prompt'])
+        self.assertIn('curious, precise', persona['system_prompt'])
+        self.assertEqual([memory.pk for memory in persona['memories']], [self.memory.pk])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_compiled_persona(self.character), persona)
+
+    def test_saves_invalidate_persona(self):
+        get_compiled_persona(self.character)
+
+        self.character.name = 'Augusta'
+        self.character.save()
+        self.assertIn('roleplaying as Augusta', get_compiled_persona(self.character)['system_prompt'])
+
+        newer = CharacterMemory.objects.create(character=self.character, content='Wrote the notes', importance_score=0.9)
+        self.assertEqual([memory.pk for memory in get_compiled_persona(self.character)['memories']], [newer.pk, self.memory.pk])
+
+        newer.delete()
+        self.assertEqual([memory.pk for memory in get_compiled_persona(self.character)['memories']], [self.memory.pk])
+
+    def test_changes_from_another_process_are_picked_up(self):
+        """A cached entry the signals never reached is rebuilt for a newer character"""
+        get_compiled_persona(self.character)
+        stale = cache.get(persona_cache_key(self.character.pk))
+
+        newer = CharacterMemory.objects.create(character=self.character, content='Wrote the notes', importance_score=0.9)
+        # What a web process still holds after a worker wrote the memory
+        cache.set(persona_cache_key(self.character.pk), stale)
+
+        character = Character.objects.get(pk=self.character.pk)
+        self.assertEqual([memory.pk for memory in get_compiled_persona(character)['memories']], [newer.pk, self.memory.pk])
+
+    def test_bookkeeping_saves_keep_persona(self):
+        get_compiled_persona(self.character)
+
+        self.character.total_interactions = 3
+        self.character.save(update_fields=['total_interactions'])
+        self.memory.last_accessed = timezone.now()
+        self.memory.save(update_fields=['last_accessed'])
+
+        with self.assertNumQueries(0):
+            get_compiled_persona(self.character)
+
+
+class TaskQueueTests(TestCase):
+    """Test cases for the database-backed task queue"""
+
+    def _claim_and_run(self):
+        BackgroundTask.objects.filter(status='pending').update(run_at=timezone.now())
+        return [run_task(task_id) for task_id in claim_tasks(10)]
+
+    def test_failures_are_retried_then_dead_lettered(self):
+        """A failing task is retried with backoff, then kept as dead"""
+        queued = enqueue(failing_task, args=('boom',))
+
+        self.assertEqual(self._claim_and_run(), [False])
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), ('pending', 1))
+        self.assertGreater(queued.run_at, timezone.now())
+
+        self.assertEqual(self._claim_and_run(), [False])
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, 'dead')
+        self.assertIn('RuntimeError: boom', queued.last_error)
+
+        self.assertEqual(retry_dead_tasks(BackgroundTask.objects.all()), 1)
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), ('pending', 0))
+
+    def test_claimed_tasks_are_not_claimed_twice(self):
+        """A running task is invisible to other workers until its lease expires"""
+        enqueue(failing_task, args=('boom',))
+
+        self.assertEqual(len(claim_tasks(10)), 1)
+        self.assertEqual(claim_tasks(10), [])
+
+    def test_unique_key_deduplicates_pending_tasks(self):
+        """Only one task per unique key is queued at a time"""
+        self.assertIsNotNone(enqueue(failing_task, args=('a',), unique_key='only-one'))
+        self.assertIsNone(enqueue(failing_task, args=('b',), unique_key='only-one'))
+        self.assertEqual(BackgroundTask.objects.count(), 1)
+
+
+class SingleFlightTests(TestCase):
+    """Test cases for coalescing concurrent identical calls"""
+
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def slow_call():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'reply'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flight.do('key', slow_call)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(flight.do('key', slow_call)))
+        follower.start()
+        # Give the follower time to join the call before it finishes
+        time.sleep(0.1)
+        release.set()
+        leader.join()
+        follower.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results, key=lambda r: r[1]), [('reply', False), ('reply', True)])
+
+    def test_failed_call_is_raised_and_forgotten(self):
+        flight = SingleFlight()
+        with self.assertRaises(ValueError):
+            flight.do('key', lambda: (_ for _ in ()).throw(ValueError("boom")))
+        # The failed call is forgotten, so the next one runs afresh
+        self.assertEqual(flight.do('key', lambda: 1), (1, False))
+
+    def test_async_callers_share_one_call(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def slow_call():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return 'reply'
+
+        async def both():
+            return await asyncio.gather(flight.ado('key', slow_call), flight.ado('key', slow_call))
+
+        self.assertEqual(asyncio.run(both()), [('reply', False), ('reply', True)])
+        self.assertEqual(len(calls), 1)
+
+
+@override_settings(LLM_RATE_LIMIT={'TIERS': {
+    'free': {'CAPACITY': 2, 'PER_MINUTE': 6},
+    'basic': {'CAPACITY': 4, 'PER_MINUTE': 6},
+}})
+class RateLimiterTests(TestCase):
+    """Test cases for the per-user LLM request rate limiter"""
+
+    def test_bucket_backends_refill_over_time(self):
+        """Both backends allow a burst of capacity, then one request per refill interval"""
+        for backend, clock in ((LocMemTokenBucketBackend(), 'monotonic'), (DatabaseTokenBucketBackend(), 'time')):
+            now = [1000.0]
+            with mock.patch(f'core.services.rate_limiter.time.{clock}', side_effect=lambda: now[0]):
+                self.assertEqual(backend.consume('key', 2, 0.1), 0)
+                self.assertEqual(backend.consume('key', 2, 0.1), 0)
+                self.assertAlmostEqual(backend.consume('key', 2, 0.1), 10)
+                now[0] += 10
+                self.assertEqual(backend.consume('key', 2, 0.1), 0)
+                self.assertAlmostEqual(backend.consume('key', 2, 0.1), 10)
+        self.assertEqual(RateLimitBucket.objects.count(), 1)
+
+    def test_limits_follow_subscription_tier(self):
+        """Each tier has its own burst size, per feature; staff aren't limited"""
+        free = User.objects.create_user(username='free', password='testpassword123')
+        basic = User.objects.create_user(username='basic', password='testpassword123', subscription_tier='basic')
+        staff = User.objects.create_user(username='staff', password='testpassword123', is_staff=True)
+
+        for _ in range(2):
+            check_rate_limit(free, 'character_chat')
+        with self.assertRaises(RateLimited) as raised:
+            check_rate_limit(free, 'character_chat')
+        self.assertEqual(raised.exception.retry_after, 10)
+        check_rate_limit(free, 'memory_summarization')
+
+        for _ in range(4):
+            check_rate_limit(basic, 'character_chat')
+        for _ in range(10):
+            check_rate_limit(staff, 'character_chat')
+
+    def test_batch_bigger_than_the_bucket_pays_in_full(self):
+        """A batch costing more than capacity is let through once, then holds off later requests"""
+        user = User.objects.create_user(username='batcher', password='testpassword123')
+        for backend, clock in ((LocMemTokenBucketBackend(), 'monotonic'), (DatabaseTokenBucketBackend(), 'time')):
+            now = [1000.0]
+            with mock.patch(f'core.services.rate_limiter.time.{clock}', side_effect=lambda: now[0]):
+                self.assertEqual(backend.consume('batch', 2, 0.1, cost=5), 0)
+                self.assertAlmostEqual(backend.consume('batch', 2, 0.1), 40)
+                now[0] += 40
+                self.assertEqual(backend.consume('batch', 2, 0.1), 0)
+
+        check_rate_limit(user, 'character_creation', cost=5)
+        with self.assertRaises(RateLimited) as raised:
+            check_rate_limit(user, 'character_creation', cost=5)
+        self.assertEqual(raised.exception.retry_after, 50)
+
+    def test_throttled_call_never_goes_upstream(self):
+        """A throttled request is refused before it is sent or reserves quota"""
+        user = User.objects.create_user(username='eager', password='testpassword123')
+        character = Character.objects.create(user=user, name='Ada', description='A mathematician')
+        check_rate_limit(user, 'character_chat', cost=2)
+
+        with mock.patch('core.services.model_router.create_chat_completion') as create:
+            with self.assertRaises(RateLimited):
+                OpenAIService(user).generate_character_response(character, [], 'Hello')
+            with self.assertRaises(RateLimited):
+                OpenAIService(user).stream_character_response(character, [], 'Hello')
+
+        create.assert_not_called()
+        self.assertEqual(UserTokenLimit.objects.get(user=user).reserved_tokens, 0)
@@ -1,5 +1,49 @@
-from django.contrib import admin
-from .models import UserTokenLimit, TokenUsage, TokenAlert, TokenPurchase, TokenHistory
+from urllib.parse import urlparse
+
+from django.contrib import admin, messages
+from django.shortcuts import redirect
+from django.utils import timezone
+from core.paginator import EstimatedCountPaginator
+from .models import UserTokenLimit, TokenUsage, TokenUsageArchive, TokenAlert, TokenPurchase, TokenHistory
+from .rollover import recompute_current_usage
+
+
+class LedgerAdminMixin:
+    """
+    Changelist settings for tables that grow without bound
+    Counts are estimated or capped rather than a full COUNT(*), users are
+    joined in rather than fetched per row, and a bare changelist opens on the
+    current month of its date hierarchy, so it reads a date range instead of
+    the whole table (with a user search, that range uses the (user, timestamp)
+    index).
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_select_related = ('user',)
+
+    def changelist_view(self, request, extra_context=None):
+        # Only a bare visit from elsewhere is sent to the current month; any
+        # filter or search is kept as is, and "All dates" (a link from the
+        # changelist itself) still shows every date
+        from_changelist = urlparse(request.META.get('HTTP_REFERER', '')).path == request.path
+        if request.method == 'GET' and not request.GET and not from_changelist:
+            field = self.date_hierarchy
+            now = timezone.localtime()
+            params = request.GET.copy()
+            params[f'{field}__year'] = now.year
+            params[f'{field}__month'] = now.month
+            return redirect(f"{request.path}?{params.urlencode()}")
+        return super().changelist_view(request, extra_context)
+
+
+@admin.action(description="Recompute this month's usage from the ledger")
+def recompute_usage(modeladmin, request, queryset):
+    """Admin action; queryset is UserTokenLimits, or rows with a user whose limits are recomputed"""
+    if queryset.model is not UserTokenLimit:
+        queryset = UserTokenLimit.objects.filter(user_id__in=queryset.values('user_id'))
+    updated = recompute_current_usage(queryset)
+    modeladmin.message_user(request, f"Recomputed usage for {updated} users.", messages.SUCCESS)
+
 
 @admin.register(UserTokenLimit)
 class UserTokenLimitAdmin(admin.ModelAdmin):
@@ -7,21 +51,26 @@ class UserTokenLimitAdmin(admin.ModelAdmin):
     search_fields = ('user__username',)
     list_filter = ('is_trial', 'last_reset')
     readonly_fields = ('last_reset', 'current_usage')
+    list_select_related = ('user',)
+    actions = [recompute_usage]
 
 @admin.register(TokenUsage)
-class TokenUsageAdmin(admin.ModelAdmin):
+class TokenUsageAdmin(LedgerAdminMixin, admin.ModelAdmin):
     list_display = ('user', 'feature', 'tokens_used', 'timestamp')
     search_fields = ('user__username', 'feature')
-    list_filter = ('feature', 'timestamp')
+    list_filter = ('feature',)
+    date_hierarchy = 'timestamp'
     ordering = ('-timestamp',)
+    actions = [recompute_usage]
 
 @admin.register(TokenAlert)
-class TokenAlertAdmin(admin.ModelAdmin):
+class TokenAlertAdmin(LedgerAdminMixin, admin.ModelAdmin):
     list_display = ('user', 'threshold', 'is_acknowledged', 'created_at')
     search_fields = ('user__username',)
-    list_filter = ('threshold', 'is_acknowledged', 'created_at')
+    list_filter = ('threshold', 'is_acknowledged')
+    date_hierarchy = 'created_at'
     ordering = ('-created_at',)
-    actions = ['mark_as_acknowledged']
+    actions = ['mark_as_acknowledged', recompute_usage]
 
     def mark_as_acknowledged(self, request, queryset):
         queryset.update(is_acknowledged=True)
@@ -40,3 +89,14 @@ class TokenHistoryAdmin(admin.ModelAdmin):
     search_fields = ('user__username',)
     list_filter = ('year', 'month')
     ordering = ('-year', '-month')
+
+@admin.register(TokenUsageArchive)
+class TokenUsageArchiveAdmin(admin.ModelAdmin):
+    list_display = ('user', 'month', 'year', 'row_count', 'tokens_used', 'archived_at')
+    search_fields = ('user__username',)
+    list_filter = ('year', 'month')
+    list_select_related = ('user',)
+    ordering = ('-year', '-month')
+    # Written only by archive_token_usage; the compressed rows aren't editable
+    exclude = ('rows',)
+    readonly_fields = ('user', 'month', 'year', 'row_count', 'tokens_used', 'feature_totals', 'archived_at')
@@ -0,0 +1,274 @@
+import json
+import zlib
+from collections import defaultdict
+from datetime import datetime, time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+# Defaults for settings.TOKEN_USAGE_ARCHIVE; any key can be overridden there
+DEFAULT_USAGE_ARCHIVE_SETTINGS = {
+    # TokenUsage rows from before the start of this many months ago are archived
+    'MONTHS': 6,
+    'COMPRESSION_LEVEL': 9,
+}
+
+# TokenUsage fields stored for each archived row (user and month are on the archive)
+ARCHIVE_FIELDS = (
+    'id', 'timestamp', 'feature', 'tokens_used', 'call_id',
+    'character_id', 'conversation_id', 'story_id', 'world_id',
+)
+
+
+class ArchiveError(Exception):
+    """Raised when a month's rows changed while they were being archived"""
+    pass
+
+
+def get_usage_archive_settings():
+    """Return the usage archive settings merged over the defaults"""
+    conf = dict(DEFAULT_USAGE_ARCHIVE_SETTINGS)
+    conf.update(getattr(settings, 'TOKEN_USAGE_ARCHIVE', {}))
+    return conf
+
+
+def _month_start(year, month):
+    return timezone.make_aware(datetime(year, month, 1))
+
+
+def _next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def archive_cutoff(months=None, now=None):
+    """Start of the oldest month kept in TokenUsage; rows before it are archived"""
+    months = get_usage_archive_settings()['MONTHS'] if months is None else months
+    now = timezone.localtime(now or timezone.now())
+    index = now.year * 12 + now.month - 1 - months
+    return _month_start(index // 12, index % 12 + 1)
+
+
+def _encode(value):
+    # Full isoformat; DjangoJSONEncoder would cut timestamps to milliseconds
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} can't be archived")
+
+
+def pack_rows(rows):
+    """Compress row dicts (ARCHIVE_FIELDS) as zlib'd JSON lines"""
+    lines = '\n'.join(json.dumps(row, default=_encode, separators=(',', ':')) for row in rows)
+    return zlib.compress(lines.encode(), get_usage_archive_settings()['COMPRESSION_LEVEL'])
+
+
+def _unpack(blob):
+    data = zlib.decompress(bytes(blob)).decode()
+    rows = [json.loads(line) for line in data.split('\n') if line]
+    for row in rows:
+        row['timestamp'] = parse_datetime(row['timestamp'])
+    return rows
+
+
+def unpack_rows(blob, user_id=None):
+    """Archived rows as unsaved TokenUsage instances, newest first"""
+    from token_management.models import TokenUsage
+    rows = [TokenUsage(user_id=user_id, **row) for row in _unpack(blob)]
+    rows.sort(key=lambda usage: usage.timestamp, reverse=True)
+    return rows
+
+
+def _as_datetime(value):
+    """A datetime, date or YYYY-MM-DD (or ISO datetime) string as an aware datetime"""
+    if isinstance(value, str):
+        value = parse_datetime(value) or parse_date(value)
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time.min)
+    return timezone.make_aware(value) if timezone.is_naive(value) else value
+
+
+def _archives_between(user, start, end):
+    """The user's archives for months overlapping [start, end)"""
+    from token_management.models import TokenUsageArchive
+    # Everything archived is from before the cutoff, so recent ranges skip the query
+    if start and start >= archive_cutoff():
+        return TokenUsageArchive.objects.none()
+    archives = TokenUsageArchive.objects.filter(user=user)
+    if start:
+        archives = archives.exclude(year__lt=start.year).exclude(year=start.year, month__lt=start.month)
+    if end:
+        archives = archives.exclude(year__gt=end.year).exclude(year=end.year, month__gt=end.month)
+    return archives
+
+
+def archived_usage(user, start=None, end=None):
+    """
+    The user's archived TokenUsage rows with timestamps in [start, end], newest first
+    Only months that overlap the range are decompressed.
+    """
+    start, end = _as_datetime(start), _as_datetime(end)
+    rows = []
+    for archive in _archives_between(user, start, end):
+        rows.extend(
+            usage for usage in archive.get_rows()
+            if (start is None or usage.timestamp >= start) and (end is None or usage.timestamp <= end)
+        )
+    rows.sort(key=lambda usage: usage.timestamp, reverse=True)
+    return rows
+
+
+def archived_feature_totals(user, start, end):
+    """
+    Archived tokens per feature with timestamps in [start, end)
+    Months wholly inside the range use their stored totals; only the months
+    at its edges are decompressed.
+    """
+    start, end = _as_datetime(start), _as_datetime(end)
+    totals = defaultdict(int)
+    for archive in _archives_between(user, start, end):
+        first = _month_start(archive.year, archive.month)
+        last = _month_start(*_next_month(archive.year, archive.month))
+        if start <= first and last <= end:
+            for feature, tokens in archive.feature_totals.items():
+                totals[feature] += tokens
+            continue
+        for row in _unpack(archive.rows):
+            if start <= row['timestamp'] < end:
+                totals[row['feature']] += row['tokens_used']
+    return dict(totals)
+
+
+def archived_total(user):
+    """All tokens the user used in archived months"""
+    from token_management.models import TokenUsageArchive
+    return TokenUsageArchive.objects.filter(user=user).aggregate(total=Sum('tokens_used'))['total'] or 0
+
+
+def archived_daily_totals(start=None):
+    """
+    Per (user, day, feature) totals of the archived rows, for rebuilding the daily rollup
+    Yields dicts shaped like backfill_token_usage_daily's GROUP BY rows.
+    """
+    from token_management.models import TokenUsageArchive
+    archives = TokenUsageArchive.objects.all()
+    if start:
+        archives = archives.exclude(year__lt=start.year).exclude(year=start.year, month__lt=start.month)
+    for archive in archives.order_by('pk').iterator():
+        days = defaultdict(lambda: [0, 0])
+        for row in _unpack(archive.rows):
+            day = timezone.localdate(row['timestamp'])
+            if start and day < start:
+                continue
+            days[(day, row['feature'])][0] += row['tokens_used']
+            days[(day, row['feature'])][1] += 1
+        for (day, feature), (tokens, requests) in days.items():
+            yield {
+                'user_id': archive.user_id, 'date': day, 'feature': feature,
+                'tokens': tokens, 'requests': requests,
+            }
+
+
+def _month_key(value):
+    return (value.year, value.month)
+
+
+def archive_token_usage(months=None, now=None, dry_run=False):
+    """
+    Move TokenUsage rows older than the cutoff into one TokenUsageArchive per user and month
+    A month is only moved once the daily rollup (TokenUsageDaily) accounts for
+    every row of it, tokens and request count, so month totals and charts are
+    unchanged; months it doesn't match are skipped and reported. Each month's
+    archive write and delete is one transaction.
+    Returns {'archived': [(user_id, year, month, rows)], 'skipped': [(user_id, year, month)]}.
+    """
+    from token_management.ledger import usage_ledger
+    from token_management.models import TokenUsage, TokenUsageArchive, TokenUsageDaily
+
+    cutoff = archive_cutoff(months, now)
+    result = {'archived': [], 'skipped': []}
+
+    # Buffered ledger entries have to be in the table (and the rollup) first
+    usage_ledger.flush()
+
+    users = (
+        TokenUsage.objects.filter(timestamp__lt=cutoff)
+        .values_list('user_id', flat=True).distinct().order_by('user_id')
+    )
+    for user_id in users.iterator():
+        cold = {
+            _month_key(row['period']): (row['tokens'], row['rows'])
+            for row in TokenUsage.objects.filter(user_id=user_id, timestamp__lt=cutoff)
+            .annotate(period=TruncMonth('timestamp')).values('period')
+            .annotate(tokens=Sum('tokens_used'), rows=Count('id')).order_by()
+        }
+        rollup = {
+            _month_key(row['period']): (row['tokens'], row['rows'])
+            for row in TokenUsageDaily.objects.filter(user_id=user_id, date__lt=cutoff.date())
+            .annotate(period=TruncMonth('date')).values('period')
+            .annotate(tokens=Sum('tokens_used'), rows=Sum('request_count')).order_by()
+        }
+        archived = {
+            (archive.year, archive.month): archive
+            for archive in TokenUsageArchive.objects.filter(
+                user_id=user_id, year__in={year for year, _ in cold}
+            )
+        }
+
+        for (year, month), (tokens, count) in sorted(cold.items()):
+            existing = archived.get((year, month))
+            expected = (
+                tokens + (existing.tokens_used if existing else 0),
+                count + (existing.row_count if existing else 0),
+            )
+            if rollup.get((year, month)) != expected:
+                result['skipped'].append((user_id, year, month))
+                continue
+            if not dry_run:
+                try:
+                    _archive_month(user_id, year, month, existing)
+                except ArchiveError:
+                    result['skipped'].append((user_id, year, month))
+                    continue
+            result['archived'].append((user_id, year, month, count))
+
+    return result
+
+
+def _archive_month(user_id, year, month, existing=None):
+    from token_management.models import TokenUsage, TokenUsageArchive
+    hot = TokenUsage.objects.filter(
+        user_id=user_id,
+        timestamp__gte=_month_start(year, month),
+        timestamp__lt=_month_start(*_next_month(year, month)),
+    )
+    with transaction.atomic():
+        rows = list(hot.order_by('pk').values(*ARCHIVE_FIELDS))
+        if not rows:
+            # Deleted since the month was counted; there is nothing left to move
+            raise ArchiveError(f"Usage for user {user_id} in {month}/{year} changed while it was archived")
+        if existing:
+            rows = _unpack(existing.rows) + rows
+
+        feature_totals = defaultdict(int)
+        for row in rows:
+            feature_totals[row['feature']] += row['tokens_used']
+
+        TokenUsageArchive.objects.update_or_create(
+            user_id=user_id, year=year, month=month,
+            defaults={
+                'rows': pack_rows(rows),
+                'row_count': len(rows),
+                'tokens_used': sum(feature_totals.values()),
+                'feature_totals': dict(feature_totals),
+            }
+        )
+        moved = len(rows) - (existing.row_count if existing else 0)
+        deleted, _ = hot.filter(pk__lte=rows[-1]['id']).delete()
+        if deleted != moved:
+            # Rolls the archive write back; the month is retried on the next run
+            raise ArchiveError(f"Usage for user {user_id} in {month}/{year} changed while it was archived")
@@ -1,51 +1,46 @@
-from .models import UserTokenLimit
-from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .models import TokenAlert
+from .quota import get_quota_snapshot, snapshot_token_limit
+
+
+class TokenUsageContext:
+    """
+    A request's token values for templates, each computed on first use
+    The quota values come from the same cached snapshot TokenUsageMiddleware
+    reads (the one it already loaded, if it ran for this request).
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    @cached_property
+    def token_limit_obj(self):
+        snapshot = getattr(self.request, 'quota_snapshot', None) or get_quota_snapshot(self.request.user)
+        return snapshot_token_limit(self.request.user, snapshot)
+
+    @cached_property
+    def alert_count(self):
+        return TokenAlert.objects.filter(user=self.request.user, is_acknowledged=False).count()
+
 
 def token_usage(request):
     if hasattr(request, 'user') and request.user.is_authenticated:
-        # Get token limit from UserTokenLimit model
-        try:
-            token_limit_obj = UserTokenLimit.objects.get(user=request.user)
-            # Check if tokens need to be reset for a new month
-            token_limit_obj.check_and_reset_tokens()
-            
-            token_limit = token_limit_obj.monthly_limit
-            token_usage = token_limit_obj.current_usage
-            token_percent = token_limit_obj.get_token_percent_used()
-            days_until_reset = token_limit_obj.days_until_next_month()
-            
-            # Trial information
-            is_trial = token_limit_obj.is_trial
-            trial_days_left = token_limit_obj.days_left_in_trial()
-            show_conversion = token_limit_obj.should_show_conversion()
-            
-        except UserTokenLimit.DoesNotExist:
-            # Create a default token limit if it doesn't exist
-            token_limit_obj = UserTokenLimit.objects.create(
-                user=request.user, 
-                monthly_limit=50000,
-                is_trial=True,
-                trial_start=timezone.now()
-            )
-            
-            token_limit = token_limit_obj.monthly_limit
-            token_usage = 0
-            token_percent = 0
-            days_until_reset = token_limit_obj.days_until_next_month()
-            
-            # Trial information
-            is_trial = True
-            trial_days_left = 14
-            show_conversion = False
-            
+        # Shared by every template rendered for this request
+        if not hasattr(request, 'token_usage_context'):
+            request.token_usage_context = TokenUsageContext(request)
+        context = request.token_usage_context
+
+        # Templates call these when they read the variable, so pages (and error
+        # pages) that don't show token info run no queries for it
         return {
-            'token_usage': token_usage,
-            'token_limit': token_limit,
-            'token_percent': token_percent,
-            'days_until_reset': days_until_reset,
-            'token_alerts': request.user.token_alerts.filter(is_acknowledged=False).count(),
-            'is_trial': is_trial,
-            'trial_days_left': trial_days_left,
-            'show_conversion': show_conversion,
+            'token_usage': lambda: context.token_limit_obj.current_usage,
+            'token_limit': lambda: context.token_limit_obj.monthly_limit,
+            'token_percent': lambda: context.token_limit_obj.get_token_percent_used(),
+            'days_until_reset': lambda: context.token_limit_obj.days_until_next_month(),
+            'token_alerts': lambda: context.alert_count,
+            'is_trial': lambda: context.token_limit_obj.is_trial,
+            'trial_days_left': lambda: context.token_limit_obj.days_left_in_trial(),
+            'show_conversion': lambda: context.token_limit_obj.should_show_conversion(),
         }
-    return {}
\ No newline at end of file
+    return {}
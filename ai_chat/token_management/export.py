@@ -0,0 +1,127 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.utils import timezone
+
+# Rows fetched from the database per round trip while streaming
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+
+class ExportError(ValueError):
+    """Raised for an unknown dataset or format, or a filter that can't be parsed"""
+    pass
+
+
+def _datasets():
+    from token_management.models import TokenHistory, TokenPurchase, TokenUsage
+    return {
+        'usage': {
+            'queryset': TokenUsage.objects.all(),
+            'columns': (
+                'id', 'user_id', 'user__username', 'timestamp', 'feature', 'tokens_used', 'call_id',
+                'character_id', 'conversation_id', 'story_id', 'world_id',
+            ),
+            'date_field': 'timestamp',
+            'has_feature': True,
+        },
+        'purchases': {
+            'queryset': TokenPurchase.objects.all(),
+            'columns': (
+                'id', 'transaction_id', 'user_id', 'user__username', 'created_at', 'completed_at',
+                'tokens_purchased', 'amount_paid', 'currency', 'payment_provider', 'payment_id', 'payment_status',
+            ),
+            'date_field': 'created_at',
+            'has_feature': False,
+        },
+        'history': {
+            # Months are filtered by their first day
+            'queryset': TokenHistory.objects.annotate(period=F('year') * 100 + F('month')),
+            'columns': ('id', 'user_id', 'user__username', 'year', 'month', 'total_usage', 'allocated_limit'),
+            'date_field': None,
+            'has_feature': False,
+        },
+    }
+
+
+def parse_date(value, name):
+    """A YYYY-MM-DD filter value as a date, or None if empty"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ExportError(f"{name} must be a date in YYYY-MM-DD format")
+
+
+def export_queryset(dataset, user=None, start=None, end=None, feature=None):
+    """
+    The values_list queryset behind an export, plus its column names
+    user is a user id or username; start and end are dates (both inclusive).
+    """
+    datasets = _datasets()
+    if dataset not in datasets:
+        raise ExportError(f"Unknown dataset '{dataset}'; choose from {', '.join(datasets)}")
+    spec = datasets[dataset]
+    queryset = spec['queryset']
+
+    if user:
+        queryset = queryset.filter(user_id=user) if str(user).isdigit() else queryset.filter(user__username=user)
+    if feature:
+        if not spec['has_feature']:
+            raise ExportError(f"The {dataset} export has no feature filter")
+        queryset = queryset.filter(feature=feature)
+
+    if spec['date_field']:
+        # Timestamp ranges, so the (user, timestamp) style indexes apply
+        if start:
+            queryset = queryset.filter(**{
+                f"{spec['date_field']}__gte": timezone.make_aware(datetime.combine(start, time.min))
+            })
+        if end:
+            queryset = queryset.filter(**{
+                f"{spec['date_field']}__lt": timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min))
+            })
+    else:
+        if start:
+            queryset = queryset.filter(period__gte=start.year * 100 + start.month)
+        if end:
+            queryset = queryset.filter(period__lte=end.year * 100 + end.month)
+
+    return queryset.order_by('pk').values_list(*spec['columns']), spec['columns']
+
+
+class _Echo:
+    """File-like object whose write() returns the line, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def export_lines(dataset, fmt='csv', chunk_size=EXPORT_CHUNK_SIZE, **filters):
+    """
+    Yield an export line by line
+    Rows are read with .iterator(), chunk_size at a time (a server-side cursor
+    where the database supports one), so memory use doesn't grow with the
+    number of rows. filters are those of export_queryset.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"Unknown format '{fmt}'; choose from {', '.join(EXPORT_FORMATS)}")
+    queryset, columns = export_queryset(dataset, **filters)
+    return _csv_lines(queryset, columns, chunk_size) if fmt == 'csv' else _jsonl_lines(queryset, columns, chunk_size)
+
+
+def _csv_lines(queryset, columns, chunk_size):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in queryset.iterator(chunk_size=chunk_size):
+        yield writer.writerow(row)
+
+
+def _jsonl_lines(queryset, columns, chunk_size):
+    for row in queryset.iterator(chunk_size=chunk_size):
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
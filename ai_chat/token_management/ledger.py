@@ -0,0 +1,126 @@
+import atexit
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import transaction
+
+from core.services import write_behind
+
+# Defaults for settings.USAGE_LEDGER; any key can be overridden there
+DEFAULT_USAGE_LEDGER_SETTINGS = {
+    # Buffer entries in memory and bulk insert them; off writes each one straight away
+    'BUFFERED': True,
+    'BATCH_SIZE': 100,
+    # Seconds an entry may wait; checked as entries arrive and as requests finish
+    'FLUSH_INTERVAL': 2.0,
+}
+
+
+def get_usage_ledger_settings():
+    """Return the usage ledger settings merged over the defaults"""
+    conf = dict(DEFAULT_USAGE_LEDGER_SETTINGS)
+    conf.update(getattr(settings, 'USAGE_LEDGER', {}))
+    return conf
+
+
+def new_call_id():
+    """A call id for usage that has no upstream response id"""
+    return uuid.uuid4().hex
+
+
+class UsageLedger:
+    """
+    The single writer for TokenUsage rows
+    Entries are buffered in memory and inserted with bulk_create once
+    BATCH_SIZE is reached or the oldest entry is FLUSH_INTERVAL old, and
+    always at process exit. Each entry has a call_id, so an entry recorded
+    twice (or flushed twice) is stored once. The daily rollup and summary
+    counters are updated from the rows actually inserted.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        # Serializes flushes, so a call id can't slip past the dedup check twice
+        self._flush_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, usage):
+        """Add an unsaved TokenUsage to the ledger"""
+        if not usage.call_id:
+            usage.call_id = new_call_id()
+
+        conf = get_usage_ledger_settings()
+        with self._lock:
+            self._entries.append(usage)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+        if not conf['BUFFERED'] or self._is_due(conf):
+            self.flush()
+
+    def flush_if_due(self):
+        if self._entries and self._is_due(get_usage_ledger_settings()):
+            self.flush()
+
+    def _is_due(self, conf):
+        return (
+            len(self._entries) >= conf['BATCH_SIZE']
+            or (self._oldest is not None and time.monotonic() - self._oldest >= conf['FLUSH_INTERVAL'])
+        )
+
+    def flush(self):
+        """Insert every buffered entry; returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                entries, self._entries, self._oldest = self._entries, [], None
+            if not entries:
+                return 0
+            try:
+                return _write_entries(entries)
+            except Exception as e:
+                # Keep the entries for the next flush rather than losing charges
+                print(f"Error flushing usage ledger: {str(e)}")
+                with self._lock:
+                    self._entries = entries + self._entries
+                    self._oldest = self._oldest or time.monotonic()
+                return 0
+
+
+def _write_entries(entries):
+    """
+    Insert ledger entries not stored yet and add them to the daily rollup
+    Written in a transaction of their own, never in a request's write-behind
+    buffer, so a failure is seen (and the entries kept) by UsageLedger.flush.
+    """
+    from token_management.models import TokenUsage, TokenUsageDaily
+
+    # Repeats within the batch and rows already in the table are both dropped
+    unique = {}
+    for usage in entries:
+        unique.setdefault(usage.call_id, usage)
+
+    with transaction.atomic():
+        stored = set(TokenUsage.objects.filter(call_id__in=list(unique)).values_list('call_id', flat=True))
+        new = [usage for call_id, usage in unique.items() if call_id not in stored]
+        # A row another process inserted meanwhile fails the batch, rolling it
+        # back; the next flush finds that row stored and adds only the rest
+        TokenUsage.objects.bulk_create(new)
+
+        # The rollup increments are coalesced per user, day and feature
+        with write_behind.separate_buffer():
+            for usage in new:
+                TokenUsageDaily.add_usage(usage)
+    return len(new)
+
+
+usage_ledger = UsageLedger()
+
+# Buffered charges must reach the database before the process goes away
+atexit.register(usage_ledger.flush)
+request_finished.connect(lambda **kwargs: usage_ledger.flush_if_due(), weak=False, dispatch_uid='usage-ledger-flush')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from token_management.archive import archive_cutoff, archive_token_usage
+
+
+class Command(BaseCommand):
+    help = "Move TokenUsage rows older than TOKEN_USAGE_ARCHIVE['MONTHS'] months into per-month archives"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, help="Months of usage to keep in TokenUsage (overrides the setting)")
+        parser.add_argument('--dry-run', action='store_true', help="Report what would be archived without moving anything")
+    
+    def handle(self, *args, **options):
+        cutoff = archive_cutoff(options['months'])
+        result = archive_token_usage(months=options['months'], dry_run=options['dry_run'])
+        
+        for user_id, year, month in result['skipped']:
+            self.stdout.write(self.style.WARNING(
+                f"Skipped user {user_id} {month}/{year}: the daily rollup doesn't match its usage rows "
+                f"(run backfill_token_usage_daily for that month, then archive again)"
+            ))
+        
+        rows = sum(count for _, _, _, count in result['archived'])
+        verb = "Would archive" if options['dry_run'] else "Archived"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {rows} usage rows from before {cutoff:%Y-%m-%d} in {len(result['archived'])} user months"
+        ))
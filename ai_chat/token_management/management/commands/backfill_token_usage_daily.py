@@ -0,0 +1,72 @@
+from datetime import datetime, time
+from itertools import chain
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from token_management.archive import archived_daily_totals
+from token_management.models import TokenUsage, TokenUsageDaily
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily token usage rollup (TokenUsageDaily) from TokenUsage rows"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="First day to rebuild (YYYY-MM-DD); defaults to all history")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rollup rows inserted per query")
+    
+    def handle(self, *args, **options):
+        usages = TokenUsage.objects.all()
+        days = TokenUsageDaily.objects.all()
+        since = None
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("--since must be a date in YYYY-MM-DD format")
+            # A timestamp range rather than timestamp__date, so the (user, timestamp) index applies
+            usages = usages.filter(timestamp__gte=timezone.make_aware(datetime.combine(since, time.min)))
+            days = days.filter(date__gte=since)
+        
+        # One GROUP BY over the usage rows; TruncDate uses the current time zone,
+        # like TokenUsageDaily.add_usage
+        totals = usages.annotate(date=TruncDate('timestamp')).values('user_id', 'date', 'feature').annotate(
+            tokens=Sum('tokens_used'), requests=Count('id')
+        ).order_by()
+        
+        # Months moved to the usage archive are rebuilt from there; a day may have
+        # both archived and hot rows, so totals are merged per day
+        merged = {}
+        for total in chain(totals.iterator(), archived_daily_totals(since)):
+            key = (total['user_id'], total['date'], total['feature'])
+            tokens, requests = merged.get(key, (0, 0))
+            merged[key] = (tokens + total['tokens'], requests + total['requests'])
+        
+        rows = (
+            TokenUsageDaily(
+                user_id=user_id,
+                date=day,
+                feature=feature,
+                tokens_used=tokens,
+                request_count=requests,
+            )
+            for (user_id, day, feature), (tokens, requests) in merged.items()
+        )
+        
+        # Replace the affected days in one transaction so readers never see a partial rollup
+        with transaction.atomic():
+            deleted, _ = days.delete()
+            created = 0
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= options['batch_size']:
+                    created += len(TokenUsageDaily.objects.bulk_create(batch))
+                    batch = []
+            if batch:
+                created += len(TokenUsageDaily.objects.bulk_create(batch))
+        
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} daily rollup rows (replaced {deleted})"))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from token_management.export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, ExportError, export_lines, parse_date
+
+
+class Command(BaseCommand):
+    help = "Stream token usage, purchases or history as CSV or JSONL"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=['usage', 'purchases', 'history'])
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--user', help="User id or username")
+        parser.add_argument('--start', help="First day to export (YYYY-MM-DD)")
+        parser.add_argument('--end', help="Last day to export (YYYY-MM-DD)")
+        parser.add_argument('--feature', help="Only usage for this feature")
+        parser.add_argument('--output', help="File to write; defaults to stdout")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help="Rows fetched per query")
+    
+    def handle(self, *args, **options):
+        try:
+            lines = export_lines(
+                options['dataset'],
+                fmt=options['format'],
+                chunk_size=options['chunk_size'],
+                user=options['user'],
+                start=parse_date(options['start'], '--start'),
+                end=parse_date(options['end'], '--end'),
+                feature=options['feature'],
+            )
+        except ExportError as e:
+            raise CommandError(str(e))
+        
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
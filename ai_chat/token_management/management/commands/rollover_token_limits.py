@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from token_management.rollover import rollover_token_limits
+
+
+class Command(BaseCommand):
+    help = "Start the new month for every user's token limit, archiving last month in TokenHistory"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Token limits rolled over per query")
+    
+    def handle(self, *args, **options):
+        # Schedule this (e.g. cron) right after midnight UTC on the 1st; limits it
+        # hasn't reached yet are still rolled over lazily when next used
+        rolled = rollover_token_limits(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rolled over {rolled} token limits"))
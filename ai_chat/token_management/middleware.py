@@ -1,83 +1,67 @@
-from django.utils import timezone
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.contrib import messages
-from token_management.models import TokenAlert, TokenUsage, UserTokenLimit
+from token_management.models import TokenUsage, UserTokenLimit
+from token_management.quota import confirm_quota_snapshot, get_quota_snapshot, is_over_limit
 
 
 class TokenUsageMiddleware:
     """Middleware to track and enforce token usage limits"""
     
+    # Supports async so async views under ASGI don't get pinned to a thread
+    sync_capable = True
+    async_capable = True
+    
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
     
     def __call__(self, request):
-        # Process request
-        if request.user.is_authenticated:
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        
+        # Process request; exempt URLs (static files, admin) skip the check entirely
+        if not self._is_exempt_url(request.path) and request.user.is_authenticated:
             # Check if the user has reached their token limit
-            if self._check_token_limits(request.user):
+            if self._check_token_limits(request, request.user):
                 # User has reached their limit
-                if not self._is_exempt_url(request.path):
-                    messages.error(request, "You have reached your monthly token limit. Please upgrade your subscription or purchase additional tokens.")
-                    return redirect(reverse('token_management:limit_reached'))
+                messages.error(request, "You have reached your monthly token limit. Please upgrade your subscription or purchase additional tokens.")
+                return redirect(reverse('token_management:limit_reached'))
         
         # Process response
         response = self.get_response(request)
         return response
     
-    def _check_token_limits(self, user):
+    async def __acall__(self, request):
+        """Async version of __call__"""
+        if not self._is_exempt_url(request.path):
+            user = await request.auser()
+            if user.is_authenticated and await sync_to_async(self._check_token_limits)(request, user):
+                messages.error(request, "You have reached your monthly token limit. Please upgrade your subscription or purchase additional tokens.")
+                return redirect(reverse('token_management:limit_reached'))
+        
+        return await self.get_response(request)
+    
+    def _check_token_limits(self, request, user):
         """
         Check if the user has reached their token limit
         Returns True if limit reached, False otherwise
+        Reads the cached quota snapshot, so this normally costs no queries;
+        a snapshot over the limit is confirmed with the database first.
+        Threshold alerts are raised when usage is recorded, not here. The
+        snapshot is kept on the request for the token_usage context processor.
         """
         # Check if user has unlimited tokens (e.g., staff)
         if user.is_staff:
             return False
         
-        # Get the user's token limit object
-        try:
-            token_limit_obj = UserTokenLimit.objects.get(user=user)
-        except UserTokenLimit.DoesNotExist:
-            # Create a default limit if it doesn't exist
-            token_limit_obj = UserTokenLimit.objects.create(user=user)
-            return False  # New user, not at limit yet
-        
-        # Check if user is at their limit
-        if token_limit_obj.token_usage_this_month >= token_limit_obj.monthly_limit:
-            # Create 100% alert if it doesn't exist
-            month = timezone.now().month
-            year = timezone.now().year
-            
-            TokenAlert.objects.get_or_create(
-                user=user,
-                threshold=100,
-                month=month,
-                year=year,
-                defaults={
-                    'usage_at_alert': token_limit_obj.token_usage_this_month,
-                    'limit_at_alert': token_limit_obj.monthly_limit
-                }
-            )
-            return True
-        
-        # Create alerts at various thresholds
-        for threshold in [50, 80, 95]:
-            if token_limit_obj.token_usage_this_month >= (token_limit_obj.monthly_limit * threshold / 100):
-                month = timezone.now().month
-                year = timezone.now().year
-                
-                TokenAlert.objects.get_or_create(
-                    user=user,
-                    threshold=threshold,
-                    month=month,
-                    year=year,
-                    defaults={
-                        'usage_at_alert': token_limit_obj.token_usage_this_month,
-                        'limit_at_alert': token_limit_obj.monthly_limit
-                    }
-                )
-        
-        return False
+        snapshot = get_quota_snapshot(user)
+        if is_over_limit(snapshot):
+            snapshot = confirm_quota_snapshot(user, snapshot)
+        request.quota_snapshot = snapshot
+        return is_over_limit(snapshot)
     
     def _is_exempt_url(self, path):
         """Check if the current URL is exempt from token limit enforcement"""
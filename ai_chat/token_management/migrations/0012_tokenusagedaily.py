@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:59
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('token_management', '0011_tokenhistory_remove_usertokenlimit_token_reset_date_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenUsageDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('feature', models.CharField(choices=[('character_creation', 'Character Creation'), ('character_chat', 'Character Chat'), ('story_assistance', 'Story Assistance'), ('memory_summarization', 'Memory Summarization'), ('world_building', 'World Building'), ('plot_development', 'Plot Development'), ('character_development', 'Character Development'), ('other', 'Other')], max_length=30)),
+                ('tokens_used', models.BigIntegerField(default=0)),
+                ('request_count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='token_usage_days', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-date'],
+                'unique_together': {('user', 'date', 'feature')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('token_management', '0012_tokenusagedaily'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tokenusage',
+            name='call_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('token_management', '0013_tokenusage_call_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usertokenlimit',
+            name='reserved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usertokenlimit',
+            name='reserved_tokens',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:51
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('token_management', '0015_tokenusagearchive'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tokenalert',
+            index=models.Index(fields=['created_at'], name='token_manag_created_18c65f_idx'),
+        ),
+    ]
@@ -10,6 +10,11 @@ import uuid
 from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.utils import timezone
+from core.services import write_behind
+from token_management.ledger import usage_ledger
+from token_management.quota import refresh_quota_snapshot, invalidate_quota
+from token_management.rollover import rollover_token_limits
+from token_management.usage_summary import current_period_summary, period_bounds, record_summary_usage, summarize_usage
 
 # Remove CustomUser import/definition - use settings.AUTH_USER_MODEL instead
 
@@ -25,6 +30,9 @@ class UserTokenLimit(models.Model):
     
     # For calendar month reset
     current_usage = models.IntegerField(default=0)  # Token usage in current month
+    # Estimated cost of LLM calls in flight, held until they are charged
+    reserved_tokens = models.IntegerField(default=0)
+    reserved_at = models.DateTimeField(null=True, blank=True)  # Last time tokens were reserved
     last_reset = models.DateTimeField(default=timezone.now)  # Last time tokens were reset
     
     # For trial tracking
@@ -49,26 +57,20 @@ class UserTokenLimit(models.Model):
         return min(100, (self.current_usage / self.monthly_limit) * 100)
     
     def check_and_reset_tokens(self):
-        """Reset tokens if we're in a new month"""
+        """
+        Reset tokens if we're in a new month
+        The rollover_token_limits command normally resets everyone just after
+        the month starts, leaving this a comparison; a limit it hasn't reached
+        yet is rolled over here, the same way.
+        """
         now = timezone.now()
         last_reset_month = self.last_reset.month
         last_reset_year = self.last_reset.year
         
         if now.month != last_reset_month or now.year != last_reset_year:
-            # Create a historical record before resetting
-            TokenHistory.objects.create(
-                user=self.user,
-                month=last_reset_month,
-                year=last_reset_year,
-                total_usage=self.current_usage,
-                allocated_limit=self.monthly_limit
-            )
-            
-            # Reset for the new month
-            self.current_usage = 0
-            self.last_reset = now
-            self.save(update_fields=['current_usage', 'last_reset'])
-            return True
+            reset = rollover_token_limits(UserTokenLimit.objects.filter(pk=self.pk), now=now) > 0
+            self.refresh_from_db(fields=['current_usage', 'last_reset'])
+            return reset
         return False
     
     def days_until_next_month(self):
@@ -107,89 +109,54 @@ class UserTokenLimit(models.Model):
         days_left = self.days_left_in_trial()
         return days_left <= 3
     
-    def update_token_usage(self, amount, feature=None, **kwargs):
-        """Update token usage with the specified amount"""
-        with transaction.atomic():
-            # Check if we need to reset for a new month
-            self.check_and_reset_tokens()
-            
-            # Lock the row to prevent race conditions
-            limit_obj = UserTokenLimit.objects.select_for_update().get(id=self.id)
-            limit_obj.current_usage += amount
-            limit_obj.save(update_fields=['current_usage'])
-            
-            # Add to usage history - this is already done in _log_token_usage, so we don't need it here
-            # TokenUsage.objects.create(
-            #     user=self.user,
-            #     feature=feature or 'other',
-            #     tokens_used=amount,
-            #     **kwargs
-            # )
-            
-            # Check for thresholds and create alerts if needed
-            self._check_thresholds_and_create_alerts()
-            
+    def record_usage(self, amount, reserved=0):
+        """
+        Add tokens to this month's usage
+        The usage is an F() increment that goes through the write-behind buffer,
+        so a chat turn's charges land in one short transaction. reserved is the
+        call's reservation, released by the same UPDATE. Threshold alerts are
+        checked once the increment is in the database.
+        """
+        self.check_and_reset_tokens()
+        self.current_usage += amount
+        if reserved:
+            write_behind.increment(self, current_usage=amount, reserved_tokens=-reserved)
+        else:
+            write_behind.increment(self, current_usage=amount)
+        write_behind.on_flush(self._refresh_and_check_alerts, key=('token-alerts', self.pk))
+    
+    def _refresh_and_check_alerts(self):
+        """Reload the current usage and create any threshold alerts it calls for"""
+        self.refresh_from_db(fields=['current_usage', 'monthly_limit'])
+        self.check_and_create_alerts()
+    
+    def update_token_usage(self, amount, feature=None, call_id=None, reservation=None, **kwargs):
+        """
+        Charge tokens to this month's usage and record them in the usage ledger
+        kwargs are TokenUsage reference fields (character_id, conversation_id, ...).
+        call_id identifies the LLM call, so a call recorded twice is stored once
+        in the ledger. reservation is the call's TokenReservation, which the
+        charge settles. Returns the updated usage.
+        """
+        usage_ledger.record(TokenUsage(
+            user_id=self.user_id,
+            feature=feature or 'other',
+            tokens_used=amount,
+            call_id=call_id,
+            **kwargs
+        ))
+        self.record_usage(amount, reserved=reservation.settle() if reservation else 0)
         return self.current_usage
 
     def _check_thresholds_and_create_alerts(self):
         """Check if user has crossed any token usage thresholds and create alerts"""
-        # Skip if the user is staff (likely has unlimited tokens)
-        if self.user.is_staff:
-            return
-            
-        # Get current month and year
-        now = timezone.now()
-        current_month = now.month
-        current_year = now.year
-        
-        # Calculate percentage used
-        percent_used = self.get_token_percent_used()
-        
-        # Check thresholds
-        for threshold in [50, 80, 95, 100]:
-            if percent_used >= threshold:
-                # Try to create an alert (will be ignored if one already exists for this threshold/month)
-                TokenAlert.objects.get_or_create(
-                    user=self.user,
-                    threshold=threshold,
-                    month=current_month,
-                    year=current_year,
-                    defaults={
-                        'usage_at_alert': self.current_usage,
-                        'limit_at_alert': self.monthly_limit
-                    }
-                )
+        # Alerts are raised by the quota snapshot, which knows the highest
+        # threshold already alerted on, so crossed thresholds cost no queries
+        refresh_quota_snapshot(self)
 
     def check_and_create_alerts(self):
-        """Check if we need to create alerts for the user"""
-        # Check if user is staff
-        if self.user.is_staff:
-            return
-        
-        # Check if we need to create alerts
+        """Check if we need to create alerts for the user, and refresh their quota snapshot"""
         self._check_thresholds_and_create_alerts()
-    
-    def update_token_usage(self, amount, feature=None, **kwargs):
-        """Update token usage with the specified amount"""
-        with transaction.atomic():
-            # Check if we need to reset for a new month
-            self.check_and_reset_tokens()
-            
-            # Lock the row to prevent race conditions
-            limit_obj = UserTokenLimit.objects.select_for_update().get(id=self.id)
-            limit_obj.current_usage += amount
-            limit_obj.save(update_fields=['current_usage'])
-            
-            # Add to usage history
-            TokenUsage.objects.create(
-                user=self.user,
-                feature=feature or 'other',
-                tokens_used=amount,
-                **kwargs
-            )
-            
-            # Check if we need to create alerts
-            self.check_and_create_alerts()
 
 class TokenUsage(models.Model):
     """Model to track token usage"""
@@ -213,6 +180,10 @@ class TokenUsage(models.Model):
     feature = models.CharField(max_length=30, choices=FEATURE_CHOICES)
     tokens_used = models.IntegerField()
     
+    # Identifies the LLM call (the upstream response id where there is one),
+    # so a call recorded twice is stored once
+    call_id = models.CharField(max_length=100, null=True, blank=True, unique=True)
+    
     # Optional references to relate the usage to specific objects
     character_id = models.IntegerField(null=True, blank=True)
     conversation_id = models.IntegerField(null=True, blank=True)
@@ -233,37 +204,92 @@ class TokenUsage(models.Model):
         return f"{self.user.username} used {self.tokens_used} tokens for {self.feature}"
     
     @classmethod
-    def get_usage_summary(cls, user):
-        """Get a summary of token usage for a user"""
-        # Get the current billing period
-        today = timezone.now().date()
-        month_start = today.replace(day=1)
-        next_month = (today.replace(day=28) + timezone.timedelta(days=4)).replace(day=1)
+    def get_usage_summary(cls, user, start_date=None, end_date=None):
+        """
+        Get a summary of token usage for a user
+        Defaults to the current billing period, which is served from cached
+        counters; other periods (end_date exclusive) take one GROUP BY query.
+        """
+        if start_date is None and end_date is None:
+            return current_period_summary(user)
         
-        # Get usage for the current billing period
-        period_usage = cls.objects.filter(
-            user=user,
-            timestamp__date__gte=month_start,
-            timestamp__date__lt=next_month
+        month_start, next_month = period_bounds()
+        return summarize_usage(user, start_date or month_start, end_date or next_month)
+
+class TokenUsageDaily(models.Model):
+    """Daily token usage per user and feature, kept up to date as usage is logged"""
+    
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, 
+        on_delete=models.CASCADE, 
+        related_name='token_usage_days'
+    )
+    date = models.DateField()
+    feature = models.CharField(max_length=30, choices=TokenUsage.FEATURE_CHOICES)
+    tokens_used = models.BigIntegerField(default=0)
+    request_count = models.IntegerField(default=0)
+    
+    class Meta:
+        ordering = ['-date']
+        # Also the index for per-user date range queries
+        unique_together = ['user', 'date', 'feature']
+    
+    def __str__(self):
+        return f"{self.user_id} used {self.tokens_used} tokens for {self.feature} on {self.date}"
+    
+    @classmethod
+    def add_usage(cls, usage):
+        """Add a TokenUsage row to its day's totals (through the write-behind buffer)"""
+        day = timezone.localdate(usage.timestamp)
+        write_behind.upsert_increment(
+            cls,
+            {'user_id': usage.user_id, 'date': day, 'feature': usage.feature},
+            tokens_used=usage.tokens_used,
+            request_count=1
         )
-        
-        # Overall usage for the period
-        total_usage = period_usage.aggregate(Sum('tokens_used'))['tokens_used__sum'] or 0
-        
-        # Usage by feature
-        feature_usage = {}
-        for feature_choice in cls.FEATURE_CHOICES:
-            feature_code = feature_choice[0]
-            feature_usage[feature_code] = period_usage.filter(
-                feature=feature_code
-            ).aggregate(Sum('tokens_used'))['tokens_used__sum'] or 0
-        
-        return {
-            'total': total_usage,
-            'by_feature': feature_usage,
-            'period_start': month_start,
-            'period_end': next_month - timezone.timedelta(days=1),
-        }
+        # Keep the cached month-to-date summary in step once the rollup is written
+        write_behind.on_flush(
+            lambda: record_summary_usage(usage.user_id, usage.feature, usage.tokens_used, day)
+        )
+    
+    @classmethod
+    def daily_totals(cls, user, start_date, end_date, feature=None):
+        """Tokens used per day between two dates (inclusive), as {date: tokens}"""
+        days = cls.objects.filter(user=user, date__range=(start_date, end_date))
+        if feature:
+            days = days.filter(feature=feature)
+        return dict(days.values_list('date').annotate(total=Sum('tokens_used')).order_by())
+
+class TokenUsageArchive(models.Model):
+    """A user's TokenUsage rows for one month, moved out of the hot table by archive_token_usage"""
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='token_usage_archives'
+    )
+    month = models.IntegerField()  # 1-12
+    year = models.IntegerField()
+    row_count = models.IntegerField(default=0)
+    tokens_used = models.BigIntegerField(default=0)
+    feature_totals = models.JSONField(default=dict)
+
+    # The archived rows as zlib-compressed JSON lines (see token_management.archive)
+    rows = models.BinaryField()
+    archived_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-year', '-month']
+        # Also the index for per-user month lookups
+        unique_together = ['user', 'year', 'month']
+
+    def __str__(self):
+        return f"{self.user_id}'s archived usage for {self.month}/{self.year}: {self.row_count} rows"
+
+    def get_rows(self):
+        """The archived rows as unsaved TokenUsage instances, newest first"""
+        from token_management.archive import unpack_rows
+        return unpack_rows(self.rows, self.user_id)
 
 class TokenAlert(models.Model):
     """Model to track token usage alerts sent to users"""
@@ -299,6 +325,10 @@ class TokenAlert(models.Model):
         ordering = ['-created_at']
         # Ensure we don't create duplicate alerts for the same threshold in the same period
         unique_together = ['user', 'threshold', 'month', 'year']
+        indexes = [
+            # The admin changelist reads alerts by created_at range (its date hierarchy)
+            models.Index(fields=['created_at']),
+        ]
     
     def acknowledge(self):
         """Mark the alert as acknowledged"""
@@ -454,4 +484,9 @@ class TokenHistory(models.Model):
     def get_yearly_summary(cls, user, year):
         """Get monthly usage summary for a specific year"""
         return cls.objects.filter(user=user, year=year).order_by('month')
-    
\ No newline at end of file
+    
+
+# Drop the cached quota snapshot when the limit row is saved (resets, purchases, admin edits)
+@receiver(post_save, sender=UserTokenLimit)
+def invalidate_quota_snapshot(sender, instance, **kwargs):
+    invalidate_quota(instance.user_id)
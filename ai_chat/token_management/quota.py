@@ -0,0 +1,138 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Max
+from django.utils import timezone
+
+# Defaults for settings.TOKEN_QUOTA_CACHE; any key can be overridden there
+DEFAULT_QUOTA_CACHE_SETTINGS = {
+    # Django cache alias. With a per-process cache, other processes only see
+    # invalidations once their copy expires, so keep TTL short
+    'CACHE_ALIAS': 'default',
+    'TTL': 60,  # seconds
+}
+
+# Usage percentages at which a TokenAlert is raised, once per month
+ALERT_THRESHOLDS = (50, 80, 95, 100)
+
+# Bump when the snapshot's keys change so stale entries are ignored
+QUOTA_SNAPSHOT_VERSION = 2
+
+# UserTokenLimit fields kept in the snapshot for display (see snapshot_token_limit)
+TRIAL_FIELDS = ('is_trial', 'trial_start', 'trial_days', 'has_seen_conversion')
+
+
+def get_quota_cache_settings():
+    """Return the quota cache settings merged over the defaults"""
+    conf = dict(DEFAULT_QUOTA_CACHE_SETTINGS)
+    conf.update(getattr(settings, 'TOKEN_QUOTA_CACHE', {}))
+    return conf
+
+
+def quota_cache_key(user_id):
+    return f"token-quota:v{QUOTA_SNAPSHOT_VERSION}:{user_id}"
+
+
+def _cache():
+    return caches[get_quota_cache_settings()['CACHE_ALIAS']]
+
+
+def get_quota_snapshot(user):
+    """
+    The user's quota state for this month: usage, limit, the highest alert
+    threshold already raised and the trial fields
+    Served from the cache; a miss (or a new month) reloads it from the database.
+    """
+    snapshot = _cache().get(quota_cache_key(user.pk))
+    now = timezone.now()
+    if snapshot is not None and (snapshot['month'], snapshot['year']) == (now.month, now.year):
+        return snapshot
+
+    from token_management.models import UserTokenLimit
+    token_limit_obj, _ = UserTokenLimit.objects.get_or_create(user=user)
+    token_limit_obj.check_and_reset_tokens()
+    return refresh_quota_snapshot(token_limit_obj)
+
+
+def refresh_quota_snapshot(token_limit_obj):
+    """
+    Store a fresh snapshot for a UserTokenLimit whose current_usage is up to date
+    Alerts are created only for thresholds crossed since the last snapshot.
+    """
+    from token_management.models import TokenAlert
+    now = timezone.now()
+    previous = _cache().get(quota_cache_key(token_limit_obj.user_id))
+    if previous is not None and (previous['month'], previous['year']) == (now.month, now.year):
+        alerted = previous['alerted']
+    else:
+        alerted = TokenAlert.objects.filter(
+            user_id=token_limit_obj.user_id, month=now.month, year=now.year
+        ).aggregate(highest=Max('threshold'))['highest'] or 0
+
+    snapshot = {
+        'usage': token_limit_obj.current_usage,
+        'limit': token_limit_obj.monthly_limit,
+        'alerted': alerted,
+        'month': now.month,
+        'year': now.year,
+        **{field: getattr(token_limit_obj, field) for field in TRIAL_FIELDS},
+    }
+
+    percent_used = token_limit_obj.get_token_percent_used()
+    crossed = [threshold for threshold in ALERT_THRESHOLDS if alerted < threshold <= percent_used]
+    if crossed and not token_limit_obj.user.is_staff:
+        for threshold in crossed:
+            # get_or_create, since another process may have raised it first
+            TokenAlert.objects.get_or_create(
+                user_id=token_limit_obj.user_id,
+                threshold=threshold,
+                month=now.month,
+                year=now.year,
+                defaults={
+                    'usage_at_alert': token_limit_obj.current_usage,
+                    'limit_at_alert': token_limit_obj.monthly_limit
+                }
+            )
+        snapshot['alerted'] = crossed[-1]
+
+    _cache().set(quota_cache_key(token_limit_obj.user_id), snapshot, get_quota_cache_settings()['TTL'])
+    return snapshot
+
+
+def confirm_quota_snapshot(user, snapshot):
+    """
+    Check a snapshot against the database before acting on it
+    The snapshot may be another process's stale copy (e.g. after an admin
+    raised the limit or recomputed usage), so a user is only held to it once
+    one query agrees; a snapshot that doesn't match is refreshed.
+    """
+    from token_management.models import UserTokenLimit
+    token_limit_obj = UserTokenLimit.objects.select_related('user').get(user=user)
+    if (token_limit_obj.current_usage, token_limit_obj.monthly_limit) == (snapshot['usage'], snapshot['limit']):
+        return snapshot
+    token_limit_obj.check_and_reset_tokens()
+    return refresh_quota_snapshot(token_limit_obj)
+
+
+def snapshot_token_limit(user, snapshot):
+    """An unsaved UserTokenLimit holding the snapshot's values, for its display helpers"""
+    from token_management.models import UserTokenLimit
+    return UserTokenLimit(
+        user=user,
+        monthly_limit=snapshot['limit'],
+        current_usage=snapshot['usage'],
+        **{field: snapshot[field] for field in TRIAL_FIELDS}
+    )
+
+
+def is_over_limit(snapshot):
+    return snapshot['usage'] >= snapshot['limit']
+
+
+def invalidate_quota(user_id):
+    """Drop a user's snapshot so the next request reloads it"""
+    _cache().delete(quota_cache_key(user_id))
+
+
+def invalidate_quotas(user_ids):
+    """invalidate_quota for several users at once"""
+    _cache().delete_many([quota_cache_key(user_id) for user_id in user_ids])
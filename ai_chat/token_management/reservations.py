@@ -0,0 +1,102 @@
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+# Defaults for settings.TOKEN_RESERVATIONS; any key can be overridden there
+DEFAULT_TOKEN_RESERVATION_SETTINGS = {
+    'ENABLED': True,
+    # Reservations a crashed worker never settled are dropped once the user has
+    # reserved nothing for this long; keep it above the longest an LLM call can take
+    'TIMEOUT': 10 * 60,  # seconds
+}
+
+
+class QuotaExceeded(Exception):
+    """Raised when a user's remaining quota can't cover a call's estimated cost"""
+    pass
+
+
+def get_token_reservation_settings():
+    """Return the token reservation settings merged over the defaults"""
+    conf = dict(DEFAULT_TOKEN_RESERVATION_SETTINGS)
+    conf.update(getattr(settings, 'TOKEN_RESERVATIONS', {}))
+    return conf
+
+
+class TokenReservation:
+    """
+    Tokens held against a user's quota for one in-flight LLM call
+    The charge for the call settles the reservation (see UserTokenLimit.record_usage);
+    leaving the with block releases whatever is still held, so failed calls and
+    cache hits give their reservation back.
+    """
+
+    def __init__(self, user_id, amount):
+        self.user_id = user_id
+        self.amount = amount
+
+    def settle(self):
+        """Hand the reservation to the charge for the call; returns the amount it releases"""
+        amount, self.amount = self.amount, 0
+        return amount
+
+    def release(self):
+        """Give the reserved tokens back without charging anything"""
+        from token_management.models import UserTokenLimit
+        amount = self.settle()
+        if amount:
+            UserTokenLimit.objects.filter(user_id=self.user_id).update(reserved_tokens=F('reserved_tokens') - amount)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.amount:
+            await sync_to_async(self.release)()
+
+
+def reserve_tokens(user, amount):
+    """
+    Reserve amount tokens of the user's quota before making an LLM call
+    The check and the reservation are one conditional UPDATE, so concurrent
+    calls can't overspend together and no row lock is held during the call.
+    Raises QuotaExceeded if usage plus reservations would pass the monthly
+    limit; staff aren't limited.
+    """
+    from token_management.models import UserTokenLimit
+    conf = get_token_reservation_settings()
+    if not conf['ENABLED'] or amount <= 0:
+        return TokenReservation(user.pk, 0)
+
+    if _try_reserve(user, amount, conf):
+        return TokenReservation(user.pk, amount)
+
+    # Either there is no row yet or it still holds last month's usage; fix that and retry
+    token_limit_obj, created = UserTokenLimit.objects.get_or_create(user=user)
+    reset = token_limit_obj.check_and_reset_tokens()
+    if not (created or reset) or not _try_reserve(user, amount, conf):
+        raise QuotaExceeded("Not enough tokens left this month for this request.")
+    return TokenReservation(user.pk, amount)
+
+
+def _try_reserve(user, amount, conf):
+    from token_management.models import UserTokenLimit
+    now = timezone.now()
+    # Everything held since before the timeout is left over from calls that never settled
+    held = Case(
+        When(Q(reserved_at__lt=now - timedelta(seconds=conf['TIMEOUT'])) | Q(reserved_tokens__lt=0), then=Value(0)),
+        default=F('reserved_tokens'),
+    )
+    rows = UserTokenLimit.objects.filter(user=user)
+    if not user.is_staff:
+        rows = rows.filter(current_usage__lte=F('monthly_limit') - held - amount)
+    return rows.update(reserved_tokens=held + amount, reserved_at=now) > 0
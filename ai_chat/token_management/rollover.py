@@ -0,0 +1,92 @@
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from token_management.quota import invalidate_quotas
+
+
+def month_start(now=None):
+    """Start of the month now falls in; limits last reset before it are due a rollover"""
+    now = now or timezone.now()
+    return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def rollover_token_limits(queryset=None, batch_size=1000, now=None):
+    """
+    Close last month for every UserTokenLimit (in queryset) not reset this month
+    Works through the limits in pk order, with one TokenHistory bulk insert and
+    one UPDATE per chunk. The UPDATE subtracts the usage it archived rather
+    than zeroing it, so charges landing meanwhile count towards the new month,
+    and it skips limits another rollover got to first.
+    Returns the number of limits rolled over.
+    """
+    from token_management.models import TokenHistory, UserTokenLimit
+    now = now or timezone.now()
+    boundary = month_start(now)
+    due = (UserTokenLimit.objects.all() if queryset is None else queryset).filter(last_reset__lt=boundary)
+
+    rolled = 0
+    last_pk = 0
+    while True:
+        chunk = list(
+            due.filter(pk__gt=last_pk).order_by('pk')
+            .values('pk', 'user_id', 'current_usage', 'monthly_limit', 'last_reset')[:batch_size]
+        )
+        if not chunk:
+            return rolled
+        last_pk = chunk[-1]['pk']
+
+        with transaction.atomic():
+            # A month already archived (by a concurrent rollover) keeps its record
+            TokenHistory.objects.bulk_create([
+                TokenHistory(
+                    user_id=row['user_id'],
+                    month=row['last_reset'].month,
+                    year=row['last_reset'].year,
+                    total_usage=row['current_usage'],
+                    allocated_limit=row['monthly_limit'],
+                )
+                for row in chunk
+            ], ignore_conflicts=True)
+
+            archived = Case(
+                *[When(pk=row['pk'], then=Value(row['current_usage'])) for row in chunk],
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+            rolled += UserTokenLimit.objects.filter(
+                pk__in=[row['pk'] for row in chunk], last_reset__lt=boundary
+            ).update(current_usage=F('current_usage') - archived, last_reset=now)
+
+        invalidate_quotas([row['user_id'] for row in chunk])
+
+
+def recompute_current_usage(queryset, batch_size=1000):
+    """
+    Set current_usage of the UserTokenLimits in queryset to this month's TokenUsage total
+    One UPDATE with a correlated SUM per user, which the (user, timestamp)
+    index serves; limits still on last month are rolled over first. Cached
+    quotas are dropped batch_size users at a time.
+    Returns the number of limits updated.
+    """
+    from token_management.ledger import usage_ledger
+    from token_management.models import TokenUsage
+
+    # Buffered ledger entries have to be in the table to be counted
+    usage_ledger.flush()
+    rollover_token_limits(queryset)
+
+    month_usage = TokenUsage.objects.filter(
+        user_id=OuterRef('user_id'), timestamp__gte=month_start()
+    ).values('user_id').annotate(total=Sum('tokens_used')).values('total')
+    updated = queryset.update(current_usage=Coalesce(Subquery(month_usage), 0))
+
+    user_ids = queryset.values_list('user_id', flat=True).iterator(chunk_size=batch_size)
+    while True:
+        chunk = list(islice(user_ids, batch_size))
+        if not chunk:
+            return updated
+        invalidate_quotas(chunk)
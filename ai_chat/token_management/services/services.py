@@ -169,19 +169,11 @@ class TokenUsageService:
         Returns:
             Updated UserTokenLimit object
         """
-        with transaction.atomic():
-            try:
-                # Get and lock the user's token limit
-                token_limit = UserTokenLimit.objects.select_for_update().get(user=user)
-                
-                # Update usage
-                token_limit.update_token_usage(tokens_used, feature, **kwargs)
-                
-                return token_limit
-                
-            except UserTokenLimit.DoesNotExist:
-                # Create token limit if it doesn't exist
-                token_limit = UserTokenLimit.objects.create(user=user)
-                token_limit.update_token_usage(tokens_used, feature, **kwargs)
-                
-                return token_limit
\ No newline at end of file
+        # Create token limit if it doesn't exist. No lock is needed: the
+        # charge is an F() increment
+        token_limit, _ = UserTokenLimit.objects.get_or_create(user=user)
+        
+        # Update usage
+        token_limit.update_token_usage(tokens_used, feature, **kwargs)
+        
+        return token_limit
\ No newline at end of file
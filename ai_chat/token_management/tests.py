@@ -1,3 +1,590 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F, Sum
+from django.http import HttpResponse
+from django.template import engines
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from core.paginator import EstimatedCountPaginator
+from core.services.openai_service import OpenAIService
+from core.services.write_behind import write_behind
+from . import archive
+from .ledger import usage_ledger
+from .middleware import TokenUsageMiddleware
+from .archive import archive_token_usage, archived_usage
+from .models import TokenAlert, TokenHistory, TokenUsage, TokenUsageArchive, TokenUsageDaily, UserTokenLimit
+from .quota import quota_cache_key
+from .reservations import QuotaExceeded, reserve_tokens
+
+User = get_user_model()
+
+
+class QuotaSnapshotTests(TestCase):
+    """Test cases for the cached quota state behind TokenUsageMiddleware"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='metered', password='testpassword123')
+        self.token_limit = UserTokenLimit.objects.get(user=self.user)
+        self.token_limit.monthly_limit = 1000
+        self.token_limit.save()
+        self.middleware = TokenUsageMiddleware(lambda request: HttpResponse('ok'))
+
+    def get(self, path='/conversations/'):
+        request = RequestFactory().get(path)
+        request.user = self.user
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        return self.middleware(request)
+
+    def record(self, amount):
+        token_limit = UserTokenLimit.objects.get(user=self.user)
+        with write_behind():
+            token_limit.record_usage(amount)
+
+    def test_middleware_reads_cached_snapshot(self):
+        self.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get().status_code, 200)
+
+    def test_alerts_are_raised_once_when_crossed(self):
+        self.record(600)
+        self.assertEqual(list(TokenAlert.objects.values_list('threshold', flat=True)), [50])
+
+        # Staying between thresholds raises nothing and reads no alerts
+        self.record(100)
+        self.assertEqual(TokenAlert.objects.count(), 1)
+
+        self.record(300)
+        self.assertEqual(sorted(TokenAlert.objects.values_list('threshold', flat=True)), [50, 80, 95, 100])
+
+    def test_over_limit_is_confirmed_before_redirecting(self):
+        self.record(1000)
+        with self.assertNumQueries(1):
+            response = self.get()
+        self.assertEqual(response.status_code, 302)
+
+        # Exempt pages stay reachable
+        self.assertEqual(self.get('/token-management/purchase/').status_code, 200)
+
+    def test_limit_change_refreshes_snapshot(self):
+        self.record(1000)
+        self.assertEqual(self.get().status_code, 302)
+
+        self.token_limit.refresh_from_db()
+        self.token_limit.monthly_limit = 5000
+        self.token_limit.save(update_fields=['monthly_limit'])
+        self.assertEqual(self.get().status_code, 200)
+
+    def test_stale_snapshot_doesnt_block(self):
+        self.record(1000)
+        self.assertEqual(self.get().status_code, 302)
+
+        # A change made elsewhere, whose invalidation never reached this process's cache
+        UserTokenLimit.objects.filter(user=self.user).update(monthly_limit=5000)
+        self.assertEqual(self.get().status_code, 200)
+        self.assertEqual(cache.get(quota_cache_key(self.user.pk))['limit'], 5000)
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class DailyRollupTests(TestCase):
+    """Test cases for the daily token usage rollup"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='charted', password='testpassword123', is_staff=True)
+        self.client.force_login(self.user)
+
+    def test_logged_usage_is_rolled_up(self):
+        service = OpenAIService(self.user)
+        with write_behind():
+            service._log_token_usage('character_chat', 100)
+            service._log_token_usage('character_chat', 50)
+            service._log_token_usage('memory_summarization', 30)
+
+        day = TokenUsageDaily.objects.get(user=self.user, feature='character_chat')
+        self.assertEqual((day.tokens_used, day.request_count), (150, 2))
+
+        with self.assertNumQueries(1):
+            totals = TokenUsageDaily.daily_totals(self.user, timezone.localdate() - timedelta(days=1), timezone.localdate())
+        self.assertEqual(totals, {timezone.localdate(): 180})
+
+    def test_api_uses_rollup(self):
+        OpenAIService(self.user)._log_token_usage('character_chat', 75)
+
+        response = self.client.get(reverse('token_management:token_usage_api'), {'days': 365})
+
+        usage_data = response.json()['usage_data']
+        self.assertEqual(len(usage_data), 366)
+        self.assertEqual(usage_data[-1], {'date': timezone.localdate().strftime('%Y-%m-%d'), 'tokens': 75})
+
+    def test_backfill_rebuilds_from_usage_rows(self):
+        TokenUsage.objects.create(user=self.user, feature='character_chat', tokens_used=10,
+                                  timestamp=timezone.now() - timedelta(days=3))
+        TokenUsage.objects.create(user=self.user, feature='character_chat', tokens_used=20,
+                                  timestamp=timezone.now() - timedelta(days=3))
+        TokenUsage.objects.create(user=self.user, feature='other', tokens_used=5)
+
+        call_command('backfill_token_usage_daily', stdout=StringIO())
+
+        self.assertEqual(
+            sorted(TokenUsageDaily.objects.values_list('feature', 'tokens_used', 'request_count')),
+            [('character_chat', 30, 2), ('other', 5, 1)]
+        )
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False})
+class UsageSummaryTests(TestCase):
+    """Test cases for TokenUsage.get_usage_summary"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='summed', password='testpassword123', is_staff=True)
+        self.service = OpenAIService(self.user)
+
+    def test_current_period_is_cached_and_kept_up_to_date(self):
+        self.service._log_token_usage('character_chat', 100)
+        self.service._log_token_usage('world_building', 40)
+
+        with self.assertNumQueries(1):
+            summary = TokenUsage.get_usage_summary(self.user)
+        self.assertEqual(summary['total'], 140)
+        self.assertEqual(summary['by_feature']['character_chat'], 100)
+        self.assertEqual(summary['by_feature']['other'], 0)
+
+        self.service._log_token_usage('character_chat', 25)
+        with self.assertNumQueries(0):
+            summary = TokenUsage.get_usage_summary(self.user)
+        self.assertEqual(summary['total'], 165)
+        self.assertEqual(summary['by_feature']['character_chat'], 125)
+
+    def test_other_periods_take_one_query(self):
+        TokenUsage.objects.create(user=self.user, feature='character_chat', tokens_used=10,
+                                  timestamp=timezone.now() - timedelta(days=40))
+        TokenUsage.objects.create(user=self.user, feature='other', tokens_used=5)
+
+        today = timezone.localdate()
+        with self.assertNumQueries(1):
+            summary = TokenUsage.get_usage_summary(self.user, today - timedelta(days=60), today + timedelta(days=1))
+        self.assertEqual(summary['total'], 15)
+        self.assertEqual(summary['by_feature']['character_chat'], 10)
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': True, 'BATCH_SIZE': 3, 'FLUSH_INTERVAL': 60})
+class UsageLedgerTests(TestCase):
+    """Test cases for the buffered TokenUsage ledger"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='ledgered', password='testpassword123', is_staff=True)
+        self.token_limit, _ = UserTokenLimit.objects.get_or_create(user=self.user)
+        # Nothing buffered here may outlive the test's transaction
+        self.addCleanup(usage_ledger.flush)
+
+    def test_entries_are_inserted_in_batches(self):
+        self.token_limit.update_token_usage(10, 'character_chat', call_id='call-1')
+        self.token_limit.update_token_usage(20, 'character_chat', call_id='call-2')
+        self.assertFalse(TokenUsage.objects.filter(user=self.user).exists())
+
+        with CaptureQueriesContext(connection) as queries:
+            self.token_limit.update_token_usage(30, 'world_building', call_id='call-3')
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT') and 'INTO "token_management_tokenusage"' in q['sql']]
+        self.assertEqual(len(inserts), 1)
+
+        self.assertEqual(TokenUsage.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(len(usage_ledger), 0)
+        day = TokenUsageDaily.objects.get(user=self.user, feature='character_chat')
+        self.assertEqual((day.tokens_used, day.request_count), (30, 2))
+
+    def test_call_recorded_twice_is_stored_once(self):
+        self.token_limit.update_token_usage(10, 'character_chat', call_id='call-1')
+        self.token_limit.update_token_usage(10, 'character_chat', call_id='call-1')
+        usage_ledger.flush()
+        self.token_limit.update_token_usage(10, 'character_chat', call_id='call-1')
+        usage_ledger.flush()
+
+        self.assertEqual(TokenUsage.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(TokenUsageDaily.objects.get(user=self.user).request_count, 1)
+
+    @override_settings(USAGE_LEDGER={'BUFFERED': False})
+    def test_flush_inside_a_request_buffer_writes_on_its_own(self):
+        with write_behind():
+            self.token_limit.update_token_usage(10, 'character_chat', call_id='call-1')
+            self.token_limit.update_token_usage(10, 'character_chat', call_id='call-1')
+            # Already in the table, before the request's buffer is flushed
+            self.assertEqual(TokenUsage.objects.filter(user=self.user).count(), 1)
+
+        self.assertEqual(TokenUsage.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(UserTokenLimit.objects.get(user=self.user).current_usage, 20)
+
+    def test_failed_flush_keeps_entries(self):
+        self.token_limit.update_token_usage(10, 'character_chat', call_id='call-1')
+        with mock.patch('token_management.models.TokenUsage.objects.bulk_create', side_effect=RuntimeError('db down')):
+            self.assertEqual(usage_ledger.flush(), 0)
+        self.assertEqual(len(usage_ledger), 1)
+
+        self.assertEqual(usage_ledger.flush(), 1)
+        self.assertEqual(TokenUsage.objects.filter(user=self.user).count(), 1)
+
+    def test_row_inserted_meanwhile_isnt_counted_twice(self):
+        self.token_limit.update_token_usage(10, 'character_chat', call_id='call-1')
+        self.token_limit.update_token_usage(20, 'character_chat', call_id='call-2')
+        # Another process stores call-1 after the dedup check has looked for it
+        usage = TokenUsage.objects.create(user=self.user, feature='character_chat', tokens_used=10, call_id='call-1')
+        TokenUsageDaily.add_usage(usage)
+
+        with mock.patch.object(TokenUsage.objects, 'filter', return_value=TokenUsage.objects.none()):
+            self.assertEqual(usage_ledger.flush(), 0)
+        self.assertEqual(usage_ledger.flush(), 1)
+
+        self.assertEqual(TokenUsage.objects.filter(user=self.user).count(), 2)
+        daily = TokenUsageDaily.objects.get(user=self.user, feature='character_chat')
+        self.assertEqual((daily.tokens_used, daily.request_count), (30, 2))
+
+    def test_each_llm_call_writes_one_entry(self):
+        service = OpenAIService(self.user)
+        service._log_token_usage('character_chat', 100, call_id='chatcmpl-1')
+        service._log_token_usage('character_chat', 50)
+
+        self.assertEqual(usage_ledger.flush(), 2)
+        self.assertEqual(
+            sorted(TokenUsage.objects.filter(user=self.user).values_list('tokens_used', flat=True)), [50, 100]
+        )
+        self.assertTrue(TokenUsage.objects.filter(call_id='chatcmpl-1').exists())
+
+
+@override_settings(LLM_RESPONSE_CACHE={'ENABLED': False}, USAGE_LEDGER={'BUFFERED': False})
+class TokenReservationTests(TestCase):
+    """Test cases for reserving quota before LLM calls"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='reserved', password='testpassword123')
+        UserTokenLimit.objects.filter(user=self.user).update(monthly_limit=3000)
+
+    def token_limit(self):
+        return UserTokenLimit.objects.get(user=self.user)
+
+    def test_reservations_cannot_overspend_together(self):
+        first = reserve_tokens(self.user, 2000)
+        with self.assertRaises(QuotaExceeded):
+            reserve_tokens(self.user, 2000)
+
+        first.release()
+        reserve_tokens(self.user, 2000)
+        self.assertEqual(self.token_limit().reserved_tokens, 2000)
+
+    def test_charge_settles_the_reservation(self):
+        completion = SimpleNamespace(
+            id='chatcmpl-reserved',
+            choices=[SimpleNamespace(message=SimpleNamespace(content='{"voice": "Calm"}'))],
+            usage=SimpleNamespace(prompt_tokens=200, completion_tokens=100, total_tokens=300),
+        )
+        with mock.patch('core.services.openai_service.routed_chat_completion', return_value=completion):
+            OpenAIService(self.user).create_character('Ada', 'A mathematician')
+
+        token_limit = self.token_limit()
+        self.assertEqual((token_limit.current_usage, token_limit.reserved_tokens), (300, 0))
+
+    def test_failed_call_releases_the_reservation(self):
+        with mock.patch('core.services.openai_service.routed_chat_completion', side_effect=RuntimeError('down')):
+            with self.assertRaises(RuntimeError):
+                OpenAIService(self.user).create_character('Ada', 'A mathematician')
+
+        token_limit = self.token_limit()
+        self.assertEqual((token_limit.current_usage, token_limit.reserved_tokens), (0, 0))
+
+    def test_call_that_cannot_fit_is_not_made(self):
+        UserTokenLimit.objects.filter(user=self.user).update(current_usage=2500)
+        with mock.patch('core.services.openai_service.routed_chat_completion') as completion:
+            with self.assertRaises(QuotaExceeded):
+                OpenAIService(self.user).create_character('Ada', 'A mathematician')
+        self.assertFalse(completion.called)
+
+    def test_stale_reservations_are_dropped(self):
+        UserTokenLimit.objects.filter(user=self.user).update(
+            reserved_tokens=2500, reserved_at=timezone.now() - timedelta(hours=1)
+        )
+        reserve_tokens(self.user, 2000)
+        self.assertEqual(self.token_limit().reserved_tokens, 2000)
+
+    def test_new_month_is_reset_once(self):
+        last_month = timezone.now() - timedelta(days=40)
+        UserTokenLimit.objects.filter(user=self.user).update(current_usage=2900, last_reset=last_month)
+        first, second = self.token_limit(), self.token_limit()
+
+        self.assertTrue(first.check_and_reset_tokens())
+        self.assertFalse(second.check_and_reset_tokens())
+        self.assertEqual(second.current_usage, 0)
+        self.assertEqual(list(TokenHistory.objects.filter(user=self.user).values_list('total_usage', flat=True)), [2900])
+
+        # The reset happens on the way to a reservation too
+        UserTokenLimit.objects.filter(user=self.user).update(
+            current_usage=2900, last_reset=timezone.now() - timedelta(days=75)
+        )
+        reserve_tokens(self.user, 2000)
+        self.assertEqual(self.token_limit().current_usage, 0)
+
+
+class TokenUsageContextProcessorTests(TestCase):
+    """Test cases for the lazy token_usage context processor"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='templated', password='testpassword123')
+        UserTokenLimit.objects.filter(user=self.user).update(monthly_limit=1000, current_usage=250)
+        self.request = RequestFactory().get('/conversations/')
+        self.request.user = self.user
+
+    def render(self, source):
+        return engines['django'].from_string(source).render({}, self.request)
+
+    def test_unused_values_cost_nothing(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render('Server error'), 'Server error')
+
+    def test_values_are_computed_once_per_request(self):
+        self.render('{{ token_usage }}')
+        with self.assertNumQueries(1):
+            rendered = self.render('{{ token_usage }}/{{ token_limit }} {{ token_percent|floatformat:0 }}% {{ token_alerts }}')
+        self.assertEqual(rendered, '250/1000 25% 0')
+        with self.assertNumQueries(0):
+            self.render('{% if token_percent >= 20 %}{{ token_alerts }}{% endif %} {{ trial_days_left }}')
+
+    def test_snapshot_loaded_by_middleware_is_reused(self):
+        TokenUsageMiddleware(lambda request: HttpResponse('ok'))(self.request)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render('{{ token_usage }} {{ is_trial }}'), '250 True')
+
+
+class RolloverTests(TestCase):
+    """Test cases for the rollover_token_limits command"""
+
+    def setUp(self):
+        self.last_month = timezone.now() - timedelta(days=40)
+        self.users = [User.objects.create_user(username=f'roller{i}', password='testpassword123') for i in range(3)]
+        for i, user in enumerate(self.users):
+            UserTokenLimit.objects.filter(user=user).update(current_usage=100 * (i + 1), last_reset=self.last_month)
+        self.current = User.objects.create_user(username='current', password='testpassword123')
+        UserTokenLimit.objects.filter(user=self.current).update(current_usage=50)
+
+    def test_rolls_over_due_limits_in_chunks(self):
+        out = StringIO()
+        call_command('rollover_token_limits', batch_size=2, stdout=out)
+
+        self.assertIn('Rolled over 3 token limits', out.getvalue())
+        self.assertEqual(
+            sorted(TokenHistory.objects.values_list('user__username', 'month', 'total_usage')),
+            [(f'roller{i}', self.last_month.month, 100 * (i + 1)) for i in range(3)]
+        )
+        self.assertEqual(set(UserTokenLimit.objects.filter(user__in=self.users).values_list('current_usage', flat=True)), {0})
+        self.assertEqual(UserTokenLimit.objects.get(user=self.current).current_usage, 50)
+
+        # Nothing is left for the per-request check to write
+        token_limit = UserTokenLimit.objects.get(user=self.users[0])
+        with self.assertNumQueries(0):
+            self.assertFalse(token_limit.check_and_reset_tokens())
+
+        call_command('rollover_token_limits', stdout=out)
+        self.assertIn('Rolled over 0 token limits', out.getvalue())
+        self.assertEqual(TokenHistory.objects.count(), 3)
+
+    def test_usage_charged_after_the_read_is_kept(self):
+        token_limit = UserTokenLimit.objects.get(user=self.users[0])
+        # A charge lands between the rollover reading the row and updating it
+        original_bulk_create = TokenHistory.objects.bulk_create
+
+        def charge_then_insert(*args, **kwargs):
+            UserTokenLimit.objects.filter(pk=token_limit.pk).update(current_usage=F('current_usage') + 25)
+            return original_bulk_create(*args, **kwargs)
+
+        with mock.patch.object(TokenHistory.objects, 'bulk_create', side_effect=charge_then_insert):
+            self.assertTrue(token_limit.check_and_reset_tokens())
+
+        self.assertEqual(token_limit.current_usage, 25)
+        self.assertEqual(TokenHistory.objects.get(user=self.users[0]).total_usage, 100)
+
+
+class ExportTests(TestCase):
+    """Test cases for the streaming token data exports"""
+
+    def setUp(self):
+        self.staff = User.objects.create_user(username='finance', password='testpassword123', is_staff=True)
+        self.user = User.objects.create_user(username='spender', password='testpassword123')
+        TokenUsage.objects.create(user=self.user, feature='character_chat', tokens_used=10)
+        TokenUsage.objects.create(user=self.user, feature='world_building', tokens_used=20)
+        TokenUsage.objects.create(user=self.user, feature='character_chat', tokens_used=30,
+                                  timestamp=timezone.now() - timedelta(days=60))
+        TokenUsage.objects.create(user=self.staff, feature='character_chat', tokens_used=40)
+        self.client.force_login(self.staff)
+
+    def export(self, dataset, **params):
+        return self.client.get(reverse('token_management:export', args=[dataset]), params)
+
+    def test_usage_streams_as_filtered_csv(self):
+        today = timezone.localdate()
+        response = self.export('usage', user='spender', feature='character_chat',
+                               start=(today - timedelta(days=7)).isoformat(), end=today.isoformat())
+
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0].split(',')[:6], ['id', 'user_id', 'user__username', 'timestamp', 'feature', 'tokens_used'])
+        self.assertEqual([line.split(',')[5] for line in lines[1:]], ['10'])
+
+    def test_jsonl_and_bad_filters(self):
+        lines = b''.join(self.export('usage', format='jsonl', user=self.user.pk).streaming_content).decode().splitlines()
+        self.assertEqual(sorted(json.loads(line)['tokens_used'] for line in lines), [10, 20, 30])
+
+        self.assertEqual(self.export('usage', start='yesterday').status_code, 400)
+        self.assertEqual(self.export('history', feature='character_chat').status_code, 400)
+        self.assertEqual(self.export('ledgers').status_code, 400)
+
+    def test_staff_only(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.export('usage').status_code, 302)
+
+    def test_command_exports_history(self):
+        TokenHistory.objects.create(user=self.user, month=1, year=2024, total_usage=500, allocated_limit=1000)
+        TokenHistory.objects.create(user=self.user, month=3, year=2024, total_usage=700, allocated_limit=1000)
+
+        out = StringIO()
+        call_command('export_token_data', 'history', '--format', 'jsonl', '--start', '2024-02-15', stdout=out)
+
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(row['month'], row['total_usage']) for row in rows], [(3, 700)])
+
+
+class LedgerAdminTests(TestCase):
+    """Test cases for the token ledger admin pages"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='root', password='testpassword123', email='root@example.com')
+        self.user = User.objects.create_user(username='audited', password='testpassword123')
+        for tokens in (10, 20, 30):
+            TokenUsage.objects.create(user=self.user, feature='character_chat', tokens_used=tokens)
+        TokenUsage.objects.create(user=self.user, feature='other', tokens_used=99,
+                                  timestamp=timezone.now() - timedelta(days=62))
+        self.client.force_login(self.admin)
+
+    def test_changelist_opens_on_current_month(self):
+        url = reverse('admin:token_management_tokenusage_changelist')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('timestamp__month=', response.url)
+
+        response = self.client.get(response.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+    def test_changelist_keeps_filters_and_all_dates(self):
+        url = reverse('admin:token_management_tokenusage_changelist')
+        response = self.client.get(url, {'feature': 'other'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+        # "All dates" links back to the bare changelist from the changelist itself
+        response = self.client.get(url, headers={'Referer': f'http://testserver{url}?timestamp__year=2025'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 4)
+
+    def test_paginator_caps_and_estimates_counts(self):
+        with mock.patch.object(EstimatedCountPaginator, 'COUNT_LIMIT', 2):
+            self.assertEqual(EstimatedCountPaginator(TokenUsage.objects.filter(user=self.user), 10).count, 2)
+            with mock.patch('core.paginator.estimated_row_count', return_value=5000000):
+                self.assertEqual(EstimatedCountPaginator(TokenUsage.objects.all(), 10).count, 5000000)
+                self.assertEqual(EstimatedCountPaginator(TokenUsage.objects.filter(feature='other'), 10).count, 1)
+
+    def test_recompute_usage_action(self):
+        UserTokenLimit.objects.filter(user=self.user).update(current_usage=12345)
+        usage = TokenUsage.objects.filter(user=self.user).first()
+
+        self.client.post(reverse('admin:token_management_tokenusage_changelist'), {
+            'action': 'recompute_usage',
+            '_selected_action': [usage.pk],
+        })
+
+        self.assertEqual(UserTokenLimit.objects.get(user=self.user).current_usage, 60)
+
+
+@override_settings(USAGE_LEDGER={'BUFFERED': False}, TOKEN_USAGE_ARCHIVE={'MONTHS': 6})
+class UsageArchiveTests(TestCase):
+    """Test cases for moving cold TokenUsage rows to the usage archive"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='archived', password='testpassword123')
+        self.old = timezone.now() - timedelta(days=300)
+        for tokens, feature in ((10, 'character_chat'), (20, 'character_chat'), (5, 'other')):
+            TokenUsage.objects.create(user=self.user, feature=feature, tokens_used=tokens, timestamp=self.old)
+        TokenUsage.objects.create(user=self.user, feature='other', tokens_used=7)
+        call_command('backfill_token_usage_daily', stdout=StringIO())
+
+    def test_cold_rows_move_to_archive(self):
+        call_command('archive_token_usage', stdout=StringIO())
+
+        self.assertEqual(list(TokenUsage.objects.filter(user=self.user).values_list('tokens_used', flat=True)), [7])
+        archive = TokenUsageArchive.objects.get(user=self.user)
+        self.assertEqual((archive.year, archive.month), (self.old.year, self.old.month))
+        self.assertEqual((archive.row_count, archive.tokens_used), (3, 35))
+        self.assertEqual(archive.feature_totals, {'character_chat': 30, 'other': 5})
+        self.assertEqual(sorted(usage.tokens_used for usage in archive.get_rows()), [5, 10, 20])
+        self.assertEqual(archive.get_rows()[0].timestamp, self.old)
+
+    def test_month_not_in_rollup_is_kept(self):
+        TokenUsage.objects.create(user=self.user, feature='other', tokens_used=1, timestamp=self.old)
+
+        result = archive_token_usage()
+
+        self.assertEqual(result['skipped'], [(self.user.pk, self.old.year, self.old.month)])
+        self.assertFalse(TokenUsageArchive.objects.exists())
+        self.assertEqual(TokenUsage.objects.filter(user=self.user).count(), 5)
+
+    def test_month_emptied_while_archiving_is_skipped(self):
+        archive_month = archive._archive_month
+
+        def emptied(user_id, year, month, existing=None):
+            TokenUsage.objects.filter(user_id=user_id, timestamp=self.old).delete()
+            return archive_month(user_id, year, month, existing)
+
+        with mock.patch('token_management.archive._archive_month', side_effect=emptied):
+            result = archive_token_usage()
+
+        self.assertEqual(result['skipped'], [(self.user.pk, self.old.year, self.old.month)])
+        self.assertFalse(TokenUsageArchive.objects.exists())
+
+    def test_history_reads_fall_back_to_archive(self):
+        archive_token_usage()
+        start = timezone.localdate(self.old) - timedelta(days=1)
+
+        summary = TokenUsage.get_usage_summary(self.user, start, timezone.localdate() + timedelta(days=1))
+        self.assertEqual(summary['total'], 42)
+        self.assertEqual(summary['by_feature']['character_chat'], 30)
+        self.assertEqual(len(archived_usage(self.user, start, timezone.now())), 3)
+
+        # The history template isn't part of this tree, so read the view's context
+        self.client.force_login(self.user)
+        with mock.patch('token_management.views.render', return_value=HttpResponse()) as render:
+            self.client.get(reverse('token_management:token_history'), {
+                'start_date': start.isoformat(), 'end_date': timezone.localdate(self.old + timedelta(days=1)).isoformat(),
+            })
+        context = render.call_args.args[2]
+        self.assertEqual(sorted(usage.tokens_used for usage in context['usage_history']), [5, 10, 20])
+
+    def test_backfill_keeps_archived_days(self):
+        archive_token_usage()
+
+        call_command('backfill_token_usage_daily', stdout=StringIO())
+
+        self.assertEqual(
+            TokenUsageDaily.objects.filter(user=self.user, date=timezone.localdate(self.old))
+            .aggregate(total=Sum('tokens_used'))['total'],
+            35
+        )
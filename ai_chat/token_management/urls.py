@@ -12,6 +12,7 @@ urlpatterns = [
     path('purchase/', views.purchase_tokens, name='purchase_tokens'),
     path('history/', views.token_history, name='token_history'),
     path('history/', views.usage_history, name='usage_history'),
+    path('limit-reached/', views.limit_reached, name='limit_reached'),
     
     # Subscription management
     path('subscription/', views.subscription_management, name='subscription'),
@@ -23,6 +24,9 @@ urlpatterns = [
     # API endpoints for token usage
     path('api/usage/', views.token_usage_api, name='token_usage_api'),
     
+    # Streaming CSV/JSONL exports for staff (usage, purchases, history)
+    path('export/<str:dataset>/', views.export_token_data, name='export'),
+    
     # Usage settings and limits
     path('settings/', views.usage_settings, name='usage_settings'),
     
@@ -0,0 +1,108 @@
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Sum
+from django.utils import timezone
+
+# Defaults for settings.TOKEN_USAGE_SUMMARY; any key can be overridden there
+DEFAULT_USAGE_SUMMARY_SETTINGS = {
+    # Django cache alias. Counters are only bumped in the process that flushes
+    # the usage, so with a per-process cache others catch up once their copy
+    # expires and is rebuilt from the daily rollup; keep TTL short
+    'CACHE_ALIAS': 'default',
+    'TTL': 60,  # seconds
+}
+
+TOTAL = '__total__'
+
+
+def get_usage_summary_settings():
+    """Return the usage summary settings merged over the defaults"""
+    conf = dict(DEFAULT_USAGE_SUMMARY_SETTINGS)
+    conf.update(getattr(settings, 'TOKEN_USAGE_SUMMARY', {}))
+    return conf
+
+
+def _cache():
+    return caches[get_usage_summary_settings()['CACHE_ALIAS']]
+
+
+def period_bounds(day=None):
+    """First day of day's month and first day of the next month"""
+    day = day or timezone.localdate()
+    month_start = day.replace(day=1)
+    next_month = (month_start + timedelta(days=32)).replace(day=1)
+    return month_start, next_month
+
+
+def _summary_keys(user_id, month_start):
+    from token_management.models import TokenUsage
+    prefix = f"token-usage-summary:{user_id}:{month_start:%Y-%m}"
+    return {feature: f"{prefix}:{feature}" for feature, _ in TokenUsage.FEATURE_CHOICES + ((TOTAL, ''),)}
+
+
+def _summary(totals, month_start, next_month):
+    from token_management.models import TokenUsage
+    return {
+        'total': sum(totals.values()),
+        'by_feature': {feature: totals.get(feature, 0) for feature, _ in TokenUsage.FEATURE_CHOICES},
+        'period_start': month_start,
+        'period_end': next_month - timedelta(days=1),
+    }
+
+
+def summarize_usage(user, start_date, end_date):
+    """
+    Token usage per feature between two dates (end exclusive)
+    One GROUP BY over a timestamp range, so the (user, timestamp) index applies,
+    plus whatever of the range has been moved to the usage archive.
+    """
+    from token_management.archive import archived_feature_totals
+    from token_management.models import TokenUsage
+    start = timezone.make_aware(datetime.combine(start_date, time.min))
+    end = timezone.make_aware(datetime.combine(end_date, time.min))
+    totals = dict(
+        TokenUsage.objects.filter(user=user, timestamp__gte=start, timestamp__lt=end)
+        .values_list('feature').annotate(total=Sum('tokens_used')).order_by()
+    )
+    for feature, tokens in archived_feature_totals(user, start, end).items():
+        totals[feature] = totals.get(feature, 0) + tokens
+    return _summary(totals, start_date, end_date)
+
+
+def current_period_summary(user):
+    """
+    This month's usage per feature
+    Served from per-feature cache counters that record_summary_usage keeps up
+    to date; a miss is rebuilt with one GROUP BY over the daily rollup.
+    """
+    from token_management.models import TokenUsageDaily
+    month_start, next_month = period_bounds()
+    keys = _summary_keys(user.pk, month_start)
+    cached = _cache().get_many(keys.values())
+
+    if keys[TOTAL] in cached:
+        totals = {feature: cached.get(key, 0) for feature, key in keys.items() if feature != TOTAL}
+    else:
+        totals = dict(
+            TokenUsageDaily.objects.filter(user=user, date__gte=month_start, date__lt=next_month)
+            .values_list('feature').annotate(total=Sum('tokens_used')).order_by()
+        )
+        counters = {key: totals.get(feature, 0) for feature, key in keys.items() if feature != TOTAL}
+        counters[keys[TOTAL]] = sum(totals.values())
+        _cache().set_many(counters, get_usage_summary_settings()['TTL'])
+
+    return _summary(totals, month_start, next_month)
+
+
+def record_summary_usage(user_id, feature, tokens_used, day):
+    """Add logged usage to the cached counters for its month, if they are cached"""
+    month_start, _ = period_bounds(day)
+    keys = _summary_keys(user_id, month_start)
+    try:
+        _cache().incr(keys[TOTAL], tokens_used)
+        _cache().incr(keys[feature], tokens_used)
+    except ValueError:
+        # Not cached (or partly evicted); the next read rebuilds from the rollup
+        _cache().delete(keys[TOTAL])
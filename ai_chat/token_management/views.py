@@ -1,7 +1,8 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.conf import settings
 from datetime import datetime, timedelta
 from django.db import models
@@ -10,7 +11,10 @@ from django.utils import timezone
 from django.db.models import Sum
 from django.http import JsonResponse
 
-from .models import TokenPurchase, TokenUsage, UserTokenLimit, TokenHistory
+from .models import TokenPurchase, TokenUsage, TokenUsageDaily, UserTokenLimit, TokenHistory
+from .archive import archived_usage
+from .quota import get_quota_snapshot
+from .export import ExportError, export_lines, parse_date
 
 # Set up Stripe API
 stripe.api_key = settings.STRIPE_SECRET_KEY
@@ -55,6 +59,19 @@ def overview(request):
     
     return render(request, 'token_management/overview.html', context)
 
+@login_required
+def limit_reached(request):
+    """Page shown by TokenUsageMiddleware once the monthly token limit is reached."""
+    snapshot = get_quota_snapshot(request.user)
+    
+    context = {
+        'token_limit': snapshot['limit'],
+        'token_usage': snapshot['usage'],
+        'days_until_reset': UserTokenLimit.objects.get(user=request.user).days_until_next_month(),
+    }
+    
+    return render(request, 'token_management/limit_reached.html', context)
+
 @login_required
 def purchase_tokens(request):
     """Page for purchasing additional tokens."""
@@ -114,15 +131,26 @@ def token_history(request):
         timestamp__range=[start_date, end_date]
     ).order_by('-timestamp')
     
+    # Rows older than the archive cutoff live in the usage archive
+    archived = archived_usage(request.user, start_date, end_date)
+    if archived:
+        usage_history = sorted(
+            list(usage_history) + archived, key=lambda usage: usage.timestamp, reverse=True
+        )
+    
     # Query token purchases
     purchase_history = TokenPurchase.objects.filter(
         user=request.user,
-        purchase_date__range=[start_date, end_date]
-    ).order_by('-purchase_date')
+        created_at__range=[start_date, end_date]
+    ).order_by('-created_at')
+    
+    # Per-day totals for the chart, from the daily rollup
+    daily_usage = sorted(TokenUsageDaily.daily_totals(request.user, start_date, end_date).items())
     
     context = {
         'usage_history': usage_history,
         'purchase_history': purchase_history,
+        'daily_usage': daily_usage,
         'start_date': start_date,
         'end_date': end_date
     }
@@ -213,28 +241,53 @@ def token_usage_api(request):
     """API endpoint for token usage statistics."""
     # Get date range
     days = int(request.GET.get('days', 30))
-    end_date = datetime.now()
+    end_date = timezone.localdate()
     start_date = end_date - timedelta(days=days)
     
-    # Get daily usage data
+    # Daily totals come from the rollup table in one query
+    daily_totals = TokenUsageDaily.daily_totals(
+        request.user, start_date, end_date, feature=request.GET.get('feature')
+    )
+    
     usage_data = []
     current_date = start_date
     
     while current_date <= end_date:
-        daily_usage = TokenUsage.objects.filter(
-            user=request.user,
-            timestamp__date=current_date.date()
-        ).values('amount').aggregate(total=models.Sum('amount'))['total'] or 0
-        
         usage_data.append({
             'date': current_date.strftime('%Y-%m-%d'),
-            'tokens': daily_usage
+            'tokens': daily_totals.get(current_date, 0)
         })
         
         current_date += timedelta(days=1)
     
     return JsonResponse({'usage_data': usage_data})
 
+@staff_member_required
+def export_token_data(request, dataset):
+    """
+    Stream TokenUsage, TokenPurchase or TokenHistory rows as CSV or JSONL
+    Query parameters: format (csv or jsonl), user (id or username), start and
+    end (YYYY-MM-DD, inclusive) and feature (usage only).
+    """
+    fmt = request.GET.get('format', 'csv')
+    try:
+        lines = export_lines(
+            dataset,
+            fmt=fmt,
+            user=request.GET.get('user'),
+            start=parse_date(request.GET.get('start'), 'start'),
+            end=parse_date(request.GET.get('end'), 'end'),
+            feature=request.GET.get('feature'),
+        )
+    except ExportError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(lines, content_type=content_type)
+    filename = f"token-{dataset}-{timezone.localdate():%Y-%m-%d}.{fmt}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
 @login_required
 def usage_settings(request):
     """Page for configuring token usage settings and alerts."""
@@ -310,11 +363,10 @@ def usage_history(request):
         'percent_used': token_limit.get_token_percent_used(),
     }
     
-    # Calculate feature usage breakdown
-    feature_breakdown = TokenUsage.objects.filter(
+    # Calculate feature usage breakdown from the daily rollup
+    feature_breakdown = TokenUsageDaily.objects.filter(
         user=request.user,
-        timestamp__year=timezone.now().year,
-        timestamp__month=timezone.now().month
+        date__gte=timezone.localdate().replace(day=1)
     ).values('feature').annotate(
         total=Sum('tokens_used')
     ).order_by('-total')
@@ -7,6 +7,7 @@ from django.utils import timezone
 from django.db.models import Sum
 
 from .forms import CustomUserCreationForm, CustomUserChangeForm, UserPreferencesForm
+from token_management.archive import archived_total
 from token_management.models import UserTokenLimit, TokenUsage
 from django.contrib.auth.views import (
     PasswordResetView, PasswordResetDoneView, PasswordResetConfirmView, 
@@ -69,6 +70,7 @@ def profile_view(request):
     total_usage = TokenUsage.objects.filter(user=user).aggregate(
         Sum('tokens_used')
     )['tokens_used__sum'] or 0
+    total_usage += archived_total(user)
     
     token_usage = {
         'monthly_tokens_used': monthly_usage,